@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+import untar_stripped
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from benchtools import find_regressions, peak_rss_kb
+
+OPERATIONS = ('list', 'info', 'extract')
+IMPLEMENTATIONS = ('TarParser', 'tarfile')
+
+
+def _add_file(tar, name, size, rnd):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = 1400000000
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(rnd.getrandbits(8 * size).to_bytes(
+        size, 'little') if size else b''))
+
+
+def make_tiny_files(tar, scale, rnd):
+    for i in range(int(20000 * scale)):
+        _add_file(tar, 'tiny/{:03}/{}.txt'.format(i % 100, i),
+                  rnd.randrange(0, 200), rnd)
+
+
+def make_huge_files(tar, scale, rnd):
+    # Случайные данные для больших файлов дорого генерировать, поэтому
+    # повторяем один мегабайт
+    block = rnd.getrandbits(8 * 2**20).to_bytes(2**20, 'little')
+    for i in range(4):
+        size = int(64 * 2**20 * scale)
+        info = tarfile.TarInfo('huge/{}.bin'.format(i))
+        info.size = size
+        info.mtime = 1400000000
+        data = (block * (size // len(block) + 1))[:size]
+        tar.addfile(info, io.BytesIO(data))
+
+
+def make_deep_tree(tar, scale, rnd):
+    for i in range(int(200 * scale)):
+        path = '/'.join('d{}'.format(rnd.randrange(3)) for _ in range(40))
+        _add_file(tar, 'deep/{}/{}.txt'.format(path, i), 10, rnd)
+
+
+def make_long_names(tar, scale, rnd):
+    # Имена длиннее 100 символов, но каждая компонента короче NAME_MAX
+    for i in range(int(5000 * scale)):
+        name = 'long/{}/{}_{}'.format('d' * rnd.randrange(100, 200),
+                                      'n' * rnd.randrange(100, 200), i)
+        _add_file(tar, name, 10, rnd)
+
+
+ARCHIVES = {
+    'tiny_files': make_tiny_files,
+    'huge_files': make_huge_files,
+    'deep_tree': make_deep_tree,
+    'long_names': make_long_names,
+}
+
+
+def make_archives(directory, scale=1.0, seed=0):
+    '''
+    Создаёт в `directory' синтетические архивы из ARCHIVES (детерминированно
+    по `seed'). Возвращает словарь {название: путь}
+    '''
+    paths = {}
+    for name, make in ARCHIVES.items():
+        path = os.path.join(directory, name + '.tar')
+        with tarfile.open(path, 'w', format=tarfile.PAX_FORMAT) as tar:
+            make(tar, scale, random.Random(seed))
+        paths[name] = path
+    return paths
+
+
+def run_operation(implementation, operation, archive, dest):
+    '''
+    Выполняет одну операцию над архивом; вызывается в отдельном процессе,
+    чтобы замерить его пиковую память и системные вызовы
+    '''
+    with open(os.devnull, 'w') as out:
+        if implementation == 'TarParser':
+            with untar_stripped.TarParser(archive) as tar:
+                if operation == 'list':
+                    for name in sorted(tar.files()):
+                        print(name, file=out)
+                elif operation == 'info':
+                    for name in sorted(tar.files()):
+                        untar_stripped.print_file_info(
+                            tar.file_stat(name), f=out)
+                else:
+                    tar.extract(dest)
+        else:
+            with tarfile.open(archive) as tar:
+                if operation == 'list':
+                    for name in sorted(tar.getnames()):
+                        print(name, file=out)
+                elif operation == 'info':
+                    for member in sorted(tar.getmembers(),
+                                         key=lambda m: m.name):
+                        print(member.get_info(), file=out)
+                else:
+                    tar.extractall(dest)
+
+
+def _count_syscalls(strace_output):
+    # Сводка `strace -c': строки "% time  seconds  usecs/call  calls
+    # [errors]  syscall" по каждому вызову, затем итоговая строка total
+    calls = 0
+    with open(strace_output) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) in (5, 6) and fields[-1] != 'total' and \
+                    fields[3].isdigit():
+                calls += int(fields[3])
+    return calls
+
+
+def measure(implementation, operation, archive, workdir, strace=None):
+    '''
+    Замеряет операцию в дочернем процессе. Возвращает словарь с временем
+    (секунды), пиковой памятью (КиБ) и числом системных вызовов (если
+    доступен strace)
+    '''
+    dest = tempfile.mkdtemp(dir=workdir)
+    command = [sys.executable, os.path.abspath(__file__), '--run',
+               implementation, operation, archive, dest]
+    strace_output = None
+    if strace is not None:
+        strace_output = os.path.join(workdir, 'strace.out')
+        command = [strace, '-f', '-c', '-o', strace_output] + command
+
+    try:
+        start = time.perf_counter()
+        process = subprocess.run(command, stdout=subprocess.PIPE)
+        elapsed = time.perf_counter() - start
+        if process.returncode:
+            raise RuntimeError('{} {} {} failed'.format(
+                implementation, operation, archive))
+    finally:
+        shutil.rmtree(dest, ignore_errors=True)
+
+    return {
+        'seconds': elapsed,
+        'max_rss_kb': int(process.stdout),
+        'syscalls': (_count_syscalls(strace_output)
+                     if strace_output is not None else None),
+    }
+
+
+def run_benchmarks(scale=1.0, repeat=3, strace=None, workdir=None):
+    '''
+    Прогоняет все операции для всех реализаций на всех архивах. Время
+    берётся лучшее из `repeat' запусков, память и системные вызовы -- из
+    отдельного запуска под strace
+    '''
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        archives = make_archives(tmp, scale)
+        report = {
+            'python': sys.version.split()[0],
+            'scale': scale,
+            'archives': {name: os.path.getsize(path)
+                         for name, path in archives.items()},
+            'results': [],
+        }
+
+        for name, path in archives.items():
+            for operation in OPERATIONS:
+                for implementation in IMPLEMENTATIONS:
+                    runs = [measure(implementation, operation, path, tmp)
+                            for _ in range(repeat)]
+                    result = min(runs, key=lambda run: run['seconds'])
+                    if strace is not None:
+                        result['syscalls'] = measure(
+                            implementation, operation, path, tmp,
+                            strace)['syscalls']
+                    result.update(archive=name, operation=operation,
+                                  implementation=implementation)
+                    report['results'].append(result)
+    return report
+
+
+def _result_key(result):
+    return result['archive'], result['operation'], result['implementation']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='TarParser vs tarfile benchmark')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='scale of synthetic archives (default 1.0)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs for every measurement')
+    parser.add_argument('--strace', action='store_true',
+                        help='also count syscalls with strace')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write JSON report to FILE instead of stdout')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with a previous JSON report and exit '
+                             'with an error on TarParser regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against baseline '
+                             '(default 0.2 = 20%%)')
+    parser.add_argument('--workdir', metavar='DIR',
+                        help='directory for temporary archives')
+    parser.add_argument('--run', nargs=4, metavar=('IMPL', 'OP', 'ARCHIVE',
+                                                   'DEST'),
+                        help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.run:
+        run_operation(*args.run)
+        print(peak_rss_kb())
+        return
+
+    strace = shutil.which('strace') if args.strace else None
+    if args.strace and strace is None:
+        sys.exit('Error: strace is not found')
+
+    report = run_benchmarks(args.scale, args.repeat, strace, args.workdir)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # Сравниваем только TarParser: tarfile здесь -- эталон, а не предмет
+        # оптимизации
+        regressions = [
+            regression for regression in find_regressions(
+                report, baseline, args.tolerance, _result_key)
+            if regression[0][2] == 'TarParser']
+        for (archive, operation, _), old, new in regressions:
+            print('Regression: {} {}: {:.3f}s -> {:.3f}s'.format(
+                archive, operation, old, new), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
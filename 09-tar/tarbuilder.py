@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+import argparse
+import grp
+import io
+import os
+import pwd
+import stat
+import struct
+import sys
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TarBuilder:
+    _HEADER_FMT = '100s8s8s8s12s12s8sc100s6s2s32s32s8s8s155s12s'
+    _READ_BLOCK = 16 * 2**20
+    _BLOCK_SIZE = 512
+    _RECORD_SIZE = 20 * _BLOCK_SIZE
+    _CHECKSUM_OFFSET = 148
+
+    # Файлы не больше этого размера читаются целиком заранее в пуле
+    # потоков, большие -- кусками прямо при записи
+    _READ_AHEAD_FILE = 2**20
+
+    def __init__(self, fileobj, workers=4):
+        '''
+        Создаёт tar-архив (ustar, при необходимости с расширенными
+        заголовками PAX), который последовательно пишется в файловый
+        объект `fileobj' -- файл, канал или sys.stdout.buffer. Содержимое
+        небольших файлов заранее читается в `workers' потоков
+        '''
+        self._fileobj = fileobj
+        self._workers = workers
+        self._written = 0
+        self._links = {}
+        self._users = {}
+        self._groups = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+
+    def close(self):
+        '''
+        Дописывает конец архива: два нулевых блока и выравнивание до
+        размера записи, как это делает tar
+        '''
+        self._write(bytes(2 * self._BLOCK_SIZE))
+        self._write(bytes(-self._written % self._RECORD_SIZE))
+        self._fileobj.flush()
+
+    def _write(self, data):
+        self._fileobj.write(data)
+        self._written += len(data)
+
+    @staticmethod
+    def _format_number(value, size):
+        # Не влезающие в восьмеричную запись числа пишем в base-256, как
+        # GNU tar; отрицательные (время до 1970 года) -- в дополнительном
+        # коде, тогда первый байт 0xff
+        if 0 <= value < 8 ** (size - 1):
+            return '{:0{}o}'.format(value, size - 1).encode() + b'\0'
+        if -256 ** (size - 1) <= value < 0:
+            return value.to_bytes(size, 'big', signed=True)
+        return b'\x80' + value.to_bytes(size - 1, 'big')
+
+    @staticmethod
+    def _pax_record(key, value):
+        record = ' {}={}\n'.format(key, value).encode(
+            'utf-8', 'surrogateescape')
+        length = len(record)
+        while len(str(length)) + len(record) != length:
+            length = len(str(length)) + len(record)
+        return str(length).encode() + record
+
+    def _user_name(self, uid):
+        if uid not in self._users:
+            try:
+                self._users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self._users[uid] = ''
+        return self._users[uid]
+
+    def _group_name(self, gid):
+        if gid not in self._groups:
+            try:
+                self._groups[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                self._groups[gid] = ''
+        return self._groups[gid]
+
+    def _split_name(self, name):
+        '''
+        Делит имя на префикс и имя в терминах ustar. Возвращает None, если
+        так записать имя нельзя
+        '''
+        encoded = name.encode('utf-8', 'surrogateescape')
+        if len(encoded) <= 100:
+            return b'', encoded
+        pos = encoded.rfind(b'/', 0, 156)
+        while pos > 0:
+            if len(encoded) - pos - 1 <= 100:
+                return encoded[:pos], encoded[pos + 1:]
+            pos = encoded.rfind(b'/', 0, pos)
+        return None
+
+    def _pack_header(self, name, st, file_type, size, linkname=''):
+        pax = {}
+        split = self._split_name(name)
+        if split is None or not name.isascii():
+            pax['path'] = name
+            split = b'', name.encode('ascii', 'replace')[-100:]
+        prefix, short_name = split
+
+        encoded_link = linkname.encode('utf-8', 'surrogateescape')
+        if len(encoded_link) > 100 or not linkname.isascii():
+            pax['linkpath'] = linkname
+            encoded_link = encoded_link[:100]
+        if size >= 8 ** 11:
+            pax['size'] = size
+
+        header = bytearray(struct.pack(
+            self._HEADER_FMT,
+            short_name,
+            self._format_number(stat.S_IMODE(st.st_mode), 8),
+            self._format_number(st.st_uid, 8),
+            self._format_number(st.st_gid, 8),
+            self._format_number(size, 12),
+            self._format_number(int(st.st_mtime), 12),
+            b' ' * 8,
+            file_type,
+            encoded_link,
+            b'ustar\0', b'00',
+            self._user_name(st.st_uid).encode()[:32],
+            self._group_name(st.st_gid).encode()[:32],
+            b'', b'',
+            prefix,
+            b''))
+        header[self._CHECKSUM_OFFSET:self._CHECKSUM_OFFSET + 8] = \
+            '{:06o}\0 '.format(sum(header)).encode()
+
+        if not pax:
+            return bytes(header)
+
+        records = b''.join(self._pax_record(key, value)
+                           for key, value in sorted(pax.items()))
+        pax_name = 'PaxHeaders/' + os.path.basename(name).encode(
+            'ascii', 'replace').decode()[-80:]
+        pax_header = self._pack_header(
+            pax_name, st, b'x', len(records))
+        padding = bytes(-len(records) % self._BLOCK_SIZE)
+        return pax_header + records + padding + bytes(header)
+
+    def _entries(self, path, arcname):
+        '''
+        Обходит дерево `path' в детерминированном (отсортированном)
+        порядке. Возвращает итератор троек (путь, имя в архиве, stat)
+        '''
+        st = os.lstat(path)
+        yield path, arcname, st
+        if not stat.S_ISDIR(st.st_mode):
+            return
+
+        with os.scandir(path) as it:
+            names = sorted(entry.name for entry in it)
+        for name in names:
+            yield from self._entries(os.path.join(path, name),
+                                     arcname + '/' + name)
+
+    @classmethod
+    def _read_small(cls, path, st):
+        if not stat.S_ISREG(st.st_mode) or st.st_size > cls._READ_AHEAD_FILE:
+            return None
+        with open(path, 'rb') as f:
+            return f.read(st.st_size + 1)
+
+    def _add_entry(self, path, arcname, st, data):
+        if stat.S_ISDIR(st.st_mode):
+            self._write(self._pack_header(arcname + '/', st, b'5', 0))
+        elif stat.S_ISLNK(st.st_mode):
+            self._write(self._pack_header(
+                arcname, st, b'2', 0, os.readlink(path)))
+        elif stat.S_ISREG(st.st_mode):
+            key = (st.st_dev, st.st_ino)
+            if st.st_nlink > 1 and key in self._links:
+                self._write(self._pack_header(
+                    arcname, st, b'1', 0, self._links[key]))
+                return
+            self._links[key] = arcname
+            self._add_file(path, arcname, st, data)
+        elif stat.S_ISFIFO(st.st_mode):
+            self._write(self._pack_header(arcname, st, b'6', 0))
+
+    def _add_file(self, path, arcname, st, data):
+        if data is not None and len(data) == st.st_size:
+            self._write(self._pack_header(arcname, st, b'0', len(data)))
+            self._write(data)
+            self._write(bytes(-len(data) % self._BLOCK_SIZE))
+            return
+
+        # Файл большой или поменялся после stat: пишем его кусками, а в
+        # заголовке оставляем размер из stat -- как и tar, дополняем
+        # данные нулями или обрезаем
+        self._write(self._pack_header(arcname, st, b'0', st.st_size))
+        left = st.st_size
+        with open(path, 'rb') as f:
+            while left > 0:
+                chunk = f.read(min(left, self._READ_BLOCK))
+                if not chunk:
+                    chunk = bytes(min(left, self._READ_BLOCK))
+                self._write(chunk)
+                left -= len(chunk)
+        self._write(bytes(-st.st_size % self._BLOCK_SIZE))
+
+    def add(self, path, arcname=None):
+        '''
+        Добавляет в архив файл или каталог `path' со всем содержимым под
+        именем `arcname' (по умолчанию -- `path' без ведущего `/')
+        '''
+        if arcname is None:
+            arcname = os.path.normpath(path).lstrip('/')
+
+        # Заголовки пишутся строго по порядку обхода, а содержимое
+        # небольших файлов читается заранее, не больше 4 * workers файлов
+        # вперёд
+        with ThreadPoolExecutor(self._workers) as pool:
+            pending = deque()
+            for entry in self._entries(path, arcname):
+                pending.append((entry, pool.submit(self._read_small,
+                                                   entry[0], entry[2])))
+                if len(pending) >= 4 * self._workers:
+                    entry, future = pending.popleft()
+                    self._add_entry(*entry, future.result())
+            while pending:
+                entry, future = pending.popleft()
+                self._add_entry(*entry, future.result())
+
+
+class _CountingSink(io.RawIOBase):
+    def __init__(self):
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def benchmark(paths, workers=4, repeat=3):
+    '''
+    Сравнивает скорость TarBuilder и модуля tarfile на дереве `paths',
+    записывая архив в никуда. Возвращает словарь
+    {название: (секунды, байт в секунду)} с лучшим из `repeat' замеров
+    '''
+    def build_tarbuilder(sink):
+        with TarBuilder(sink, workers=workers) as tar:
+            for path in paths:
+                tar.add(path)
+
+    def build_tarfile(sink):
+        with tarfile.open(fileobj=sink, mode='w|',
+                          format=tarfile.PAX_FORMAT) as tar:
+            for path in paths:
+                tar.add(path)
+
+    results = {}
+    for name, build in (('TarBuilder', build_tarbuilder),
+                        ('tarfile', build_tarfile)):
+        best = None
+        for _ in range(repeat):
+            sink = _CountingSink()
+            start = time.perf_counter()
+            build(sink)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best[0]:
+                best = (elapsed, sink.size / elapsed)
+        results[name] = best
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='{} [OPTIONS] PATH...'.format(os.path.basename(sys.argv[0])),
+        description='Tar archiver')
+    parser.add_argument('-f', '--file', default='-', dest='fn',
+                        metavar='ARCHIVE',
+                        help="name of an archive to create ('-' for stdout, "
+                             "default)")
+    parser.add_argument('-j', '--workers', type=int, default=4,
+                        metavar='N', dest='workers',
+                        help='read files in N threads')
+    parser.add_argument('--bench', action='store_true', dest='bench',
+                        help='compare archiving speed with tarfile module '
+                             'instead of creating an archive')
+    parser.add_argument('paths', metavar='PATH', nargs='+',
+                        help='files and directories to archive')
+
+    args = parser.parse_args()
+
+    try:
+        if args.bench:
+            for name, (elapsed, speed) in benchmark(
+                    args.paths, workers=args.workers).items():
+                print('{:>10} : {:.3f} s, {:.1f} MB/s'.format(
+                    name, elapsed, speed / 2**20))
+        elif args.fn == '-':
+            with TarBuilder(sys.stdout.buffer, workers=args.workers) as tar:
+                for path in args.paths:
+                    tar.add(path)
+        else:
+            with open(args.fn, 'wb') as f, \
+                    TarBuilder(f, workers=args.workers) as tar:
+                for path in args.paths:
+                    tar.add(path)
+    except Exception as e:
+        sys.exit(e)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+import tarbuilder as t
+import untar_stripped
+
+
+class TestTarBuilder(unittest.TestCase):
+    LONG_NAME = 'd' * 120 + '/' + 'f' * 120
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tree = os.path.join(self._tmp.name, 'tree')
+        self.files = {
+            'a.txt': b'hello',
+            'big.bin': os.urandom(3 * t.TarBuilder._READ_AHEAD_FILE),
+            'sub/b.txt': b'',
+            'sub/файл.txt': b'unicode',
+            self.LONG_NAME: b'long',
+        }
+        for name, data in self.files.items():
+            path = os.path.join(self.tree, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        os.symlink('a.txt', os.path.join(self.tree, 'link'))
+        os.link(os.path.join(self.tree, 'a.txt'),
+                os.path.join(self.tree, 'hard'))
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def build(self, workers=4):
+        out = io.BytesIO()
+        with t.TarBuilder(out, workers=workers) as tar:
+            tar.add(self.tree, 'tree')
+        return out.getvalue()
+
+    def test_read_by_tarfile(self):
+        data = self.build()
+        self.assertEqual(len(data) % t.TarBuilder._RECORD_SIZE, 0)
+
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            for name, content in self.files.items():
+                member = tar.getmember('tree/' + name)
+                self.assertEqual(tar.extractfile(member).read(), content)
+            self.assertEqual(tar.getmember('tree/link').linkname, 'a.txt')
+            self.assertTrue(tar.getmember('tree/hard').islnk())
+            self.assertTrue(tar.getmember('tree/sub').isdir())
+
+    def test_read_by_tar_parser(self):
+        path = os.path.join(self._tmp.name, 'test.tar')
+        with open(path, 'wb') as f:
+            f.write(self.build(workers=1))
+
+        dest = os.path.join(self._tmp.name, 'out')
+        with untar_stripped.TarParser(path) as tar:
+            self.assertIn('tree/' + self.LONG_NAME, list(tar.files()))
+            tar.extract(dest)
+        for name, content in self.files.items():
+            with open(os.path.join(dest, 'tree', name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    def test_mtime_before_epoch(self):
+        os.utime(os.path.join(self.tree, 'a.txt'), (-86400, -86400))
+        path = os.path.join(self._tmp.name, 'test.tar')
+        with open(path, 'wb') as f:
+            f.write(self.build())
+
+        with tarfile.open(path) as tar:
+            self.assertEqual(tar.getmember('tree/a.txt').mtime, -86400)
+        dest = os.path.join(self._tmp.name, 'out')
+        with untar_stripped.TarParser(path) as tar:
+            tar.extract(dest, members=['tree/a.txt'])
+        self.assertEqual(
+            os.stat(os.path.join(dest, 'tree', 'a.txt')).st_mtime, -86400)
+
+    def test_deterministic(self):
+        self.assertEqual(self.build(workers=1), self.build(workers=8))
+
+
+if __name__ == '__main__':
+    unittest.main()
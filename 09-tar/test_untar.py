@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import re
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+import untar_stripped as t
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_archive(path, files, fmt=tarfile.GNU_FORMAT):
+    '''
+    Собирает архив `path' из словаря {имя: содержимое}; содержимое None
+    означает каталог
+    '''
+    with tarfile.open(path, 'w', format=fmt) as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.mtime = 1400000000
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(data))
+
+
+class TestTarParser(unittest.TestCase):
+    FILES = {
+        'dir': None,
+        'dir/a.txt': b'hello',
+        'dir/sub': None,
+        'dir/sub/b.bin': bytes(range(256)) * 5,
+        'empty': b'',
+    }
+    OPTIONS = {}
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = self._tmp.name
+        self.archive = os.path.join(self.tmp, 'test.tar')
+        make_archive(self.archive, self.FILES)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def open(self, path, **kwargs):
+        return t.TarParser(path, **dict(self.OPTIONS, **kwargs))
+
+    def assertExtracted(self, dest, names=None):
+        for name, data in self.FILES.items():
+            path = os.path.join(dest, name)
+            if names is not None and name not in names:
+                if data is not None:
+                    self.assertFalse(os.path.exists(path))
+                continue
+            if data is None:
+                self.assertTrue(os.path.isdir(path))
+            else:
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), data)
+                self.assertEqual(os.stat(path).st_mtime, 1400000000)
+
+    def test_level_archives(self):
+        for name in ('level1.tar', 'level2.tar'):
+            with tarfile.open(os.path.join(HERE, name)) as tar:
+                expected = tar.getnames()
+            with self.open(os.path.join(HERE, name)) as tar:
+                self.assertListEqual(list(tar.files()), expected)
+
+    def test_files(self):
+        with self.open(self.archive) as tar:
+            self.assertListEqual(list(tar.files()), list(self.FILES))
+
+    def test_file_stat(self):
+        with self.open(self.archive) as tar:
+            stat = dict(tar.file_stat('dir/a.txt'))
+            self.assertEqual(stat['Type'], 'Regular file')
+            self.assertEqual(stat['Mode'], '0000644')
+            self.assertEqual(stat['Size'], '5')
+            self.assertEqual(dict(tar.file_stat('dir'))['Type'], 'Directory')
+            with self.assertRaises(ValueError):
+                tar.file_stat('missing')
+
+    def test_extract(self):
+        dest = os.path.join(self.tmp, 'out')
+        with self.open(self.archive) as tar:
+            tar.extract(dest)
+        self.assertExtracted(dest)
+
+    def test_extract_parallel(self):
+        dest = os.path.join(self.tmp, 'out')
+        with self.open(self.archive) as tar:
+            tar.extract(dest, workers=4)
+        self.assertExtracted(dest)
+
+    def make_symlink_archive(self, target):
+        # Ссылка `a' и файл, который записался бы по ней
+        archive = os.path.join(self.tmp, 'symlink.tar')
+        with tarfile.open(archive, 'w') as tar:
+            info = tarfile.TarInfo('a')
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tar.addfile(info)
+            info = tarfile.TarInfo('a/pwned')
+            info.size = 5
+            tar.addfile(info, io.BytesIO(b'pwned'))
+        return archive
+
+    def test_extract_symlink_outside(self):
+        outside = os.path.join(self.tmp, 'outside')
+        os.mkdir(outside)
+        dest = os.path.join(self.tmp, 'out')
+        for target in (outside, '../outside', 'x/../../outside'):
+            archive = self.make_symlink_archive(target)
+            with self.open(archive) as tar:
+                with self.assertRaises(ValueError):
+                    tar.extract(dest)
+            with open(archive, 'rb') as f, self.assertRaises(ValueError):
+                t.TarParser.extract_stream(f, dest)
+            self.assertListEqual(os.listdir(outside), [])
+
+        # Уже существующая в `dest' ссылка наружу тоже не помогает
+        os.makedirs(dest, exist_ok=True)
+        os.symlink(outside, os.path.join(dest, 'dir'))
+        with self.open(self.archive) as tar, self.assertRaises(ValueError):
+            tar.extract(dest)
+        self.assertListEqual(os.listdir(outside), [])
+
+    def test_extract_symlink_inside(self):
+        os.makedirs(os.path.join(self.tmp, 'out', 'dir'))
+        dest = os.path.join(self.tmp, 'out')
+        with self.open(self.make_symlink_archive('dir')) as tar:
+            tar.extract(dest)
+        self.assertTrue(os.path.islink(os.path.join(dest, 'a')))
+        with open(os.path.join(dest, 'dir', 'pwned'), 'rb') as f:
+            self.assertEqual(f.read(), b'pwned')
+
+    @staticmethod
+    def snapshot(dest):
+        tree = {}
+        for root, dirs, files in os.walk(dest):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    tree[os.path.relpath(path, dest)] = os.readlink(path)
+                elif os.path.isfile(path):
+                    with open(path, 'rb') as f:
+                        tree[os.path.relpath(path, dest)] = f.read()
+                else:
+                    tree[os.path.relpath(path, dest)] = None
+        return tree
+
+    def test_extract_symlink_parallel(self):
+        archive = os.path.join(self.tmp, 'symlink.tar')
+        with tarfile.open(archive, 'w') as tar:
+            # Тип: None - каталог, str - ссылка, bytes - файл
+            for name, kind in (('dir', None), ('a', 'dir'),
+                               ('a/pwned', b'pwned'), ('a/sub', None),
+                               ('a/sub/b.txt', b'b'), ('dir/c.txt', b'c')):
+                info = tarfile.TarInfo(name)
+                if kind is None:
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                elif isinstance(kind, str):
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = kind
+                    tar.addfile(info)
+                else:
+                    info.size = len(kind)
+                    tar.addfile(info, io.BytesIO(kind))
+
+        trees = []
+        for workers in (None, 4):
+            dest = os.path.join(self.tmp, 'out{}'.format(workers))
+            with self.open(archive) as tar:
+                tar.extract(dest, workers=workers)
+            trees.append(self.snapshot(dest))
+        self.assertDictEqual(trees[0], trees[1])
+        self.assertEqual(trees[1]['a'], 'dir')
+        self.assertEqual(trees[1]['dir/sub/b.txt'], b'b')
+
+    def test_stream(self):
+        with open(self.archive, 'rb') as f:
+            data = f.read()
+
+        names = []
+        for header, chunks in t.TarParser.iter_stream(io.BytesIO(data)):
+            names.append(header['name'])
+            if header['name'] == 'dir/a.txt':
+                self.assertEqual(b''.join(chunks), b'hello')
+        self.assertListEqual(names, list(self.FILES))
+
+        dest = os.path.join(self.tmp, 'out')
+        t.TarParser.extract_stream(io.BufferedReader(io.BytesIO(data)), dest)
+        self.assertExtracted(dest)
+
+    def test_verify(self):
+        with self.open(self.archive) as tar:
+            report = tar.verify('sha256')
+        self.assertListEqual([name for name, _, _ in report],
+                             list(self.FILES))
+        for name, problems, digest in report:
+            self.assertListEqual(problems, [])
+            if self.FILES[name] is not None:
+                self.assertEqual(digest,
+                                 hashlib.sha256(self.FILES[name]).hexdigest())
+
+    def test_verify_corrupt(self):
+        with open(self.archive, 'r+b') as f:
+            f.seek(512 * 1 + 10)
+            f.write(b'!')
+        with self.open(self.archive) as tar:
+            problems = {name: problems for name, problems, _ in tar.verify()}
+        self.assertListEqual(problems['dir/a.txt'], ['bad header checksum'])
+        self.assertListEqual(problems['dir'], [])
+
+    def test_verify_truncated(self):
+        # Заголовок dir/sub/b.bin начинается на 2048 байте
+        for size, problem in ((2300, 'truncated header'),
+                              (2048, 'missing end-of-archive marker')):
+            with open(self.archive, 'r+b') as f:
+                f.truncate(size)
+            with self.open(self.archive) as tar:
+                report = tar.verify()
+            self.assertListEqual(report[-1][1], [problem])
+            self.assertListEqual([name for name, _, _ in report[:-1]],
+                                 ['dir', 'dir/a.txt', 'dir/sub'])
+
+        # Обрезанные данные файла -- последняя проблема
+        with open(self.archive, 'r+b') as f:
+            f.truncate(1026)
+        with self.open(self.archive) as tar:
+            report = tar.verify()
+        self.assertEqual(report[-1], ('dir/a.txt', ['truncated data'], None))
+
+    def test_match_name(self):
+        self.assertTrue(t.match_name('dir/a.txt'))
+        self.assertTrue(t.match_name('dir/a.txt', include=['*.txt']))
+        self.assertFalse(t.match_name('dir/a.txt', include=['*.bin']))
+        self.assertFalse(t.match_name('dir/a.txt', exclude=['dir/*']))
+        self.assertTrue(t.match_name('dir/a.txt', include=[re.compile('a')]))
+
+    def test_extract_selected(self):
+        dest = os.path.join(self.tmp, 'out')
+        with self.open(self.archive) as tar:
+            self.assertListEqual(list(tar.files(include=['*.bin'])),
+                                 ['dir/sub/b.bin'])
+            tar.extract(dest, include=['dir*'], exclude=['*.txt'])
+        self.assertExtracted(dest, ['dir', 'dir/sub', 'dir/sub/b.bin'])
+
+    def test_extract_stream_selected(self):
+        dest = os.path.join(self.tmp, 'out')
+        with open(self.archive, 'rb') as f:
+            headers = t.TarParser.extract_stream(
+                f, dest, include=[re.compile(r'\.bin$')])
+        self.assertListEqual([header['name'] for header in headers],
+                             list(self.FILES))
+        self.assertExtracted(dest, ['dir', 'dir/sub', 'dir/sub/b.bin'])
+
+    def check_compressed(self, data, **kwargs):
+        path = os.path.join(self.tmp, 'test.tar.z')
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        dest = os.path.join(self.tmp, 'out')
+        with self.open(path, **kwargs) as tar:
+            self.assertListEqual(list(tar.files()), list(self.FILES))
+            # Для списка и информации о файлах архив не распаковывается
+            self.assertEqual(dict(tar.file_stat('dir/a.txt'))['Size'], '5')
+            self.assertIsNone(tar._data)
+            tar.extract(dest)
+        self.assertExtracted(dest)
+
+        names = [header['name'] for header, _ in
+                 t.TarParser.iter_stream(io.BytesIO(data))]
+        self.assertListEqual(names, list(self.FILES))
+
+    def test_compressed(self):
+        with open(self.archive, 'rb') as f:
+            data = f.read()
+        for module in (gzip, bz2, lzma):
+            self.check_compressed(module.compress(data))
+
+    @mock.patch.object(t.TarParser, '_DECOMPRESS_RANGE', 1)
+    def test_compressed_parallel(self):
+        with open(self.archive, 'rb') as f:
+            data = f.read()
+        for module in (gzip, bz2, lzma):
+            # Несколько независимых потоков, как у pbzip2
+            parts = b''.join(module.compress(data[i:i + 1000])
+                             for i in range(0, len(data), 1000))
+            self.check_compressed(parts, workers=2)
+
+        # Куски не растут с размером архива: каждый поток -- свой кусок
+        with self.open(os.path.join(self.tmp, 'test.tar.z'),
+                       workers=2) as tar:
+            self.assertEqual(len(tar._split_streams()),
+                             (len(data) + 999) // 1000)
+
+    def test_extract_members(self):
+        dest = os.path.join(self.tmp, 'out')
+        with self.open(self.archive) as tar:
+            tar.extract(dest, members=['dir/sub/b.bin'])
+        self.assertExtracted(dest, ['dir', 'dir/sub', 'dir/sub/b.bin'])
+
+    def test_index(self):
+        index = self.archive + '.idx'
+        with self.open(self.archive, use_index=True) as tar:
+            expected = list(tar.files())
+        self.assertTrue(os.path.exists(index))
+
+        # Индекс используется: архив не сканируется заново
+        with mock.patch.object(t.TarParser, '_scan',
+                               side_effect=AssertionError), \
+                self.open(self.archive, use_index=True) as tar:
+            self.assertListEqual(list(tar.files()), expected)
+            self.assertEqual(dict(tar.file_stat('dir/a.txt'))['Size'], '5')
+            dest = os.path.join(self.tmp, 'out')
+            tar.extract(dest)
+        self.assertExtracted(dest)
+
+    def test_stale_index(self):
+        with self.open(self.archive, use_index=True):
+            pass
+
+        self.FILES = dict(self.FILES, new=b'new file')
+        make_archive(self.archive, self.FILES)
+        os.utime(self.archive, ns=(0, 0))
+        with self.open(self.archive, use_index=True) as tar:
+            self.assertIn('new', list(tar.files()))
+
+
+class TestExtensions(unittest.TestCase):
+    LONG_NAME = 'long/' + 'x' * 150 + '/' + 'y' * 120
+    # Разреженный файл: 10 байт данных на смещении 5000 и 3 в самом конце
+    SPARSE = [(5000, 10), (20000, 3)]
+    SPARSE_SIZE = 20003
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = self._tmp.name
+        self.archive = os.path.join(self.tmp, 'test.tar')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def sparse_content(self):
+        content = bytearray(self.SPARSE_SIZE)
+        for offset, size in self.SPARSE:
+            content[offset:offset + size] = b'd' * size
+        return bytes(content)
+
+    def check_archive(self, name, content):
+        dest = os.path.join(self.tmp, 'out')
+        for kwargs in ({}, {'use_mmap': True}):
+            with t.TarParser(self.archive, **kwargs) as tar:
+                self.assertListEqual(list(tar.files()), [name])
+                self.assertEqual(dict(tar.file_stat(name))['Size'],
+                                 str(len(content)))
+                tar.extract(dest)
+            with open(os.path.join(dest, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+        with open(self.archive, 'rb') as f:
+            t.TarParser.extract_stream(f, dest)
+        with open(os.path.join(dest, name), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_global_pax(self):
+        # Глобальный заголовок PAX действует только на файлы после него
+        with tarfile.open(self.archive, 'w', format=tarfile.PAX_FORMAT) as tar:
+            for name, uname in (('a', 'alice'), ('pax_global_header', None),
+                                ('b', '')):
+                info = tarfile.TarInfo(name)
+                data = b''
+                if uname is None:
+                    info.type = tarfile.XGLTYPE
+                    data = b'13 uname=bob\n'
+                else:
+                    info.uname = uname
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+        for kwargs in ({}, {'use_index': True}, {'use_index': True}):
+            with t.TarParser(self.archive, **kwargs) as tar:
+                for _ in range(3):
+                    self.assertEqual(dict(tar.file_stat('a'))['User name'],
+                                     'alice')
+                    self.assertEqual(dict(tar.file_stat('b'))['User name'],
+                                     'bob')
+                self.assertEqual(len(tar._global_pax), 1)
+        with open(self.archive, 'rb') as f:
+            self.assertListEqual(
+                [(header['name'], header['uname'])
+                 for header, _ in t.TarParser.iter_stream(f)],
+                [('a', 'alice'), ('b', 'bob')])
+
+    def test_long_names(self):
+        for fmt in (tarfile.GNU_FORMAT, tarfile.PAX_FORMAT):
+            make_archive(self.archive, {self.LONG_NAME: b'data'}, fmt)
+            self.check_archive(self.LONG_NAME, b'data')
+
+    def make_pax_sparse(self, pax_headers, data):
+        with tarfile.open(self.archive, 'w', format=tarfile.PAX_FORMAT) as tar:
+            info = tarfile.TarInfo('GNUSparseFile.0/sparse')
+            info.size = len(data)
+            info.pax_headers = dict(pax_headers, **{
+                'GNU.sparse.name': 'sparse',
+                'GNU.sparse.realsize': str(self.SPARSE_SIZE),
+                'GNU.sparse.size': str(self.SPARSE_SIZE),
+            })
+            tar.addfile(info, io.BytesIO(data))
+
+    def test_pax_sparse_0_1(self):
+        self.make_pax_sparse({
+            'GNU.sparse.major': '0',
+            'GNU.sparse.minor': '1',
+            'GNU.sparse.map': ','.join(
+                str(n) for region in self.SPARSE for n in region),
+        }, b'd' * 13)
+        self.check_archive('sparse', self.sparse_content())
+
+    def test_pax_sparse_1_0(self):
+        sparse_map = '\n'.join(
+            [str(len(self.SPARSE))] +
+            [str(n) for region in self.SPARSE for n in region]) + '\n'
+        sparse_map = sparse_map.encode().ljust(512, b'\0')
+        self.make_pax_sparse({
+            'GNU.sparse.major': '1',
+            'GNU.sparse.minor': '0',
+        }, sparse_map + b'd' * 13)
+        self.check_archive('sparse', self.sparse_content())
+
+    def test_gnu_sparse(self):
+        make_archive(self.archive, {'sparse': b'd' * 13})
+        with open(self.archive, 'r+b') as f:
+            header = bytearray(f.read(512))
+
+            # Превращаем обычный файл в разреженный старого формата GNU
+            header[156:157] = b'S'
+            for i, (offset, size) in enumerate(self.SPARSE):
+                pos = 386 + 24 * i
+                header[pos:pos + 24] = b'%011o\0%011o\0' % (offset, size)
+            header[483:495] = b'%011o\0' % self.SPARSE_SIZE
+            header[148:156] = b' ' * 8
+            header[148:156] = b'%06o\0 ' % sum(header)
+
+            f.seek(0)
+            f.write(header)
+        self.check_archive('sparse', self.sparse_content())
+
+
+class TestTarParserMmap(TestTarParser):
+    OPTIONS = {'use_mmap': True}
+
+    def test_empty_archive(self):
+        open(self.archive, 'wb').close()
+        with self.open(self.archive) as tar:
+            self.assertListEqual(list(tar.files()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,57 @@
 #!/usr/bin/env python3
 
 import argparse
+import bz2
+import fnmatch
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import mmap
 import os.path
+import re
+import shutil
+import tempfile
 import time
 import struct
 import sys
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 class TarParser:
     _HEADER_FMT1 = '100s8s8s8s12s12s8sc100s255s'
     _HEADER_FMT2 = '6s2s32s32s8s8s155s12s'
     _HEADER_FMT3 = '6s2s32s32s8s8s12s12s112s31x'
+    _GNU_SPARSE_FMT = '96sc12s'
+    _GNU_SPARSE_EXT_FMT = '504sc'
     _READ_BLOCK = 16 * 2**20
+    _BLOCK_SIZE = 512
+    _USTAR_OFFSET = 257
+    _GNU_SPARSE_OFFSET = 386
+    _CHECKSUM_OFFSET = 148
+    _CHECKSUM_SIZE = 8
+    _LOW_BYTES = bytes(range(128))
+
+    _REGULAR_TYPES = (b'0', b'7', b'S')
+    # Служебные записи, которые относятся к следующему за ними файлу
+    _EXTENSION_TYPES = (b'K', b'L', b'g', b'x')
+
+    _INDEX_SUFFIX = '.idx'
+    _INDEX_VERSION = 3
+
+    # Сигнатуры начала сжатого потока и модули, которые его распаковывают
+    _COMPRESSIONS = OrderedDict([
+        ('gzip', (re.compile(rb'\x1f\x8b\x08'), gzip)),
+        ('bz2', (re.compile(rb'BZh[1-9](1AY&SY|\x17rE8P\x90)'), bz2)),
+        ('xz', (re.compile(rb'\xfd7zXZ\x00'), lzma)),
+    ])
+    _DECOMPRESS_ERRORS = (OSError, EOFError, ValueError, zlib.error,
+                          lzma.LZMAError)
+    _MAGIC_SIZE = 1024
+    _DECOMPRESS_RANGE = 8 * 2**20
 
     _FILE_TYPES = {
         b'0': 'Regular file',
@@ -31,27 +71,1003 @@ class TarParser:
         b'V': "`name' is tape/volume header name"
     }
 
-    def __init__(self, filename):
+    # Запись индекса: где лежит заголовок и данные файла в архиве и
+    # сколько записей глобальных заголовков PAX было до его заголовка
+    _Member = namedtuple(
+        '_Member',
+        'name header_offset data_offset size type mtime global_pax')
+
+    def __init__(self, filename, use_index=False, use_mmap=False,
+                 workers=None):
         '''
         Открывает tar-архив `filename' и производит его предобработку
         (если требуется)
+
+        Если `use_index' истинен, то список файлов берётся из индекса
+        `filename'.idx, а если индекса нет или он устарел (не совпадают
+        размер или время модификации архива) -- индекс строится заново
+
+        Если `use_mmap' истинен, то архив отображается в память: заголовки
+        разбираются прямо из отображения, без чтения блоков в буфер, а
+        данные файлов при распаковке пишутся из него же без копирования
+
+        Сжатые gzip, bzip2 и xz архивы распознаются по сигнатуре. Список
+        файлов и их заголовки читаются за один проход с распаковкой на
+        лету, а во временный файл архив распаковывается, только когда нужны
+        данные файлов. Если архив состоит из нескольких независимых сжатых
+        потоков (как у pbzip2 или склеенных gzip), то при `workers' больше
+        единицы потоки распаковываются параллельно в `workers' процессах;
+        обычный архив из одного потока распаковывается последовательно
+        '''
+        self._filename = filename
+        self._file = open(filename, 'rb')
+        self._members = OrderedDict()
+        # Заголовки, прочитанные при сканировании сжатого архива
+        self._headers = {}
+        self._global_pax = []
+        self._use_mmap = use_mmap
+        self._workers = workers
+
+        self._compression = self._sniff(self._file.read(self._MAGIC_SIZE))
+        self._data = self._mmap = self._view = None
+
+        if use_index and self._load_index():
+            return
+
+        self._scan()
+
+        if use_index:
+            self._save_index()
+
+    def close(self):
+        if self._mmap is not None:
+            self._view.release()
+            self._mmap.close()
+            self._mmap = self._view = None
+        if self._data is not None and self._data is not self._file:
+            self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _parse_number(field):
+        # GNU tar хранит большие числа в base-256 с выставленным старшим битом
+        if field[:1] == b'\x80':
+            return int.from_bytes(field[1:], 'big')
+        if field[:1] == b'\xff':
+            return int.from_bytes(field, 'big', signed=True)
+
+        field = field.split(b'\0', 1)[0].strip()
+        return int(field, 8) if field else 0
+
+    @staticmethod
+    def _parse_string(field):
+        return field.split(b'\0', 1)[0].decode('utf-8', 'surrogateescape')
+
+    @classmethod
+    def _parse_header(cls, buf, offset=0):
+        '''
+        Разбирает заголовок, лежащий в `buf' по смещению `offset'. `buf'
+        может быть и memoryview отображённого архива -- тогда блок
+        заголовка никуда не копируется
+        '''
+        (name, mode, uid, gid, size, mtime, checksum, file_type, linkname,
+         _) = struct.unpack_from(cls._HEADER_FMT1, buf, offset)
+        ustar = offset + cls._USTAR_OFFSET
+        magic = buf[ustar:ustar + 6]
+
+        header = {
+            'name': cls._parse_string(name),
+            'mode': cls._parse_number(mode),
+            'uid': cls._parse_number(uid),
+            'gid': cls._parse_number(gid),
+            'size': cls._parse_number(size),
+            'mtime': cls._parse_number(mtime),
+            'checksum': cls._parse_number(checksum),
+            'type': file_type if file_type != b'\0' else b'0',
+            'linkname': cls._parse_string(linkname),
+        }
+
+        if magic == b'ustar\0':
+            (_, _, uname, gname, devmajor, devminor, prefix,
+             _) = struct.unpack_from(cls._HEADER_FMT2, buf, ustar)
+            if prefix[:1] != b'\0':
+                header['name'] = '/'.join(
+                    (cls._parse_string(prefix), header['name']))
+        elif magic == b'ustar ':
+            (_, _, uname, gname, devmajor, devminor, atime, ctime,
+             _) = struct.unpack_from(cls._HEADER_FMT3, buf, ustar)
+            header['atime'] = cls._parse_number(atime)
+            header['ctime'] = cls._parse_number(ctime)
+        else:
+            return header
+
+        header['uname'] = cls._parse_string(uname)
+        header['gname'] = cls._parse_string(gname)
+        header['devmajor'] = cls._parse_number(devmajor)
+        header['devminor'] = cls._parse_number(devminor)
+        return header
+
+    @classmethod
+    def _is_stream_start(cls, compression, buf, offset):
+        if not cls._COMPRESSIONS[compression][0].match(buf, offset):
+            return False
+
+        # У gzip сигнатура короткая, поэтому проверяем, что с этого места
+        # действительно начинается deflate-поток, а у xz -- контрольную
+        # сумму флагов потока
+        if compression == 'gzip':
+            try:
+                zlib.decompressobj(31).decompress(
+                    bytes(buf[offset:offset + cls._MAGIC_SIZE]))
+            except zlib.error:
+                return False
+        elif compression == 'xz':
+            flags = bytes(buf[offset + 6:offset + 8])
+            crc = bytes(buf[offset + 8:offset + 12])
+            return zlib.crc32(flags) == int.from_bytes(crc, 'little')
+        return True
+
+    @classmethod
+    def _sniff(cls, head):
+        for compression in cls._COMPRESSIONS:
+            if cls._is_stream_start(compression, head, 0):
+                return compression
+        return None
+
+    def _split_streams(self):
+        '''
+        Делит сжатый архив на куски по границам независимых сжатых
+        потоков, не больше `_DECOMPRESS_RANGE' байт каждый: больше бывает
+        только кусок из одного потока, который сам больше этого
+        '''
+        size = os.fstat(self._file.fileno()).st_size
+        regex = self._COMPRESSIONS[self._compression][0]
+
+        ranges = []
+        begin = last = 0
+        with mmap.mmap(self._file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as buf:
+            for m in regex.finditer(buf, 1):
+                if not self._is_stream_start(self._compression, buf,
+                                             m.start()):
+                    continue
+                # Кусок заканчиваем на последней границе, при которой он
+                # ещё помещается в `_DECOMPRESS_RANGE'
+                if m.start() - begin > self._DECOMPRESS_RANGE and last > begin:
+                    ranges.append((begin, last))
+                    begin = last
+                last = m.start()
+            if size - begin > self._DECOMPRESS_RANGE and last > begin:
+                ranges.append((begin, last))
+                begin = last
+        ranges.append((begin, size))
+        return ranges
+
+    @classmethod
+    def _decompress_range(cls, filename, compression, begin, end):
+        '''
+        Распаковывает кусок архива с `begin' до `end' во временный файл
+        блоками по `_READ_BLOCK' байт и возвращает имя этого файла
+        '''
+        with open(filename, 'rb') as f:
+            f.seek(begin)
+            data = io.BytesIO(f.read(end - begin))
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as dst, \
+                    cls._COMPRESSIONS[compression][1].open(data) as src:
+                shutil.copyfileobj(src, dst, cls._READ_BLOCK)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path
+
+    def _decompress_parallel(self, ranges, dst):
+        # Результаты забираем по порядку, держа в работе не больше
+        # 2 * workers кусков. В памяти процесса -- только сжатый кусок
+        # (не больше `_DECOMPRESS_RANGE') и блок распакованных данных,
+        # распакованные куски ждут своей очереди на диске
+        def copy(future):
+            path = future.result()
+            try:
+                with open(path, 'rb') as src:
+                    shutil.copyfileobj(src, dst, self._READ_BLOCK)
+            finally:
+                os.remove(path)
+
+        with ProcessPoolExecutor(self._workers) as pool:
+            pending = deque()
+            try:
+                for begin, end in ranges:
+                    pending.append(pool.submit(
+                        self._decompress_range, self._filename,
+                        self._compression, begin, end))
+                    if len(pending) >= 2 * self._workers:
+                        copy(pending.popleft())
+                while pending:
+                    copy(pending.popleft())
+            finally:
+                for future in pending:
+                    if not future.cancel() and future.exception() is None:
+                        os.remove(future.result())
+
+    def _decompress(self, dst):
+        if self._workers is not None and self._workers > 1:
+            ranges = self._split_streams()
+            if len(ranges) > 1:
+                try:
+                    self._decompress_parallel(ranges, dst)
+                    return
+                except self._DECOMPRESS_ERRORS:
+                    # Ложная сигнатура внутри сжатых данных: распакуем
+                    # архив целиком последовательно
+                    dst.seek(0)
+                    dst.truncate()
+
+        self._file.seek(0)
+        with self._COMPRESSIONS[self._compression][1].open(self._file) as src:
+            shutil.copyfileobj(src, dst, self._READ_BLOCK)
+
+    def _open_data(self):
+        if self._compression is None:
+            self._data = self._file
+        else:
+            self._data = tempfile.TemporaryFile()
+            self._decompress(self._data)
+            self._data.flush()
+
+        if self._use_mmap and os.fstat(self._data.fileno()).st_size:
+            self._mmap = mmap.mmap(self._data.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+
+    @staticmethod
+    def _parse_pax(data):
+        '''
+        Разбирает записи расширенного заголовка PAX вида
+        "<длина> <ключ>=<значение>\\n" в список пар (ключ, значение).
+        Ключи могут повторяться (так устроены разреженные файлы GNU 0.0)
+        '''
+        records = []
+        pos = 0
+        while pos < len(data) and data[pos] != 0:
+            space = data.index(b' ', pos)
+            length = int(data[pos:space])
+            key, _, value = data[space + 1:pos + length - 1].partition(b'=')
+            records.append((key.decode('utf-8', 'surrogateescape'),
+                            value.decode('utf-8', 'surrogateescape')))
+            pos += length
+        return records
+
+    @classmethod
+    def _parse_sparse_map(cls, data):
+        '''
+        Разбирает карту разреженного файла старого формата GNU: пары
+        12-байтных чисел (смещение, длина), пустая пара -- конец карты
+        '''
+        sparse = []
+        for pos in range(0, len(data), 24):
+            if not any(data[pos:pos + 24]):
+                break
+            sparse.append((cls._parse_number(data[pos:pos + 12]),
+                           cls._parse_number(data[pos + 12:pos + 24])))
+        return sparse
+
+    @classmethod
+    def _apply_pax(cls, header, records):
+        sparse = []
+        for key, value in records:
+            if key == 'path':
+                header['name'] = value
+            elif key == 'linkpath':
+                header['linkname'] = value
+            elif key in ('size', 'uid', 'gid'):
+                header[key] = int(value)
+            elif key == 'mtime':
+                header['mtime'] = float(value)
+            elif key in ('uname', 'gname'):
+                header[key] = value
+            elif key == 'GNU.sparse.name':
+                header['sparse_name'] = value
+            elif key in ('GNU.sparse.size', 'GNU.sparse.realsize'):
+                header['realsize'] = int(value)
+            elif key == 'GNU.sparse.map':
+                numbers = list(map(int, value.split(',')))
+                sparse.extend(zip(numbers[::2], numbers[1::2]))
+            elif key == 'GNU.sparse.offset':
+                sparse.append((int(value), 0))
+            elif key == 'GNU.sparse.numbytes':
+                sparse[-1] = (sparse[-1][0], int(value))
+            elif key == 'GNU.sparse.major':
+                header['sparse_major'] = int(value)
+
+        if sparse:
+            header['sparse'] = sparse
+        if 'sparse_name' in header:
+            header['name'] = header.pop('sparse_name')
+
+    @classmethod
+    def _read_sparse_map_1_0(cls, read, header):
+        # В формате PAX 1.0 карта лежит в начале данных файла: числа через
+        # перевод строки (число пар, затем смещения и длины), дополненные
+        # до границы блока
+        data = b''
+        while True:
+            block = bytes(read(cls._BLOCK_SIZE))
+            if len(block) < cls._BLOCK_SIZE:
+                raise ValueError('{}: unexpected end of archive'.format(
+                    header['name']))
+            data += block
+            lines = data.split(b'\n')
+            if len(lines) > 1 and len(lines) > 2 * int(lines[0]) + 1:
+                break
+
+        numbers = list(map(int, lines[1:2 * int(lines[0]) + 1]))
+        header['sparse'] = list(zip(numbers[::2], numbers[1::2]))
+        header['size'] -= len(data)
+
+    @classmethod
+    def _read_header_chain(cls, read, global_pax, blocks=None):
+        '''
+        Читает заголовок файла вместе с предшествующими ему служебными
+        записями (длинные имена GNU, расширенные заголовки PAX) и картой
+        разреженного файла. `read(size)' должна возвращать следующие
+        `size' байт архива, после возврата она стоит на начале данных
+        файла. Записи глобальных заголовков PAX накапливаются в
+        `global_pax', а все прочитанные блоки заголовков -- в списке
+        `blocks', если он задан. Возвращает заголовок или None в конце
+        архива. Архив, оборвавшийся внутри цепочки служебных записей,
+        вызывает ValueError
+        '''
+        long_name = long_link = None
+        pax = []
+        chained = False
+        while True:
+            block = read(cls._BLOCK_SIZE)
+            if chained and len(block) < cls._BLOCK_SIZE:
+                raise ValueError('truncated header')
+            if len(block) < cls._BLOCK_SIZE or not any(block):
+                return None
+            chained = True
+
+            if blocks is not None:
+                blocks.append(block)
+            header = cls._parse_header(block)
+            if header['type'] not in cls._EXTENSION_TYPES:
+                break
+
+            data = bytes(read(cls._padded(header['size'])))[:header['size']]
+            if header['type'] == b'L':
+                long_name = cls._parse_string(data)
+            elif header['type'] == b'K':
+                long_link = cls._parse_string(data)
+            elif header['type'] == b'x':
+                pax.extend(cls._parse_pax(data))
+            else:
+                global_pax.extend(cls._parse_pax(data))
+
+        # Обычный файл без расширений -- самый частый случай, ничего
+        # больше делать не нужно
+        if long_name is not None:
+            header['name'] = long_name
+        if long_link is not None:
+            header['linkname'] = long_link
+        if global_pax or pax:
+            cls._apply_pax(header, global_pax + pax)
+
+        if header['type'] == b'S':
+            block = bytes(block)
+            sparse, extended, realsize = struct.unpack_from(
+                cls._GNU_SPARSE_FMT, block, cls._GNU_SPARSE_OFFSET)
+            header['sparse'] = cls._parse_sparse_map(sparse)
+            header['realsize'] = cls._parse_number(realsize)
+            while extended not in (b'\0', b'0'):
+                sparse, extended = struct.unpack_from(
+                    cls._GNU_SPARSE_EXT_FMT, bytes(read(cls._BLOCK_SIZE)))
+                header['sparse'].extend(cls._parse_sparse_map(sparse))
+        elif header.pop('sparse_major', 0) == 1:
+            cls._read_sparse_map_1_0(read, header)
+
+        header['name'] = header['name'].rstrip('/') or header['name']
+        return header
+
+    @classmethod
+    def _padded(cls, size):
+        return -(-size // cls._BLOCK_SIZE) * cls._BLOCK_SIZE
+
+    def _read_at(self, offset, size):
+        '''
+        Возвращает `size' байт архива начиная с `offset' (меньше, если
+        архив кончился). В режиме mmap это memoryview без копирования
+        '''
+        if self._data is None:
+            self._open_data()
+
+        if self._view is not None:
+            return self._view[offset:offset + size]
+        return os.pread(self._data.fileno(), size, offset)
+
+    def _read_header_at(self, offset, global_pax, blocks=None):
+        '''
+        Читает заголовок файла, цепочка служебных записей которого
+        начинается по смещению `offset', с действующими записями
+        глобальных заголовков PAX `global_pax' (список дополняется
+        записями из цепочки). Возвращает заголовок и смещение данных
+        файла. Блоки заголовков добавляются в список `blocks', если он
+        задан
+        '''
+        pos = offset
+
+        def read(size):
+            nonlocal pos
+            data = self._read_at(pos, size)
+            pos += len(data)
+            return data
+
+        header = self._read_header_chain(read, global_pax, blocks)
+        return header, pos
+
+    def _scan_stream(self):
+        '''
+        Сжатый архив сканируется за один проход с распаковкой на лету, как
+        в iter_stream(): распакованная копия нужна только для доступа к
+        данным файлов. Заголовки запоминаются, чтобы и file_stat() без неё
+        обходился
+        '''
+        self._file.seek(0)
+        offset = 0
+        with self._COMPRESSIONS[self._compression][1].open(
+                self._file) as stream:
+            def read(size):
+                nonlocal offset
+                data = self._read_exact(stream, size)
+                offset += len(data)
+                return data
+
+            while True:
+                header_offset = offset
+                global_pax = len(self._global_pax)
+                header = self._read_header_chain(read, self._global_pax)
+                if header is None:
+                    break
+
+                name = header['name']
+                self._members[name] = self._Member(
+                    name, header_offset, offset, header['size'],
+                    header['type'], header['mtime'], global_pax)
+                self._headers[name] = header
+                self._skip(stream, self._padded(header['size']))
+                offset += self._padded(header['size'])
+
+    def _scan(self):
+        if self._compression is not None:
+            self._scan_stream()
+            return
+
+        # Глобальные записи PAX только добавляются в конец списка, так что
+        # для каждого файла достаточно запомнить, сколько их было до него
+        offset = 0
+        while True:
+            global_pax = len(self._global_pax)
+            header, data_offset = self._read_header_at(offset,
+                                                       self._global_pax)
+            if header is None:
+                break
+
+            name = header['name']
+            self._members[name] = self._Member(
+                name, offset, data_offset, header['size'], header['type'],
+                header['mtime'], global_pax)
+            offset = data_offset + self._padded(header['size'])
+
+    def _index_filename(self):
+        return self._filename + self._INDEX_SUFFIX
+
+    def _load_index(self):
+        st = os.stat(self._file.fileno())
+        try:
+            with open(self._index_filename(), encoding='utf-8',
+                      errors='surrogateescape') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if (index.get('version') != self._INDEX_VERSION or
+                index.get('size') != st.st_size or
+                index.get('mtime_ns') != st.st_mtime_ns):
+            return False
+
+        self._global_pax = [tuple(record) for record in index['global_pax']]
+        for name, header_offset, data_offset, size, file_type, mtime, \
+                global_pax in index['members']:
+            self._members[name] = self._Member(
+                name, header_offset, data_offset, size,
+                file_type.encode('latin-1'), mtime, global_pax)
+        return True
+
+    def _save_index(self):
+        st = os.stat(self._file.fileno())
+        index = {
+            'version': self._INDEX_VERSION,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'global_pax': self._global_pax,
+            'members': [
+                [m.name, m.header_offset, m.data_offset, m.size,
+                 m.type.decode('latin-1'), m.mtime, m.global_pax]
+                for m in self._members.values()
+            ],
+        }
+
+        # Индекс -- только ускорение, так что если его не удалось записать
+        # (например, архив лежит в каталоге только для чтения), то и ладно
+        tmp = self._index_filename() + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8',
+                      errors='surrogateescape') as f:
+                json.dump(index, f)
+            os.replace(tmp, self._index_filename())
+        except OSError:
+            pass
+
+    def _read_header(self, member):
+        if member.name in self._headers:
+            return dict(self._headers[member.name])
+        # Копия: глобальные записи из цепочки самого файла не должны
+        # попасть в общий список ещё раз
+        return self._read_header_at(
+            member.header_offset,
+            self._global_pax[:member.global_pax])[0]
+
+    def _read_data(self, member):
+        if self._data is None:
+            self._open_data()
+
+        if self._view is not None:
+            end = member.data_offset + member.size
+            if end > len(self._view):
+                raise ValueError('{}: unexpected end of archive'.format(
+                    member.name))
+            for start in range(member.data_offset, end, self._READ_BLOCK):
+                yield self._view[start:min(end, start + self._READ_BLOCK)]
+            return
+
+        # pread не трогает общую позицию в файле, так что данные разных
+        # файлов можно читать из нескольких потоков одновременно
+        offset, left = member.data_offset, member.size
+        while left > 0:
+            chunk = os.pread(self._data.fileno(),
+                             min(left, self._READ_BLOCK), offset)
+            if not chunk:
+                raise ValueError('{}: unexpected end of archive'.format(
+                    member.name))
+            offset += len(chunk)
+            left -= len(chunk)
+            yield chunk
+
+    @staticmethod
+    def _dest_path(dest, name):
+        path = os.path.normpath(name.lstrip('/'))
+        if path == '..' or path.startswith('..' + os.sep):
+            raise ValueError('{}: path is outside of destination'.format(name))
+        return os.path.join(dest, path)
+
+    @staticmethod
+    def _check_real_path(dest, path, name):
+        '''
+        Проверяет, что `path' с раскрытыми символическими ссылками (в том
+        числе созданными этой же распаковкой) лежит внутри `dest'
         '''
+        real_dest = os.path.realpath(dest)
+        real = os.path.realpath(path)
+        if real != real_dest and \
+                not real.startswith(os.path.join(real_dest, '')):
+            raise ValueError('{}: path is outside of destination'.format(name))
+
+    @classmethod
+    def _check_symlink(cls, dest, header):
+        '''
+        Символические ссылки на абсолютные пути и наружу из `dest' не
+        создаём: через них следующие файлы архива записались бы куда угодно
+        '''
+        target = header['linkname']
+        if os.path.isabs(target):
+            raise ValueError('{}: absolute symlink target {}'.format(
+                header['name'], target))
+        cls._dest_path(dest, os.path.join(os.path.dirname(header['name']),
+                                          target))
+
+    @classmethod
+    def _prepare_path(cls, path, dest, name):
+        parent = os.path.dirname(path)
+        cls._check_real_path(dest, parent, name)
+        os.makedirs(parent, exist_ok=True)
+        if os.path.islink(path) or (os.path.lexists(path) and
+                                    not os.path.isdir(path)):
+            os.unlink(path)
+
+    @classmethod
+    def _make_directory(cls, path, dest, name):
+        cls._check_real_path(dest, path, name)
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def _write_file(path, header, chunks):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            if 'sparse' in header:
+                # Разреженный файл: задаём полный размер (получается одна
+                # большая дыра) и пишем только реальные куски данных по
+                # их смещениям, нули на диск не попадают
+                os.ftruncate(fd, header['realsize'])
+                regions = iter(header['sparse'])
+            else:
+                # Место под файл выделяем сразу, чтобы параллельная запись
+                # многих файлов не фрагментировала диск
+                if header['size'] and hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(fd, 0, header['size'])
+                    except OSError:
+                        pass
+                regions = iter([(0, header['size'])])
 
-        ### TODO
+            # pwrite отдаёт куски (в том числе memoryview отображения)
+            # прямо в системный вызов, не копируя их
+            offset = left = 0
+            for chunk in chunks:
+                while chunk:
+                    while not left:
+                        offset, left = next(regions, (None, None))
+                        if offset is None:
+                            raise ValueError(
+                                '{}: data does not match sparse map'.format(
+                                    header['name']))
+                    written = os.pwrite(fd, chunk[:left], offset)
+                    chunk = chunk[written:]
+                    offset += written
+                    left -= written
+        finally:
+            os.close(fd)
 
-    def extract(self, dest=os.getcwd()):
+    @classmethod
+    def _extract_member(cls, header, chunks, path, dest):
+        '''
+        Создаёт файл `path' по заголовку `header', беря данные обычных
+        файлов из итератора `chunks'. Возвращает истину, если после этого
+        надо выставить права и время изменения
+        '''
+        if header['type'] == b'5':
+            cls._make_directory(path, dest, header['name'])
+            return True
+
+        if header['type'] == b'2':
+            cls._check_symlink(dest, header)
+        cls._prepare_path(path, dest, header['name'])
+
+        if header['type'] in cls._REGULAR_TYPES:
+            cls._write_file(path, header, chunks)
+        elif header['type'] == b'1':
+            target = cls._dest_path(dest, header['linkname'])
+            cls._check_real_path(dest, target, header['name'])
+            os.link(target, path)
+        elif header['type'] == b'2':
+            os.symlink(header['linkname'], path)
+            return False
+        elif header['type'] == b'6':
+            os.mkfifo(path)
+        else:
+            return False
+
+        return True
+
+    @staticmethod
+    def _apply_attrs(header, path):
+        os.chmod(path, header['mode'] & 0o7777)
+        os.utime(path, (header['mtime'], header['mtime']))
+
+    def extract(self, dest=os.getcwd(), members=None, workers=None,
+                include=None, exclude=None):
         '''
         Распаковывает данный tar-архив в каталог `dest'
+
+        Если задан список имён `members', то распаковываются только эти
+        файлы; остальные данные архива при этом не читаются. Списки
+        шаблонов `include' и `exclude' дополнительно отбирают файлы так же,
+        как match_name()
+
+        Если `workers' больше единицы, то сначала создаются все каталоги,
+        затем обычные файлы записываются параллельно в `workers' потоков,
+        и в конце по порядку архива создаются ссылки и выставляются права
+        и время изменения. Каталоги и файлы на месте или внутри ссылок из
+        архива создаются в этом же последнем проходе, так что результат
+        не отличается от распаковки в один поток
+
+        Символические ссылки на абсолютные пути или наружу из `dest', как
+        и файлы, путь к которым через ссылки уходит из `dest', вызывают
+        ValueError
+        '''
+        if members is None:
+            members = self._members
+
+        entries = []
+        for name in members:
+            if name not in self._members:
+                raise ValueError(name)
+            if not match_name(name, include, exclude):
+                continue
+            member = self._members[name]
+            entries.append(
+                (member, self._read_header(member),
+                 self._dest_path(dest, name)))
+
+        created = set()
+        if workers is not None and workers > 1:
+            created = self._write_files_parallel(entries, dest, workers)
+
+        directories = []
+        for i, (member, header, path) in enumerate(entries):
+            if i not in created and not self._extract_member(
+                    header, self._read_data(member), path, dest):
+                continue
+
+            # Права и время каталогов выставляем в самом конце, иначе
+            # их испортит (или запретит) создание файлов внутри
+            if member.type == b'5':
+                directories.append((header, path))
+            else:
+                self._apply_attrs(header, path)
+
+        for header, path in reversed(directories):
+            self._apply_attrs(header, path)
+
+    def _write_files_parallel(self, entries, dest, workers):
+        '''
+        Создаёт каталоги и параллельно записывает обычные файлы из
+        `entries'. Возвращает множество номеров созданных элементов
+        '''
+        def parallel(member):
+            return member.type == b'5' or member.type in self._REGULAR_TYPES
+
+        # Ссылки создаются только по порядку, поэтому всё, что лежит на их
+        # месте или внутри них, тоже оставляем на последовательный проход
+        links = {path for member, _, path in entries if not parallel(member)}
+
+        def under_link(path):
+            while path not in links:
+                parent = os.path.dirname(path)
+                if parent == path:
+                    return False
+                path = parent
+            return True
+
+        created, files = set(), []
+        for i, (member, header, path) in enumerate(entries):
+            if not parallel(member) or under_link(path):
+                continue
+            if member.type == b'5':
+                self._make_directory(path, dest, header['name'])
+            else:
+                self._prepare_path(path, dest, header['name'])
+                files.append((member, header, path))
+            created.add(i)
+
+        with ThreadPoolExecutor(workers) as pool:
+            for future in [pool.submit(self._write_file, path, header,
+                                       self._read_data(member))
+                           for member, header, path in files]:
+                future.result()
+        return created
+
+    @staticmethod
+    def _read_exact(stream, size):
+        # Из канала read() может вернуть меньше, чем просили
+        parts = []
+        while size > 0:
+            part = stream.read(size)
+            if not part:
+                break
+            parts.append(part)
+            size -= len(part)
+        return b''.join(parts)
+
+    @classmethod
+    def _stream_data(cls, stream, left):
+        # В left[0] остаётся число непрочитанных байт данных файла
+        while left[0] > 0:
+            chunk = cls._read_exact(stream, min(left[0], cls._READ_BLOCK))
+            if not chunk:
+                raise ValueError('unexpected end of archive')
+            left[0] -= len(chunk)
+            yield chunk
+
+    @classmethod
+    def _skip(cls, stream, size):
+        if size and stream.seekable():
+            stream.seek(size, io.SEEK_CUR)
+            return
+
+        while size > 0:
+            chunk = stream.read(min(size, cls._READ_BLOCK))
+            if not chunk:
+                raise ValueError('unexpected end of archive')
+            size -= len(chunk)
+
+    @classmethod
+    def iter_stream(cls, stream):
+        '''
+        Читает tar-архив из потока `stream' (канала, sys.stdin.buffer и
+        т.п.) за один проход, без seek. Возвращает итератор пар (заголовок,
+        итератор кусков данных файла). В памяти одновременно держится не
+        больше одного куска; если данные файла не дочитаны до перехода к
+        следующему, они пропускаются (через seek, если поток это умеет)
+
+        Сжатый gzip, bzip2 или xz поток распаковывается на лету
+        '''
+        if not hasattr(stream, 'peek'):
+            stream = io.BufferedReader(stream)
+        compression = cls._sniff(stream.peek(cls._MAGIC_SIZE))
+        if compression is not None:
+            stream = cls._COMPRESSIONS[compression][1].open(stream)
+
+        global_pax = []
+        while True:
+            header = cls._read_header_chain(
+                lambda size: cls._read_exact(stream, size), global_pax)
+            if header is None:
+                return
+
+            left = [header['size']]
+            chunks = cls._stream_data(stream, left)
+            yield header, chunks
+
+            chunks.close()
+            cls._skip(stream, left[0] + cls._padded(header['size']) -
+                      header['size'])
+
+    @classmethod
+    def extract_stream(cls, stream, dest=os.getcwd(), members=None,
+                       include=None, exclude=None):
+        '''
+        Распаковывает tar-архив из потока `stream' в каталог `dest' по мере
+        чтения, за один проход. Если задан список имён `members' или
+        шаблоны `include' и `exclude' (см. match_name()), то распаковываются
+        только подходящие файлы, а данные остальных пропускаются.
+        Возвращает список заголовков всех файлов архива
         '''
+        if members is not None:
+            members = set(members)
+
+        headers = []
+        directories = []
+        for header, chunks in cls.iter_stream(stream):
+            headers.append(header)
+            if members is not None and header['name'] not in members:
+                continue
+            if not match_name(header['name'], include, exclude):
+                continue
 
-        ### TODO
+            path = cls._dest_path(dest, header['name'])
+            if not cls._extract_member(header, chunks, path, dest):
+                continue
 
-    def files(self):
+            if header['type'] == b'5':
+                directories.append((header, path))
+            else:
+                cls._apply_attrs(header, path)
+
+        for header, path in reversed(directories):
+            cls._apply_attrs(header, path)
+
+        return headers
+
+    @classmethod
+    def _checksum_ok(cls, block):
         '''
-        Возвращает итератор имён файлов (с путями) в архиве
+        Проверяет контрольную сумму блока заголовка: сумму всех байт, где
+        поле самой суммы считается заполненным пробелами. sum() по
+        memoryview считает весь блок разом в C, без копирования из
+        отображения. Старые tar-ы считали сумму по байтам со знаком, её
+        тоже принимаем
         '''
+        start = cls._CHECKSUM_OFFSET
+        end = start + cls._CHECKSUM_SIZE
+        try:
+            stored = cls._parse_number(bytes(block[start:end]))
+        except ValueError:
+            return False
+
+        unsigned = (sum(block) - sum(block[start:end]) +
+                    cls._CHECKSUM_SIZE * ord(' '))
+        if stored == unsigned:
+            return True
+
+        high = (len(bytes(block).translate(None, cls._LOW_BYTES)) -
+                len(bytes(block[start:end]).translate(None, cls._LOW_BYTES)))
+        return stored == unsigned - 256 * high
 
-        ### TODO
+    def verify(self, hash_name=None):
+        '''
+        Проверяет целостность архива, заново проходя по всем заголовкам:
+        контрольные суммы каждого блока заголовка (включая служебные
+        записи), разбираемость заголовков, наличие данных файлов и
+        нулевого блока конца архива. Если
+        задано имя алгоритма `hash_name' (см. hashlib), то считает ещё и
+        хэши содержимого обычных файлов
+
+        Возвращает список троек (имя файла, список найденных проблем, хэш
+        содержимого или None)
+        '''
+        if self._data is None:
+            self._open_data()
+        if self._view is not None:
+            archive_size = len(self._view)
+        else:
+            archive_size = os.fstat(self._data.fileno()).st_size
+
+        report = []
+        offset = 0
+        global_pax = []
+        while True:
+            # Конец архива -- нулевой блок. Просто конец файла (или
+            # неполный блок) значит, что архив обрезан
+            block = self._read_at(offset, self._BLOCK_SIZE)
+            if len(block) < self._BLOCK_SIZE:
+                report.append(('<offset {}>'.format(offset),
+                               ['truncated header' if len(block) else
+                                'missing end-of-archive marker'], None))
+                break
+
+            blocks = []
+            try:
+                header, data_offset = self._read_header_at(
+                    offset, global_pax, blocks)
+            except (ValueError, IndexError, struct.error) as e:
+                report.append(('<offset {}>'.format(offset),
+                               ['unreadable header: {}'.format(e)],
+                               None))
+                break
+            if header is None:
+                break
+
+            problems = ['bad header checksum'
+                        for block in blocks
+                        if not self._checksum_ok(block)]
+            digest = None
+            truncated = data_offset + header['size'] > archive_size
+            if truncated:
+                problems.append('truncated data')
+            elif hash_name is not None and \
+                    header['type'] in self._REGULAR_TYPES:
+                h = hashlib.new(hash_name)
+                for chunk in self._read_data(self._Member(
+                        header['name'], offset, data_offset,
+                        header['size'], header['type'], header['mtime'],
+                        len(global_pax))):
+                    h.update(chunk)
+                digest = h.hexdigest()
+
+            report.append((header['name'], problems, digest))
+            if truncated:
+                break
+            offset = data_offset + self._padded(header['size'])
+
+        return report
+
+    def files(self, include=None, exclude=None):
+        '''
+        Возвращает итератор имён файлов (с путями) в архиве, отобранных
+        шаблонами `include' и `exclude' (см. match_name())
+        '''
+        if include is None and exclude is None:
+            return iter(self._members)
+        return (name for name in self._members
+                if match_name(name, include, exclude))
 
     def file_stat(self, filename):
         '''
@@ -72,25 +1088,89 @@ class TarParser:
             ('Group name', 'victor')
         ]
         '''
-        if filename not in self.files:
+        if filename not in self._members:
             raise ValueError(filename)
 
-        info = [('Filename', filename)]
+        return self._header_info(
+            filename, self._read_header(self._members[filename]))
 
-        ### TODO
+    @classmethod
+    def _header_info(cls, filename, header):
+        info = [('Filename', filename)]
+        info.extend([
+            ('Type', cls._FILE_TYPES.get(header['type'], 'Unknown')),
+            ('Mode', '{:07o}'.format(header['mode'])),
+            ('UID', str(header['uid'])),
+            ('GID', str(header['gid'])),
+            ('Size', str(header.get('realsize', header['size']))),
+            ('Modification time', time.strftime(
+                '%d %b %Y %H:%M:%S', time.localtime(header['mtime']))),
+            ('Checksum', str(header['checksum'])),
+        ])
+        if header['linkname']:
+            info.append(('Link name', header['linkname']))
+        if 'uname' in header:
+            info.append(('User name', header['uname']))
+            info.append(('Group name', header['gname']))
 
         return info
 
 
+def match_name(name, include=None, exclude=None):
+    '''
+    Проверяет, что имя `name' подходит хотя бы под один шаблон из
+    `include' (если он задан) и ни под один из `exclude'. Шаблоны -- это
+    строки в стиле shell (`*.txt', `dir/*') или скомпилированные
+    регулярные выражения, которые ищутся в имени через search()
+    '''
+    def matches(pattern):
+        if isinstance(pattern, str):
+            return fnmatch.fnmatchcase(name, pattern)
+        return pattern.search(name) is not None
+
+    if include is not None and not any(map(matches, include)):
+        return False
+    return exclude is None or not any(map(matches, exclude))
+
+
 def print_file_info(stat, f=sys.stdout):
     max_width = max(map(lambda s: len(s[0]), stat))
     for field in stat:
         print("{{:>{}}} : {{}}".format(max_width).format(*field), file=f)
 
 
+def main_stream(args):
+    try:
+        if args.extract:
+            headers = TarParser.extract_stream(
+                sys.stdin.buffer, os.getcwd(), members=args.members or None,
+                include=args.include, exclude=args.exclude)
+        else:
+            headers = [header for header, _ in
+                       TarParser.iter_stream(sys.stdin.buffer)]
+
+        headers = {header['name']: header for header in headers}
+        for fn in args.members:
+            if fn not in headers:
+                raise ValueError(fn)
+        names = sorted(fn for fn in args.members or headers
+                       if match_name(fn, args.include, args.exclude))
+
+        if args.info:
+            for fn in names:
+                print_file_info(TarParser._header_info(fn, headers[fn]))
+                print()
+        elif args.ls:
+            for fn in names:
+                print(fn)
+    except Exception as e:
+        sys.exit(e)
+
+
 def main():
     parser = argparse.ArgumentParser(
-        usage='{} [OPTIONS] FILE'.format(os.path.basename(sys.argv[0])),
+        usage='{} [OPTIONS] FILE [MEMBER...]'.format(
+            os.path.basename(sys.argv[0])),
         description='Tar extractor')
     parser.add_argument('-l', '--list', action='store_true', dest='ls',
                         help='list the contents of an archive')
@@ -98,26 +1178,85 @@ def main():
                         help='extract files from an archive')
     parser.add_argument('-i', '--info', action='store_true', dest='info',
                         help='get information about files in an archive')
+    parser.add_argument('--verify', action='store_true', dest='verify',
+                        help='check header checksums and data of all files '
+                             'in an archive')
+    parser.add_argument('--hash', metavar='ALGORITHM', dest='hash',
+                        help='with --verify, also print ALGORITHM (e.g. '
+                             'sha256) digests of file contents')
+    parser.add_argument('--index', action='store_true', dest='index',
+                        help='use (and create if needed) FILE.idx index '
+                             'instead of scanning the whole archive')
+    parser.add_argument('--mmap', action='store_true', dest='mmap',
+                        help='memory-map an archive instead of reading it')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        metavar='N', dest='workers',
+                        help='decompress an archive in N processes and '
+                             'write extracted files in N threads')
+    parser.add_argument('--include', action='append', metavar='PATTERN',
+                        dest='include',
+                        help='process only files matching PATTERN '
+                             '(may be given several times)')
+    parser.add_argument('--exclude', action='append', metavar='PATTERN',
+                        dest='exclude',
+                        help='skip files matching PATTERN '
+                             '(may be given several times)')
+    parser.add_argument('-E', '--regex', action='store_true', dest='regex',
+                        help='treat PATTERNs as regular expressions '
+                             'instead of shell globs')
     parser.add_argument('fn', metavar='FILE',
-                        help='name of an archive')
+                        help="name of an archive ('-' to read it from "
+                             "stdin in a single pass)")
+    parser.add_argument('members', metavar='MEMBER', nargs='*',
+                        help='process only these files from an archive')
 
     args = parser.parse_args()
-    if not (args.ls or args.extract or args.info):
+    if not (args.ls or args.extract or args.info or args.verify):
         sys.exit("Error: action must be specified")
+    if args.verify and args.fn == '-':
+        sys.exit("Error: --verify needs a seekable archive")
+
+    if args.regex:
+        try:
+            args.include = args.include and list(
+                map(re.compile, args.include))
+            args.exclude = args.exclude and list(
+                map(re.compile, args.exclude))
+        except re.error as e:
+            sys.exit("Error: bad pattern: {}".format(e))
+
+    if args.fn == '-':
+        return main_stream(args)
 
     try:
-        tar = TarParser(args.fn)
+        tar = TarParser(args.fn, use_index=args.index, use_mmap=args.mmap,
+                        workers=args.workers)
+        names = sorted(fn for fn in args.members or tar.files()
+                       if match_name(fn, args.include, args.exclude))
 
         if args.info:
-            for fn in sorted(tar.files()):
+            for fn in names:
                 print_file_info(tar.file_stat(fn))
                 print()
         elif args.ls:
-            for fn in sorted(tar.files()):
+            for fn in names:
                 print(fn)
 
+        if args.verify:
+            corrupt = False
+            for fn, problems, digest in tar.verify(args.hash):
+                if digest is not None:
+                    print('{}  {}'.format(digest, fn))
+                for problem in problems:
+                    print('{}: {}'.format(fn, problem))
+                    corrupt = True
+            if corrupt:
+                sys.exit("Error: archive is corrupt")
+
         if args.extract:
-            tar.extract()
+            tar.extract(members=args.members or None,
+                        workers=args.workers, include=args.include,
+                        exclude=args.exclude)
     except Exception as e:
         sys.exit(e)
 
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Synthetic access logs and a benchmark of hw4 log statistics.
+
+    bench_hw4.py --lines 1000000 -o report.json
+    bench_hw4.py --lines 1000000 --baseline report.json
+    bench_hw4.py --lines 100000 --days 7 --generate access.log
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+
+import hw4
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from benchtools import find_regressions, peak_rss_kb
+
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+STATUSES = ((200, 90), (302, 4), (304, 3), (404, 2), (500, 1))
+START = datetime(2013, 2, 17, tzinfo=timezone(timedelta(hours=6)))
+GENERATE_CHUNK = 64 * 1024
+
+
+def client(i):
+    return '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255)
+
+
+def page(i):
+    if i % 3:
+        return '/section{}/page{}'.format(i % 17, i)
+    return '/api/call?id={}&admin=0'.format(i)
+
+
+def agent(i):
+    return ('Mozilla/5.0 (Windows NT 6.1; synthetic {}) Gecko/20100101 '
+            'Firefox/{}.0'.format(i, 10 + i % 50))
+
+
+def _zipf_weights(n, skew):
+    return list(accumulate(1 / (rank + 1) ** skew for rank in range(n)))
+
+
+def _timestamp(dt):
+    offset = dt.utcoffset() // timedelta(minutes=1)
+    return '{:02}/{}/{}:{:02}:{:02}:{:02} {}{:02}{:02}'.format(
+        dt.day, MONTHS[dt.month - 1], dt.year, dt.hour, dt.minute,
+        dt.second, '-' if offset < 0 else '+', abs(offset) // 60,
+        abs(offset) % 60)
+
+
+def generate_log(f, lines=100000, clients=1000, pages=1000, agents=100,
+                 skew=1.1, days=1, seed=0):
+    """
+    Writes `lines` log lines to text file `f`, deterministically by
+    `seed`. Clients, pages and user agents are drawn from `clients`,
+    `pages` and `agents` distinct values with Zipf distribution of exponent
+    `skew` (0 is uniform). Lines are spread over `days` days in time order
+    with a few seconds of jitter, as in real logs. Every page has its own
+    typical processing time
+    """
+    rnd = random.Random(seed)
+    client_weights = _zipf_weights(clients, skew)
+    page_weights = _zipf_weights(pages, skew)
+    agent_weights = _zipf_weights(agents, skew)
+    page_times = [int(rnd.lognormvariate(10, 1.5)) for _ in range(pages)]
+    statuses, status_weights = zip(*STATUSES)
+    seconds = days * 86400 / lines
+
+    timestamps = {}
+    written = 0
+    while written < lines:
+        n = min(GENERATE_CHUNK, lines - written)
+        chunk = zip(
+            rnd.choices(range(clients), cum_weights=client_weights, k=n),
+            rnd.choices(range(pages), cum_weights=page_weights, k=n),
+            rnd.choices(range(agents), cum_weights=agent_weights, k=n),
+            rnd.choices(statuses, status_weights, k=n))
+        out = []
+        for i, (c, p, a, status) in enumerate(chunk, written):
+            second = max(0, int(i * seconds) - rnd.randrange(3))
+            if second not in timestamps:
+                if len(timestamps) > 16:
+                    timestamps.clear()
+                timestamps[second] = _timestamp(
+                    START + timedelta(seconds=second))
+            out.append(
+                '{} - - [{}] "GET {} HTTP/1.1" {} {} "http://example.com{}" '
+                '"{}" {}\n'.format(
+                    client(c), timestamps[second], page(p), status,
+                    rnd.randrange(100, 50000),
+                    page(rnd.randrange(pages)), agent(a),
+                    int(page_times[p] * rnd.lognormvariate(0, 0.5))))
+        f.writelines(out)
+        written += n
+
+
+def _consume(iterable):
+    deque(iterable, maxlen=0)
+
+
+def bench_parse_file(log, workers):
+    with open(log) as f:
+        _consume(hw4.parse_file(f))
+
+
+def bench_parse_file_fast(log, workers):
+    with open(log) as f:
+        _consume(hw4.parse_file(f, hw4.FAST_PARSERS))
+
+
+def bench_harvest_stats(log, workers):
+    with open(log) as f:
+        hw4.harvest_stats(hw4.parse_file(f))
+
+
+def bench_harvest_stats_fast(log, workers):
+    with open(log) as f:
+        hw4.harvest_stats(hw4.parse_file(f, hw4.FAST_PARSERS))
+
+
+def bench_harvest_stats_batch(log, workers):
+    with open(log) as f:
+        hw4.harvest_stats(hw4.iter_batches(f), batches=True)
+
+
+def bench_harvest_stats_workers(log, workers):
+    hw4.harvest_file_stats(log, workers=workers, parsers=hw4.FAST_PARSERS)
+
+
+BENCHMARKS = {
+    'parse_file': bench_parse_file,
+    'parse_file_fast': bench_parse_file_fast,
+    'harvest_stats': bench_harvest_stats,
+    'harvest_stats_fast': bench_harvest_stats_fast,
+    'harvest_stats_batch': bench_harvest_stats_batch,
+    'harvest_stats_workers': bench_harvest_stats_workers,
+}
+
+
+def run_benchmark(name, log, workers):
+    """
+    Runs benchmark `name` over `log` in this process. Returns dict with
+    time (seconds) and peak memory (KiB); peak memory of workers is not
+    included
+    """
+    start = time.perf_counter()
+    BENCHMARKS[name](log, workers)
+    return {'seconds': time.perf_counter() - start,
+            'max_rss_kb': peak_rss_kb()}
+
+
+def measure(name, log, workers):
+    """
+    Runs benchmark `name` in a child process, so that its peak memory is
+    not affected by other benchmarks
+    """
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run', name, log,
+         str(workers)], stdout=subprocess.PIPE)
+    if process.returncode:
+        raise RuntimeError('{} failed'.format(name))
+    return json.loads(process.stdout)
+
+
+def run_benchmarks(corpus, benchmarks=tuple(BENCHMARKS), repeat=3,
+                   workers=None, workdir=None):
+    """
+    Generates a log with generate_log parameters `corpus` and runs
+    `benchmarks` over it. Time is the best of `repeat` runs, memory is the
+    peak over them
+    """
+    # One worker would just read the file in this process
+    workers = workers or max(2, os.cpu_count())
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        log = os.path.join(tmp, 'access.log')
+        with open(log, 'w') as f:
+            generate_log(f, **corpus)
+        size = os.path.getsize(log)
+        report = {
+            'python': sys.version.split()[0],
+            'numpy': hw4.np is not None,
+            'workers': workers,
+            'corpus': corpus,
+            'bytes': size,
+            'results': [],
+        }
+
+        for name in benchmarks:
+            runs = [measure(name, log, workers) for _ in range(repeat)]
+            seconds = min(run['seconds'] for run in runs)
+            report['results'].append({
+                'benchmark': name,
+                'seconds': seconds,
+                'lines_per_second': round(corpus['lines'] / seconds),
+                'mb_per_second': round(size / seconds / 2**20, 2),
+                'max_rss_kb': max(run['max_rss_kb'] for run in runs),
+            })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Synthetic access log generator and hw4 benchmark')
+    parser.add_argument('--lines', type=int, default=200000,
+                        help='number of log lines (default 200000)')
+    parser.add_argument('--clients', type=int, default=1000,
+                        help='number of distinct client IPs (default 1000)')
+    parser.add_argument('--pages', type=int, default=1000,
+                        help='number of distinct URLs (default 1000)')
+    parser.add_argument('--agents', type=int, default=100,
+                        help='number of distinct user agents (default 100)')
+    parser.add_argument('--skew', type=float, default=1.1,
+                        help='Zipf exponent of clients, URLs and user '
+                             'agents, 0 for uniform (default 1.1)')
+    parser.add_argument('--days', type=int, default=1,
+                        help='number of days spanned by the log (default 1)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default 0)')
+    parser.add_argument('--generate', metavar='FILE',
+                        help='only write the synthetic log to FILE')
+    parser.add_argument('--benchmark', action='append',
+                        choices=list(BENCHMARKS), metavar='NAME',
+                        help='run only benchmark NAME (may be repeated): '
+                             '%(choices)s')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs for every benchmark')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='processes for harvest_stats_workers '
+                             '(default: number of CPUs, at least 2)')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write JSON report to FILE instead of stdout')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with a previous JSON report and exit '
+                             'with an error on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against baseline '
+                             '(default 0.2 = 20%%)')
+    parser.add_argument('--workdir', metavar='DIR',
+                        help='directory for the temporary log')
+    parser.add_argument('--run', nargs=3, metavar=('NAME', 'LOG', 'WORKERS'),
+                        help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.run:
+        name, log, workers = args.run
+        print(json.dumps(run_benchmark(name, log, int(workers))))
+        return
+
+    corpus = {'lines': args.lines, 'clients': args.clients,
+              'pages': args.pages, 'agents': args.agents, 'skew': args.skew,
+              'days': args.days, 'seed': args.seed}
+    if args.generate:
+        with open(args.generate, 'w') as f:
+            generate_log(f, **corpus)
+        return
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['corpus'] != corpus:
+            sys.exit('Error: baseline is made for another corpus: {}'.format(
+                baseline['corpus']))
+
+    report = run_benchmarks(corpus, args.benchmark or tuple(BENCHMARKS),
+                            args.repeat, args.workers, args.workdir)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if baseline is not None:
+        regressions = find_regressions(report, baseline, args.tolerance)
+        for name, old, new in regressions:
+            print('Regression: {}: {:.3f}s -> {:.3f}s'.format(name, old, new),
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
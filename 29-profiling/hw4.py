@@ -1,10 +1,34 @@
 #!/usr/bin/env python3
 import abc
+import argparse
+import bz2
+import gzip
+import lzma
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
 import re
+import struct
 import sys
-from collections import defaultdict, Counter, OrderedDict
-from datetime import datetime
-from operator import itemgetter
+import threading
+import time
+import zlib
+from array import array
+from collections import defaultdict, namedtuple, Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache, partial
+from itertools import islice, repeat
+from operator import contains, eq, ge, gt, itemgetter, le, lt, ne
+
+from sketches import CountMinSketch, DDSketch, HyperLogLog, MisraGries
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 LOG_RE = re.compile(r'''
@@ -40,9 +64,48 @@ def parse_ints(parsed_dict):
     return parsed_dict
 
 
+TIMESTAMP_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
+
+MONTHS = {month: number for number, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+# Fixed-width form of TIMESTAMP_FORMAT that parse_timestamp slices
+FIXED_TIMESTAMP_RE = re.compile(
+    r'[0-9]{2}/[A-Z][a-z]{2}/[0-9]{4}:[0-9]{2}:[0-9]{2}:[0-9]{2} [+-][0-9]{4}')
+
+
+@lru_cache(maxsize=None)
+def parse_timezone(offset):
+    sign = -1 if offset[0] == '-' else 1
+    return timezone(sign * timedelta(hours=int(offset[1:3]),
+                                     minutes=int(offset[3:5])))
+
+
+@lru_cache(maxsize=1024)
+def parse_timestamp(timestamp):
+    """
+    Fast equivalent of datetime.strptime(timestamp, TIMESTAMP_FORMAT).
+
+    Log lines come in time order, so consecutive lines mostly share the
+    same second: those are served from the cache. Other timestamps of the
+    usual fixed-width form '08/Jul/2012:06:27:38 +0600' (all digits,
+    separators and the offset sign checked) are sliced by positions,
+    anything else falls back to strptime
+    """
+    try:
+        if not FIXED_TIMESTAMP_RE.fullmatch(timestamp):
+            raise ValueError(timestamp)
+        return datetime(
+            int(timestamp[7:11]), MONTHS[timestamp[3:6]], int(timestamp[0:2]),
+            int(timestamp[12:14]), int(timestamp[15:17]),
+            int(timestamp[18:20]), tzinfo=parse_timezone(timestamp[21:]))
+    except (KeyError, ValueError):
+        return datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+
+
 def parse_datetime(parsed_dict):
-    parsed_dict['DATETIME'] = datetime.strptime(
-        parsed_dict['TIMESTAMP'], '%d/%b/%Y:%H:%M:%S %z')
+    parsed_dict['DATETIME'] = parse_timestamp(parsed_dict['TIMESTAMP'])
     return parsed_dict
 
 
@@ -59,7 +122,166 @@ def parse_request(parsed_dict):
 PARSERS = (parse_to_dict, parse_ints, parse_datetime, parse_request)
 
 
-def parse_file(lines, parsers=PARSERS):
+# LOG_RE and REQUEST_RE fused into a single pattern: one match per line
+# instead of two matches, a groupdict() and a dict update
+FAST_LOG_RE = re.compile(r'''
+  ((?:\d{1,3}\.){3}\d{1,3})
+  \s+-\s+-\s+
+  \[([^\]]*)\]
+  \s+
+  "(([A-Z]+)\s([^ "]+)\sHTTP/[^"]*)"
+  \s+
+  (\d+)
+  \s+
+  (\d+)
+  \s+
+  "([^"]+)"
+  \s+
+  "([^"]+)"
+  \s+
+  (\d+)
+''', re.VERBOSE)
+
+
+class LogRecord(namedtuple('LogRecord', (
+        'IP', 'TIMESTAMP', 'REQUEST', 'REQUEST_METHOD', 'REQUEST_URL',
+        'STATUS', 'SIZE', 'REFERRER', 'USER_AGENT', 'PROCESS_TIME',
+        'DATETIME'))):
+    """
+    Compact parsed log line. Fields are available as record['IP'] just like
+    in dicts built by PARSERS, so statistics work with both; integer
+    indexes and slices work as for any tuple
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key, _getitem=tuple.__getitem__):
+        try:
+            key = LOG_RECORD_INDEXES[key]
+        except (KeyError, TypeError):
+            if isinstance(key, str):
+                raise KeyError(key) from None
+        return _getitem(self, key)
+
+
+LOG_RECORD_INDEXES = {field: i for i, field in enumerate(LogRecord._fields)}
+
+
+def parse_record(line):
+    (ip, timestamp, request, method, url, status, size, referrer, user_agent,
+     process_time) = FAST_LOG_RE.match(line).groups()
+    return LogRecord(
+        ip, timestamp, request, method, url, int(status), int(size),
+        referrer, user_agent, int(process_time),
+        parse_timestamp(timestamp))
+
+
+FAST_PARSERS = (parse_record,)
+
+
+class Profile:
+    """
+    Cumulative timings and counters of a run (see --profile): seconds spent
+    reading lines and in every parser stage, seconds spent by every
+    statistics builder, numbers of lines, parsed records and lines dropped
+    by every stage with every exception type
+    """
+    def __init__(self):
+        self.lines = 0
+        self.records = 0
+        self.dropped = Counter()
+        self.stage_times = defaultdict(float)
+        self.handle_times = defaultdict(float)
+        self.elapsed = 0.0
+
+    def merge(self, other):
+        self.lines += other.lines
+        self.records += other.records
+        self.dropped.update(other.dropped)
+        for times, other_times in ((self.stage_times, other.stage_times),
+                                   (self.handle_times, other.handle_times)):
+            for name, seconds in other_times.items():
+                times[name] += seconds
+
+    def report(self):
+        """
+        Returns dict for prepare_output. With workers stage and statistics
+        times are summed over all processes, `seconds` is wall clock time
+        """
+        dropped = defaultdict(dict)
+        for (stage, error), count in self.dropped.items():
+            dropped[stage][error] = count
+        return {
+            'lines': self.lines,
+            'records': self.records,
+            'dropped': dict(dropped) or 0,
+            'seconds': round(self.elapsed, 3),
+            'lines per second': (round(self.lines / self.elapsed)
+                                 if self.elapsed else None),
+            'stages': {name: round(seconds, 3)
+                       for name, seconds in self.stage_times.items()},
+            'statistics': {name: round(seconds, 3)
+                           for name, seconds in self.handle_times.items()},
+        }
+
+
+def _profiled_parse_file(lines, parsers, profile):
+    clock = time.perf_counter
+    stage_times, dropped = profile.stage_times, profile.dropped
+    stages = [(getattr(parser, '__name__', repr(parser)), parser)
+              for parser in parsers]
+    lines = iter(lines)
+    while True:
+        start = clock()
+        line = next(lines, None)
+        stage_times['read'] += clock() - start
+        if line is None:
+            return
+        profile.lines += 1
+
+        parsed = line
+        for name, parser in stages:
+            start = clock()
+            try:
+                parsed = parser(parsed)
+            except Exception as e:
+                stage_times[name] += clock() - start
+                dropped[name, type(e).__name__] += 1
+                break
+            stage_times[name] += clock() - start
+        else:
+            profile.records += 1
+            yield parsed
+
+
+def filter_lines(lines, line_filter, profile=None):
+    """
+    Yields `lines` for which `line_filter` returns true. Lines it drops
+    are counted in Profile `profile` if it is given, as dropped by stage
+    'prefilter' with reason 'no match' (the time goes to stage 'read' of
+    the parser reading the filtered lines)
+    """
+    if profile is None:
+        yield from filter(line_filter, lines)
+        return
+    dropped = profile.dropped
+    for line in lines:
+        if line_filter(line):
+            yield line
+        else:
+            profile.lines += 1
+            dropped['prefilter', 'no match'] += 1
+
+
+def parse_file(lines, parsers=PARSERS, profile=None):
+    """
+    Yields `lines` parsed with `parsers` one after another, silently
+    dropping lines any of them fails on. Updates Profile `profile` if it is
+    given (that is several times slower)
+    """
+    if profile is not None:
+        yield from _profiled_parse_file(lines, parsers, profile)
+        return
+
     for line in lines:
         try:
             parsed = line
@@ -70,6 +292,286 @@ def parse_file(lines, parsers=PARSERS):
             pass
 
 
+BATCH_SIZE = 64 * 1024
+
+
+class Interner(dict):
+    """
+    Maps every distinct key to a small int id in order of first appearance
+    """
+    def __missing__(self, key):
+        value = self[key] = len(self)
+        return value
+
+
+class Symbols(Interner):
+    """
+    Interner that also resolves ids back: `strings[id]`
+    """
+    def __init__(self):
+        super().__init__()
+        self.strings = []
+
+    def __missing__(self, key):
+        value = self[key] = len(self.strings)
+        self.strings.append(key)
+        return value
+
+    def ids(self, strings):
+        return [self[string] for string in strings]
+
+
+class SymbolTable(dict):
+    """
+    Symbols by field name ('IP', 'REQUEST_URL', ...) shared by all
+    statistics of a run: every distinct string is stored once, statistics
+    keep only int ids and resolve them back in result()
+    """
+    def __missing__(self, field):
+        value = self[field] = Symbols()
+        return value
+
+
+def grow(counts, size):
+    counts.extend(repeat(0, size - len(counts)))
+
+
+def add_counts(counts, symbols, items):
+    """
+    Adds numbers from (string, number) pairs `items` to array `counts`
+    indexed by ids from `symbols`
+    """
+    for string, number in items:
+        i = symbols[string]
+        if i >= len(counts):
+            grow(counts, len(symbols))
+        counts[i] += number
+
+
+class LogBatch:
+    """
+    Up to BATCH_SIZE parsed log lines stored by columns.
+
+    `columns['IP']`, `columns['REQUEST_METHOD']`, `columns['REQUEST_URL']`,
+    `columns['REFERRER']`, `columns['USER_AGENT']` and `columns['DATE']`
+    hold ids into lists of distinct values `values[field]` (in order of
+    first appearance), `columns['STATUS']`,
+    `columns['SIZE']`, `columns['PROCESS_TIME']` and `columns['TIME']`
+    (POSIX timestamp in seconds) hold the numbers. Columns are NumPy
+    arrays if NumPy is installed and lists otherwise. `tzinfo` is the time
+    zone of the first line
+    """
+    STRING_FIELDS = ('IP', 'REQUEST_METHOD', 'REQUEST_URL', 'REFERRER',
+                     'USER_AGENT', 'DATE')
+    NUMERIC_FIELDS = ('STATUS', 'SIZE', 'PROCESS_TIME', 'TIME')
+
+    def __init__(self, columns, values, tzinfo=None):
+        self.columns = columns
+        self.values = values
+        self.tzinfo = tzinfo
+        self.size = len(columns['IP'])
+
+    def __len__(self):
+        return self.size
+
+    def value(self, field, index):
+        return self.values[field][self.columns[field][index]]
+
+    def counts(self, field):
+        """
+        Returns dict {value: number of lines} for a string column
+        """
+        values = self.values[field]
+        return dict(zip(values, count_ids(self.columns[field], len(values))))
+
+    def take(self, indices):
+        """
+        Returns LogBatch of lines with `indices` (in ascending order)
+        """
+        columns = {}
+        values = {}
+        for field, column in self.columns.items():
+            if np is not None:
+                column = column[np.asarray(indices, dtype=np.int64)]
+            else:
+                column = [column[i] for i in indices]
+            if field in self.values:
+                column, values[field] = compact_ids(column,
+                                                    self.values[field])
+            columns[field] = column
+        return LogBatch(columns, values, self.tzinfo)
+
+
+def compact_ids(ids, values):
+    """
+    Renumbers `ids` into `values` so that only values in use are left, in
+    order of first appearance. Returns tuple (new ids, new values)
+    """
+    if np is not None:
+        used, first, inverse = np.unique(ids, return_index=True,
+                                         return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        return rank[inverse], [values[i] for i in used[order].tolist()]
+
+    interner = Interner()
+    ids = [interner[i] for i in ids]
+    return ids, [values[i] for i in interner]
+
+
+@lru_cache(maxsize=1024)
+def parse_date_and_time(timestamp):
+    """
+    Returns tuple (date, POSIX timestamp in seconds, time zone) of a log
+    timestamp
+    """
+    dt = parse_timestamp(timestamp)
+    return dt.date(), int(dt.timestamp()), dt.tzinfo
+
+
+def parse_batch(lines):
+    """
+    Parses `lines` with FAST_LOG_RE into a LogBatch, silently dropping
+    invalid lines just like parse_file
+    """
+    interners = {field: Interner() for field in LogBatch.STRING_FIELDS}
+    ips, methods, urls, referrers, user_agents, dates = [], [], [], [], [], []
+    statuses, sizes, process_times, times = [], [], [], []
+    tzinfo = None
+    ip_ids, method_ids, url_ids, referrer_ids, user_agent_ids, date_ids = (
+        interners[field] for field in LogBatch.STRING_FIELDS)
+
+    match = FAST_LOG_RE.match
+    for line in lines:
+        m = match(line)
+        if m is None:
+            continue
+        (ip, timestamp, _, method, url, status, size, referrer, user_agent,
+         process_time) = m.groups()
+        try:
+            day, seconds, line_tzinfo = parse_date_and_time(timestamp)
+        except ValueError:
+            continue
+        if tzinfo is None:
+            tzinfo = line_tzinfo
+
+        ips.append(ip_ids[ip])
+        methods.append(method_ids[method])
+        urls.append(url_ids[url])
+        referrers.append(referrer_ids[referrer])
+        user_agents.append(user_agent_ids[user_agent])
+        dates.append(date_ids[day])
+        statuses.append(int(status))
+        sizes.append(int(size))
+        process_times.append(int(process_time))
+        times.append(seconds)
+
+    columns = dict(zip(
+        LogBatch.STRING_FIELDS + LogBatch.NUMERIC_FIELDS,
+        (ips, methods, urls, referrers, user_agents, dates, statuses, sizes,
+         process_times, times)))
+    if np is not None:
+        columns = {field: np.array(column, dtype=np.int64)
+                   for field, column in columns.items()}
+    return LogBatch(columns, {field: list(interner)
+                              for field, interner in interners.items()},
+                    tzinfo)
+
+
+def iter_batches(lines, batch_size=BATCH_SIZE, profile=None):
+    clock = time.perf_counter
+    lines = iter(lines)
+    while True:
+        start = clock()
+        chunk = list(islice(lines, batch_size))
+        if not chunk:
+            return
+        if profile is None:
+            yield parse_batch(chunk)
+            continue
+
+        parsed = clock()
+        batch = parse_batch(chunk)
+        profile.stage_times['read'] += parsed - start
+        profile.stage_times['parse_batch'] += clock() - parsed
+        profile.lines += len(chunk)
+        profile.records += batch.size
+        if len(chunk) > batch.size:
+            profile.dropped['parse_batch', 'invalid line'] += (
+                len(chunk) - batch.size)
+        yield batch
+
+
+def count_ids(ids, n):
+    """
+    Returns list of numbers of occurrences of every id from range(n)
+    """
+    if np is not None:
+        return np.bincount(ids, minlength=n).tolist()
+    counter = Counter(ids)
+    return [counter[i] for i in range(n)]
+
+
+def sum_by_ids(ids, values, n):
+    """
+    Returns list of sums of `values` grouped by ids from range(n)
+    """
+    if np is not None:
+        # bincount sums in float64: exact while sums stay below 2**53
+        return np.bincount(ids, weights=values, minlength=n).astype(
+            np.int64).tolist()
+    sums = [0] * n
+    for i, value in zip(ids, values):
+        sums[i] += value
+    return sums
+
+
+def group_by_ids(ids, values, n):
+    """
+    Returns list of lists of `values` grouped by ids from range(n)
+    """
+    if np is not None:
+        order = np.argsort(ids, kind='stable')
+        bounds = np.cumsum(np.bincount(ids, minlength=n))[:-1]
+        return [group.tolist() for group in
+                np.split(np.asarray(values)[order], bounds)]
+    groups = [[] for _ in range(n)]
+    for i, value in zip(ids, values):
+        groups[i].append(value)
+    return groups
+
+
+def count_pairs(first, second, n_second):
+    """
+    Returns dict {(first id, second id): number of occurrences}. Ids in
+    `second` must be below `n_second`, and first * n_second must fit in
+    int64
+    """
+    if np is not None:
+        keys, counts = np.unique(first * n_second + second,
+                                 return_counts=True)
+        return {divmod(key, n_second): count
+                for key, count in zip(keys.tolist(), counts.tolist())}
+    return Counter(zip(first, second))
+
+
+def last_argmax(values):
+    """
+    Returns index of the last maximal value (ties go to later lines just
+    like in handle_record)
+    """
+    if np is not None:
+        return len(values) - 1 - int(np.argmax(values[::-1]))
+    return max(reversed(range(len(values))), key=values.__getitem__)
+
+
+def last_argmin(values):
+    if np is not None:
+        return len(values) - 1 - int(np.argmin(values[::-1]))
+    return min(reversed(range(len(values))), key=values.__getitem__)
+
+
 def prepare_output(stats: dict, offset=0, indent=2) -> str:
     """
     This function provides very simple yaml-like format
@@ -91,6 +593,9 @@ def prepare_output(stats: dict, offset=0, indent=2) -> str:
 
 
 class Statistics(metaclass=abc.ABCMeta):
+    def __init__(self, symbols=None):
+        self.symbols = SymbolTable() if symbols is None else symbols
+
     @property
     def name(self):
         return type(self).__name__
@@ -103,9 +608,23 @@ class Statistics(metaclass=abc.ABCMeta):
     def result(self):
         pass
 
+    @abc.abstractmethod
+    def handle_batch(self, batch):
+        """
+        Updates statistics with all lines of LogBatch `batch` at once
+        """
+
+    @abc.abstractmethod
+    def merge(self, other):
+        """
+        Adds partial statistics `other` (built from records that follow
+        this builder's records) into this one
+        """
+
 
 class SlowestPage(Statistics):
-    def __init__(self):
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
         self.slowest_page = None
         self.slowest_page_speed = 0
 
@@ -114,12 +633,28 @@ class SlowestPage(Statistics):
             self.slowest_page_speed = record['PROCESS_TIME']
             self.slowest_page = record['REQUEST_URL']
 
+    def handle_batch(self, batch):
+        if not batch.size:
+            return
+        times = batch.columns['PROCESS_TIME']
+        i = last_argmax(times)
+        if times[i] >= self.slowest_page_speed:
+            self.slowest_page_speed = int(times[i])
+            self.slowest_page = batch.value('REQUEST_URL', i)
+
+    def merge(self, other):
+        if (other.slowest_page is not None and
+                other.slowest_page_speed >= self.slowest_page_speed):
+            self.slowest_page_speed = other.slowest_page_speed
+            self.slowest_page = other.slowest_page
+
     def result(self):
         return self.slowest_page
 
 
 class FastestPage(Statistics):
-    def __init__(self):
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
         self.fastest_page = None
         self.fastest_page_speed = 10 ** 100
 
@@ -128,28 +663,64 @@ class FastestPage(Statistics):
             self.fastest_page_speed = record['PROCESS_TIME']
             self.fastest_page = record['REQUEST_URL']
 
+    def handle_batch(self, batch):
+        if not batch.size:
+            return
+        times = batch.columns['PROCESS_TIME']
+        i = last_argmin(times)
+        if times[i] <= self.fastest_page_speed:
+            self.fastest_page_speed = int(times[i])
+            self.fastest_page = batch.value('REQUEST_URL', i)
+
+    def merge(self, other):
+        if (other.fastest_page is not None and
+                other.fastest_page_speed <= self.fastest_page_speed):
+            self.fastest_page_speed = other.fastest_page_speed
+            self.fastest_page = other.fastest_page
+
     def result(self):
         return self.fastest_page
 
 
 class SlowestAveragePage(Statistics):
-    def __init__(self):
-        self.pages = defaultdict(lambda: {'count': 0, 'cumulative_time': 0})
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
+        self.urls = self.symbols['REQUEST_URL']
+        # Indexed by URL ids: 16 bytes per page instead of a dict per page
+        self.counts = array('q')
+        self.cumulative_times = array('q')
 
     def handle_record(self, record):
-        page = record['REQUEST_URL']
-        self.pages[page]['count'] += 1
-        self.pages[page]['cumulative_time'] += record['PROCESS_TIME']
+        page = self.urls[record['REQUEST_URL']]
+        if page >= len(self.counts):
+            grow(self.counts, len(self.urls))
+            grow(self.cumulative_times, len(self.urls))
+        self.counts[page] += 1
+        self.cumulative_times[page] += record['PROCESS_TIME']
+
+    def handle_batch(self, batch):
+        pages = batch.values['REQUEST_URL']
+        urls = batch.columns['REQUEST_URL']
+        add_counts(self.counts, self.urls,
+                   zip(pages, count_ids(urls, len(pages))))
+        add_counts(self.cumulative_times, self.urls,
+                   zip(pages, sum_by_ids(urls, batch.columns['PROCESS_TIME'],
+                                         len(pages))))
+
+    def merge(self, other):
+        add_counts(self.counts, self.urls,
+                   zip(other.urls.strings, other.counts))
+        add_counts(self.cumulative_times, self.urls,
+                   zip(other.urls.strings, other.cumulative_times))
 
     def result(self):
-        def average(dct):
-            return dct['cumulative_time'] / dct['count']
+        counts, times = self.counts, self.cumulative_times
+        page = max((page for page in range(len(counts)) if counts[page]),
+                   key=lambda page: times[page] / counts[page])
+        return self.urls.strings[page]
 
-        page, stat = max(self.pages.items(), key=lambda tpl: average(tpl[1]))
-        return page
 
-
-def most_common_lex_minimal(counter):
+def most_common_lex_minimal(counter, symbols=None):
     max_count = None
     answers = []
     for (item, count) in counter.most_common():
@@ -160,53 +731,123 @@ def most_common_lex_minimal(counter):
             break
 
         answers.append(item)
+    if symbols is not None:
+        answers = [symbols.strings[item] for item in answers]
     return min(answers)
 
 
+def most_common_symbol(counts, symbols):
+    """
+    most_common_lex_minimal for an array of counts indexed by ids
+    from `symbols`
+    """
+    max_count = max(counts)
+    return min(string for string, count in zip(symbols.strings, counts)
+               if count == max_count)
+
+
 class MostPopularPage(Statistics):
-    def __init__(self):
-        self.pages = Counter()
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
+        self.urls = self.symbols['REQUEST_URL']
+        self.pages = array('q')
 
     def handle_record(self, record):
-        self.pages[record['REQUEST_URL']] += 1
+        i = self.urls[record['REQUEST_URL']]
+        try:
+            self.pages[i] += 1
+        except IndexError:
+            grow(self.pages, len(self.urls))
+            self.pages[i] += 1
+
+    def handle_batch(self, batch):
+        add_counts(self.pages, self.urls, batch.counts('REQUEST_URL').items())
+
+    def merge(self, other):
+        add_counts(self.pages, self.urls, zip(other.urls.strings, other.pages))
 
     def result(self):
-        return most_common_lex_minimal(self.pages)
+        return most_common_symbol(self.pages, self.urls)
 
 
 class MostActiveClient(Statistics):
-    def __init__(self):
-        self.clients = Counter()
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
+        self.ips = self.symbols['IP']
+        self.clients = array('q')
 
     def handle_record(self, record):
-        self.clients[record['IP']] += 1
+        i = self.ips[record['IP']]
+        try:
+            self.clients[i] += 1
+        except IndexError:
+            grow(self.clients, len(self.ips))
+            self.clients[i] += 1
+
+    def handle_batch(self, batch):
+        add_counts(self.clients, self.ips, batch.counts('IP').items())
+
+    def merge(self, other):
+        add_counts(self.clients, self.ips,
+                   zip(other.ips.strings, other.clients))
 
     def result(self):
-        return most_common_lex_minimal(self.clients)
+        return most_common_symbol(self.clients, self.ips)
 
 
 class MostPopularBrowser(Statistics):
-    def __init__(self):
-        self.browsers = Counter()
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
+        self.user_agents = self.symbols['USER_AGENT']
+        self.browsers = array('q')
 
     def handle_record(self, record):
-        self.browsers[record['USER_AGENT']] += 1
+        i = self.user_agents[record['USER_AGENT']]
+        try:
+            self.browsers[i] += 1
+        except IndexError:
+            grow(self.browsers, len(self.user_agents))
+            self.browsers[i] += 1
+
+    def handle_batch(self, batch):
+        add_counts(self.browsers, self.user_agents,
+                   batch.counts('USER_AGENT').items())
+
+    def merge(self, other):
+        add_counts(self.browsers, self.user_agents,
+                   zip(other.user_agents.strings, other.browsers))
 
     def result(self):
-        return most_common_lex_minimal(self.browsers)
+        return most_common_symbol(self.browsers, self.user_agents)
 
 
 class MostActiveClientByDay(Statistics):
-    def __init__(self):
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
+        self.ips = self.symbols['IP']
         self.stat_by_day = defaultdict(Counter)
 
     def handle_record(self, record):
-        self.stat_by_day[record['DATETIME'].date()][record['IP']] += 1
+        self.stat_by_day[record['DATETIME'].date()][
+            self.ips[record['IP']]] += 1
+
+    def handle_batch(self, batch):
+        ips = self.ips.ids(batch.values['IP'])
+        dates = batch.values['DATE']
+        for (day, ip), count in count_pairs(
+                batch.columns['DATE'], batch.columns['IP'], len(ips)).items():
+            self.stat_by_day[dates[day]][ips[ip]] += count
+
+    def merge(self, other):
+        for day, counter in other.stat_by_day.items():
+            self.stat_by_day[day].update({
+                self.ips[other.ips.strings[ip]]: count
+                for ip, count in counter.items()})
 
     def result(self):
         return OrderedDict(sorted(
-            ((date, most_common_lex_minimal(counter))
-             for date, counter in self.stat_by_day.items()),
+            ((day, most_common_lex_minimal(counter, self.ips))
+             for day, counter in self.stat_by_day.items()),
             key=itemgetter(0)
         ))
 
@@ -219,22 +860,1748 @@ ALL_STATS = (SlowestPage, FastestPage, SlowestAveragePage, MostPopularPage,
 #                    not inspect.isabstract(cls)))
 
 
-def harvest_stats(feed, statistics=ALL_STATS):
-    stats_builders = list(map(lambda x: x(), statistics))
+class ApproxMostCommon(Statistics):
+    """
+    Fixed-memory replacement for an exact most common `FIELD` statistic
+    `EXACT`, reported under the same name. A MisraGries summary of
+    `CAPACITY` counters keeps every value occurring in more than
+    1 / (CAPACITY + 1) of records, the candidates are ranked by a
+    CountMinSketch. The answer is exact unless the top values are within
+    the sketch error (see CountMinSketch) of each other or no value
+    exceeds the 1 / (CAPACITY + 1) share.
+
+    Values are kept as strings, not symbols: a shared SymbolTable would
+    grow with the number of distinct values
+    """
+    EXACT = None
+    FIELD = None
+    CAPACITY = 1024
+
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
+        self.candidates = MisraGries(self.CAPACITY)
+        self.counts = CountMinSketch()
+
+    @property
+    def name(self):
+        return self.EXACT.__name__
+
+    def handle_record(self, record):
+        value = record[self.FIELD]
+        self.candidates.add(value)
+        self.counts.add(value)
+
+    def handle_batch(self, batch):
+        for value, count in batch.counts(self.FIELD).items():
+            self.candidates.add(value, count)
+            self.counts.add(value, count)
+
+    def merge(self, other):
+        self.candidates.merge(other.candidates)
+        self.counts.merge(other.counts)
+
+    def result(self):
+        return min(self.candidates,
+                   key=lambda value: (-self.counts.estimate(value), value))
+
+
+class ApproxMostPopularPage(ApproxMostCommon):
+    EXACT = MostPopularPage
+    FIELD = 'REQUEST_URL'
+
+
+class ApproxMostActiveClient(ApproxMostCommon):
+    EXACT = MostActiveClient
+    FIELD = 'IP'
+
+
+class ApproxMostPopularBrowser(ApproxMostCommon):
+    EXACT = MostPopularBrowser
+    FIELD = 'USER_AGENT'
+
+
+class ApproxMostActiveClientByDay(Statistics):
+    """
+    MostActiveClientByDay with a MisraGries summary of `CAPACITY` counters
+    per day instead of a Counter of all clients. As in ApproxMostCommon,
+    the summary keeps every client with more than 1 / (CAPACITY + 1) of
+    the day's records and the candidates are ranked by a CountMinSketch of
+    (day, client) pairs shared by all days. The answer for a day is exact
+    unless its top clients are within the sketch error (e / width of all
+    records, see CountMinSketch) of each other or no client exceeds the
+    1 / (CAPACITY + 1) share of the day
+    """
+    CAPACITY = 256
+
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
+        self.stat_by_day = {}
+        self.counts = CountMinSketch()
+
+    @property
+    def name(self):
+        return MostActiveClientByDay.__name__
+
+    @staticmethod
+    def _key(day, ip):
+        return '{} {}'.format(day.isoformat(), ip)
+
+    def _add(self, day, ip, count=1):
+        if day not in self.stat_by_day:
+            self.stat_by_day[day] = MisraGries(self.CAPACITY)
+        self.stat_by_day[day].add(ip, count)
+        self.counts.add(self._key(day, ip), count)
+
+    def handle_record(self, record):
+        self._add(record['DATETIME'].date(), record['IP'])
+
+    def handle_batch(self, batch):
+        ips, days = batch.values['IP'], batch.values['DATE']
+        for (day, ip), count in count_pairs(
+                batch.columns['DATE'], batch.columns['IP'], len(ips)).items():
+            self._add(days[day], ips[ip], count)
+
+    def merge(self, other):
+        for day, summary in other.stat_by_day.items():
+            if day not in self.stat_by_day:
+                self.stat_by_day[day] = MisraGries(self.CAPACITY)
+            self.stat_by_day[day].merge(summary)
+        self.counts.merge(other.counts)
+
+    def result(self):
+        return OrderedDict(sorted(
+            ((day, min(summary, key=lambda ip: (
+                -self.counts.estimate(self._key(day, ip)), ip)))
+             for day, summary in self.stat_by_day.items()),
+            key=itemgetter(0)
+        ))
+
+
+class ApproxSlowestAveragePage(Statistics):
+    """
+    SlowestAveragePage in fixed memory. Candidates are pages with the
+    largest total PROCESS_TIME, kept by a MisraGries summary of `CAPACITY`
+    counters weighted by time; their averages are estimated from
+    CountMinSketches of total times and of numbers of requests. A page is
+    found only if its total time exceeds 1 / (CAPACITY + 1) of the total
+    time of all pages, so a rare slow page may be missed.
+
+    Pages are kept as strings, not symbols, as in ApproxMostCommon
+    """
+    CAPACITY = 1024
+
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
+        self.candidates = MisraGries(self.CAPACITY)
+        self.counts = CountMinSketch()
+        self.cumulative_times = CountMinSketch()
+
+    @property
+    def name(self):
+        return SlowestAveragePage.__name__
+
+    def _add(self, url, count, cumulative_time):
+        # MisraGries needs positive weights; pages that took no time at
+        # all never have the highest average anyway
+        if cumulative_time:
+            self.candidates.add(url, cumulative_time)
+        self.counts.add(url, count)
+        self.cumulative_times.add(url, cumulative_time)
+
+    def handle_record(self, record):
+        self._add(record['REQUEST_URL'], 1, record['PROCESS_TIME'])
+
+    def handle_batch(self, batch):
+        pages = batch.values['REQUEST_URL']
+        urls = batch.columns['REQUEST_URL']
+        for url, count, cumulative_time in zip(
+                pages, count_ids(urls, len(pages)),
+                sum_by_ids(urls, batch.columns['PROCESS_TIME'], len(pages))):
+            if count:
+                self._add(url, count, int(cumulative_time))
+
+    def merge(self, other):
+        self.candidates.merge(other.candidates)
+        self.counts.merge(other.counts)
+        self.cumulative_times.merge(other.cumulative_times)
+
+    def result(self):
+        return min(self.candidates, key=lambda url: (
+            -self.cumulative_times.estimate(url) / self.counts.estimate(url),
+            url))
+
+
+class DistinctCount(Statistics):
+    """
+    Approximate number of distinct `FIELD` values: HyperLogLog with 0.81%
+    standard error in 16 KiB
+    """
+    FIELD = None
+
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
+        self.distinct = HyperLogLog()
+
+    def handle_record(self, record):
+        self.distinct.add(record[self.FIELD])
+
+    def handle_batch(self, batch):
+        for value in batch.values[self.FIELD]:
+            self.distinct.add(value)
+
+    def merge(self, other):
+        self.distinct.merge(other.distinct)
+
+    def result(self):
+        return self.distinct.count()
+
+
+class DistinctClients(DistinctCount):
+    FIELD = 'IP'
+
+
+class DistinctPages(DistinctCount):
+    FIELD = 'REQUEST_URL'
+
+
+class SlowestPercentilePages(Statistics):
+    """
+    Pages with the highest 50th, 95th and 99th percentiles of PROCESS_TIME
+    (lexicographically minimal on ties). Percentiles are estimated with a
+    DDSketch per page within `ALPHA` relative error, in one pass and
+    without storing samples. Unlike the other APPROX_STATS it is not
+    fixed-memory: memory grows with the number of distinct URLs
+    """
+    QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+    ALPHA = 0.01
+
+    def __init__(self, symbols=None):
+        super().__init__(symbols)
+        self.urls = self.symbols['REQUEST_URL']
+        # Indexed by URL ids
+        self.sketches = []
+
+    def _grow(self):
+        self.sketches.extend(DDSketch(self.ALPHA) for _ in range(
+            len(self.urls) - len(self.sketches)))
+
+    def handle_record(self, record):
+        page = self.urls[record['REQUEST_URL']]
+        if page >= len(self.sketches):
+            self._grow()
+        self.sketches[page].add(record['PROCESS_TIME'])
+
+    def handle_batch(self, batch):
+        if not batch.size:
+            return
+        pages = self.urls.ids(batch.values['REQUEST_URL'])
+        self._grow()
+        for page, times in zip(pages, group_by_ids(
+                batch.columns['REQUEST_URL'], batch.columns['PROCESS_TIME'],
+                len(pages))):
+            sketch = self.sketches[page]
+            for process_time, count in Counter(times).items():
+                sketch.add(process_time, count)
+
+    def merge(self, other):
+        for url, sketch in zip(other.urls.strings, other.sketches):
+            page = self.urls[url]
+            if page >= len(self.sketches):
+                self._grow()
+            self.sketches[page].merge(sketch)
+
+    def percentiles(self, url):
+        """
+        Returns dict {'p50': ..., 'p95': ..., 'p99': ...} of estimated
+        PROCESS_TIME percentiles of page `url`
+        """
+        sketch = self.sketches[self.urls[url]]
+        return {name: sketch.quantile(q) for name, q in self.QUANTILES}
+
+    def result(self):
+        return {
+            name: min((-sketch.quantile(q), url) for url, sketch in zip(
+                self.urls.strings, self.sketches) if sketch.count)[1]
+            for name, q in self.QUANTILES
+        }
+
+
+APPROX_STATS = {
+    'SlowestAveragePage': ApproxSlowestAveragePage,
+    'MostPopularPage': ApproxMostPopularPage,
+    'MostActiveClient': ApproxMostActiveClient,
+    'MostPopularBrowser': ApproxMostPopularBrowser,
+    'MostActiveClientByDay': ApproxMostActiveClientByDay,
+    'DistinctClients': DistinctClients,
+    'DistinctPages': DistinctPages,
+    'SlowestPercentilePages': SlowestPercentilePages,
+}
+
+
+def select_stats(approx=()):
+    """
+    Returns ALL_STATS with statistics named in `approx` replaced by their
+    approximate variants from APPROX_STATS, followed by approximate-only
+    statistics named there
+    """
+    unknown = set(approx) - set(APPROX_STATS)
+    if unknown:
+        raise ValueError('no approximate statistics {}'.format(
+            ', '.join(sorted(unknown))))
+    statistics = [APPROX_STATS[cls.__name__]
+                  if cls.__name__ in approx else cls for cls in ALL_STATS]
+    exact = {cls.__name__ for cls in ALL_STATS}
+    statistics.extend(APPROX_STATS[name] for name in approx
+                      if name not in exact)
+    return tuple(statistics)
+
+
+DURATION_UNITS = (('d', 86400), ('h', 3600), ('m', 60), ('s', 1))
+
+
+def parse_duration(text):
+    """
+    Converts duration like '30s', '5m', '1h' or '1d' (or just seconds) to
+    a number of seconds
+    """
+    units = dict(DURATION_UNITS)
+    try:
+        if text[-1:] in units:
+            seconds = int(text[:-1]) * units[text[-1]]
+        else:
+            seconds = int(text)
+    except ValueError:
+        raise ValueError('invalid duration {!r}'.format(text)) from None
+    if seconds <= 0:
+        raise ValueError('invalid duration {!r}'.format(text))
+    return seconds
+
+
+def format_duration(seconds):
+    for unit, size in DURATION_UNITS:
+        if seconds % size == 0:
+            return '{}{}'.format(seconds // size, unit)
+
+
+class WindowedStatistics(Statistics):
+    """
+    Computes `statistics` (a Statistics class) separately for every time
+    window of `size` seconds: tumbling windows by default, windows sliding
+    by `step` seconds if `step` is given (`size` must be a multiple of it).
+    Windows are aligned to the time zone of the first record, so daily
+    windows start at local midnight.
+
+    Records are counted into panes of `step` seconds, each with its own
+    `statistics` builder and SymbolTable. A window is the merge of its
+    size / step panes and is finalized once records are `lateness` seconds
+    past its end; panes that no window still needs are dropped. So only
+    about (size + lateness) / step panes and window results are kept in
+    memory, not the whole log. Records arriving later than that are
+    dropped and counted in `late`.
+
+    Windows touching the first `size` + `lateness` seconds of the builder
+    are finalized only in result() or by merge() into the builder of the
+    preceding part of the log: it may have records for them
+    """
+    def __init__(self, symbols=None, statistics=None, size=3600, step=None,
+                 lateness=60):
+        super().__init__(symbols)
+        step = size if step is None else step
+        if size % step:
+            raise ValueError('window size must be a multiple of its step')
+        self.statistics = statistics
+        self.size = size
+        self.step = step
+        self.width = size // step
+        self.lateness = -(-lateness // step)
+        self.inner_name = statistics(SymbolTable()).name
+        self.tzinfo = None
+        self.offset = 0
+        self.first = None
+        self.head_end = None
+        self.newest = None
+        self.closed = None
+        self.panes = {}
+        self.results = {}
+        self.late = 0
+
+    @property
+    def name(self):
+        name = '{}Per{}'.format(self.inner_name, format_duration(self.size))
+        if self.step != self.size:
+            name += 'Every{}'.format(format_duration(self.step))
+        return name
+
+    def _start(self, tzinfo, timestamp):
+        self.tzinfo = tzinfo
+        self.offset = int(datetime.fromtimestamp(
+            timestamp, tzinfo).utcoffset().total_seconds())
+        self.first = self.newest = (timestamp + self.offset) // self.step
+        self.head_end = self.closed = (
+            self.first + self.width - 1 + self.lateness)
+
+    def _pane(self, pane):
+        if pane not in self.panes:
+            self.panes[pane] = self.statistics(SymbolTable())
+        return self.panes[pane]
+
+    def _is_late(self, pane, newest):
+        # The pane is already dropped or about to be dropped
+        return self.head_end < pane < (
+            newest - self.lateness - self.width + 1)
+
+    def _window(self, end):
+        builder = self.statistics(SymbolTable())
+        for pane in range(end - self.width + 1, end + 1):
+            if pane in self.panes:
+                builder.merge(self.panes[pane])
+        return builder.result()
+
+    def _close(self, until):
+        """
+        Finalizes windows ending in panes after `closed` up to `until`
+        (those with records only) and drops panes no longer needed
+        """
+        if until <= self.closed:
+            return
+        ends = sorted({end for pane in self.panes
+                       for end in range(pane, pane + self.width)
+                       if self.closed < end <= until})
+        for end in ends:
+            self.results[end] = self._window(end)
+        self.closed = until
+        self._expire()
+
+    def _expire(self):
+        for pane in [pane for pane in self.panes
+                     if self.head_end < pane <= self.closed - self.width + 1]:
+            del self.panes[pane]
+
+    def handle_record(self, record):
+        dt = record['DATETIME']
+        timestamp = int(dt.timestamp())
+        if self.first is None:
+            self._start(dt.tzinfo, timestamp)
+        pane = (timestamp + self.offset) // self.step
+        if self._is_late(pane, self.newest):
+            self.late += 1
+            return
+        self._pane(pane).handle_record(record)
+        if pane > self.newest:
+            self.newest = pane
+            self._close(pane - self.lateness - 1)
+
+    def handle_batch(self, batch):
+        if not batch.size:
+            return
+        times = batch.columns['TIME']
+        if self.first is None:
+            self._start(batch.tzinfo, int(times[0]))
+
+        if np is not None:
+            panes = (times + self.offset) // self.step
+            newest = np.maximum(np.maximum.accumulate(panes), self.newest)
+            late = (panes > self.head_end) & (
+                panes < newest - self.lateness - self.width + 1)
+            self.late += int(np.count_nonzero(late))
+            kept = np.flatnonzero(~late)
+            order = kept[np.argsort(panes[kept], kind='stable')]
+            keys, starts = np.unique(panes[order], return_index=True)
+            groups = zip(keys.tolist(), np.split(order, starts[1:]))
+            newest = int(newest[-1])
+        else:
+            groups = {}
+            newest = self.newest
+            for i, timestamp in enumerate(times):
+                pane = (timestamp + self.offset) // self.step
+                if self._is_late(pane, newest):
+                    self.late += 1
+                    continue
+                newest = max(newest, pane)
+                groups.setdefault(pane, []).append(i)
+            groups = sorted(groups.items())
+
+        for pane, indices in groups:
+            self._pane(pane).handle_batch(batch.take(indices))
+        self.newest = newest
+        self._close(newest - self.lateness - 1)
+
+    def merge(self, other):
+        if other.first is None:
+            return
+        if self.first is None:
+            self.__dict__.update(other.__dict__)
+            return
+
+        for pane, builder in other.panes.items():
+            self._pane(pane).merge(builder)
+        self.newest = max(self.newest, other.newest)
+        self.late += other.late
+        # Windows up to other.head_end need records of both builders,
+        # later ones are already finalized by other alone
+        self._close(min(self.newest - self.lateness - 1, other.head_end))
+        if other.closed > other.head_end:
+            self.results.update(other.results)
+            self.closed = other.closed
+            self._expire()
+        self._close(self.newest - self.lateness - 1)
+
+    def result(self):
+        """
+        Returns OrderedDict {window start: `statistics` result} for all
+        windows with records
+        """
+        results = dict(self.results)
+        for end in {end for pane in self.panes
+                    for end in range(pane, pane + self.width)
+                    if end > self.closed or end <= self.head_end}:
+            results[end] = self._window(end)
+
+        return OrderedDict(
+            (datetime.fromtimestamp(
+                (end - self.width + 1) * self.step - self.offset,
+                self.tzinfo), result)
+            for end, result in sorted(results.items()))
+
+
+def parse_window(text, statistics=ALL_STATS, lateness=60):
+    """
+    Parses window specification 'NAME:SIZE[:STEP]' of the --window option,
+    NAME is a name of one of `statistics` or of APPROX_STATS
+    """
+    name, _, durations = text.partition(':')
+    by_name = dict(APPROX_STATS)
+    by_name.update((cls.__name__, cls) for cls in ALL_STATS)
+    by_name.update((cls(SymbolTable()).name, cls) for cls in statistics)
+    if name not in by_name or not durations:
+        raise ValueError('invalid window {!r}'.format(text))
+    size, _, step = durations.partition(':')
+    window = windowed(by_name[name], parse_duration(size),
+                      parse_duration(step) if step else None, lateness)
+    window()  # checks that the size is a multiple of the step
+    return window
+
+
+def windowed(statistics, size, step=None, lateness=60):
+    """
+    Returns factory of WindowedStatistics builders of `statistics`, to be
+    used in place of a Statistics class
+    """
+    return partial(WindowedStatistics, statistics=statistics, size=size,
+                   step=step, lateness=lateness)
+
+
+QUERY_FIELDS = {
+    'ip': 'IP',
+    'method': 'REQUEST_METHOD',
+    'url': 'REQUEST_URL',
+    'status': 'STATUS',
+    'size': 'SIZE',
+    'referrer': 'REFERRER',
+    'user_agent': 'USER_AGENT',
+    'process_time': 'PROCESS_TIME',
+    'date': 'DATETIME',
+}
+NUMERIC_QUERY_FIELDS = ('status', 'size', 'process_time')
+
+QUERY_OPERATORS = {
+    '=': eq, '!=': ne, '<': lt, '<=': le, '>': gt, '>=': ge, '~': contains,
+}
+
+WHERE_RE = re.compile(r'\s*(\w+)\s*(!=|<=|>=|=|<|>|~)\s*(.*?)\s*$')
+AGG_RE = re.compile(r'\s*([\w.]+?)(?:\(\s*(\w*)\s*\))?\s*$')
+PERCENTILE_RE = re.compile(r'p(\d{1,2}(?:\.\d+)?)$')
+
+
+def query_value(record, field):
+    value = record[QUERY_FIELDS[field]]
+    return value.date() if field == 'date' else value
+
+
+def query_column(batch, field):
+    """
+    Returns list of values of query `field` of all lines of LogBatch
+    `batch`, the same as query_value would return for their records
+    """
+    name = 'DATE' if field == 'date' else QUERY_FIELDS[field]
+    column = batch.columns[name]
+    if np is not None:
+        column = column.tolist()
+    if name not in batch.values:
+        return list(column)
+    values = batch.values[name]
+    return [values[i] for i in column]
+
+
+def raw_status_and_size(line):
+    """
+    Cheaply finds STATUS and SIZE of a raw log line without parsing it:
+    they follow the quote closing the request (see FAST_LOG_RE). Returns
+    tuple of ints, None if the line does not look like that. For lines
+    accepted by parse_record the numbers are always right
+    """
+    request_end = line.find('"', line.find('HTTP/') + 1)
+    if request_end < 0:
+        return None
+    fields = line[request_end + 1:].split(None, 2)
+    if len(fields) < 2 or not (fields[0].isdigit() and fields[1].isdigit()):
+        return None
+    return int(fields[0]), int(fields[1])
+
+
+class Predicate(namedtuple('Predicate', ('field', 'op', 'value'))):
+    """
+    Condition `field` `op` `value` of a --where option like 'status>=500'
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, text):
+        m = WHERE_RE.match(text)
+        if m is None or m.group(1) not in QUERY_FIELDS:
+            raise ValueError('invalid condition {!r}'.format(text))
+        field, op, value = m.groups()
+        if field in NUMERIC_QUERY_FIELDS:
+            if op == '~' or not value.isdigit():
+                raise ValueError('invalid condition {!r}'.format(text))
+            value = int(value)
+        elif field == 'date':
+            try:
+                value = datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                raise ValueError('invalid condition {!r}'.format(
+                    text)) from None
+            if op == '~':
+                raise ValueError('invalid condition {!r}'.format(text))
+        return cls(field, op, value)
+
+    def __str__(self):
+        return '{}{}{}'.format(*self)
+
+    def matches(self, record):
+        return QUERY_OPERATORS[self.op](query_value(record, self.field),
+                                        self.value)
+
+
+class Count:
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+
+    def result(self):
+        return self.count
+
+
+class Sum:
+    __slots__ = ('sum',)
+
+    def __init__(self):
+        self.sum = 0
+
+    def add(self, value):
+        self.sum += value
+
+    def merge(self, other):
+        self.sum += other.sum
+
+    def result(self):
+        return self.sum
+
+
+class Min:
+    __slots__ = ('min',)
+
+    def __init__(self):
+        self.min = None
+
+    def add(self, value):
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def merge(self, other):
+        if other.min is not None:
+            self.add(other.min)
+
+    def result(self):
+        return self.min
+
+
+class Max:
+    __slots__ = ('max',)
+
+    def __init__(self):
+        self.max = None
+
+    def add(self, value):
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.max is not None:
+            self.add(other.max)
+
+    def result(self):
+        return self.max
+
+
+class Mean:
+    __slots__ = ('count', 'sum')
+
+    def __init__(self):
+        self.count = self.sum = 0
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+
+    def result(self):
+        return self.sum / self.count if self.count else None
+
+
+class Percentile:
+    """
+    Estimate of `q`-quantile within 1% relative error (see DDSketch)
+    """
+    __slots__ = ('q', 'sketch')
+
+    def __init__(self, q):
+        self.q = q
+        self.sketch = DDSketch()
+
+    def add(self, value):
+        self.sketch.add(value)
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+
+    def result(self):
+        value = self.sketch.quantile(self.q)
+        return None if value is None else round(value)
+
+
+class Distinct:
+    """
+    Approximate number of distinct values: HyperLogLog with 3.25% standard
+    error in 1 KiB, as there may be a lot of groups
+    """
+    __slots__ = ('distinct',)
+
+    def __init__(self):
+        self.distinct = HyperLogLog(precision=10)
+
+    def add(self, value):
+        self.distinct.add(str(value))
+
+    def merge(self, other):
+        self.distinct.merge(other.distinct)
+
+    def result(self):
+        return self.distinct.count()
+
+
+AGGREGATES = {
+    'count': Count, 'sum': Sum, 'min': Min, 'max': Max, 'avg': Mean,
+    'distinct': Distinct,
+}
+
+
+class Aggregate(namedtuple('Aggregate', ('function', 'field'))):
+    """
+    Aggregate function of a --agg option like 'count', 'avg(size)' or
+    'p99(process_time)'
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, text):
+        m = AGG_RE.match(text)
+        if m is None:
+            raise ValueError('invalid aggregate {!r}'.format(text))
+        function, field = m.groups()
+        if function == 'count':
+            return cls(function, None)
+        if field not in QUERY_FIELDS or not (
+                function == 'distinct' or
+                field in NUMERIC_QUERY_FIELDS and (
+                    function in AGGREGATES or PERCENTILE_RE.match(function))):
+            raise ValueError('invalid aggregate {!r}'.format(text))
+        return cls(function, field)
+
+    def __str__(self):
+        if self.field is None:
+            return self.function
+        return '{}({})'.format(*self)
+
+    def new(self):
+        m = PERCENTILE_RE.match(self.function)
+        if m is not None:
+            return Percentile(float(m.group(1)) / 100)
+        return AGGREGATES[self.function]()
+
+
+class Query:
+    """
+    Aggregates `aggregates` of records matching all `predicates`, grouped
+    by values of field `group_by` if it is given.
+
+    Lines that certainly do not match are skipped by prefilter() before
+    parsing: equality and substring conditions on strings need the value
+    to occur in the line, conditions on STATUS and SIZE are checked on
+    numbers found by raw_status_and_size. Other conditions are checked on
+    parsed records only
+    """
+    def __init__(self, predicates=(), group_by=None,
+                 aggregates=(Aggregate('count', None),)):
+        if group_by is not None and group_by not in QUERY_FIELDS:
+            raise ValueError('invalid field {!r}'.format(group_by))
+        self.predicates = tuple(predicates)
+        self.group_by = group_by
+        self.aggregates = tuple(aggregates)
+        self.needles = tuple(
+            p.value for p in self.predicates
+            if p.op in ('=', '~') and isinstance(p.value, str))
+        self.numbers = tuple(
+            (('status', 'size').index(p.field), QUERY_OPERATORS[p.op],
+             p.value)
+            for p in self.predicates if p.field in ('status', 'size'))
+
+    @classmethod
+    def parse(cls, where=(), group_by=None, aggregates=('count',)):
+        return cls([Predicate.parse(text) for text in where], group_by,
+                   [Aggregate.parse(text) for text in aggregates])
+
+    def __str__(self):
+        text = ', '.join(map(str, self.aggregates))
+        if self.group_by is not None:
+            text += ' by ' + self.group_by
+        if self.predicates:
+            text += ' where ' + ' and '.join(map(str, self.predicates))
+        return text
+
+    @property
+    def has_prefilter(self):
+        return bool(self.needles or self.numbers)
+
+    def prefilter(self, line):
+        """
+        Returns False if raw `line` can't match the query
+        """
+        for needle in self.needles:
+            if needle not in line:
+                return False
+        if self.numbers:
+            numbers = raw_status_and_size(line)
+            if numbers is not None:
+                for i, op, value in self.numbers:
+                    if not op(numbers[i], value):
+                        return False
+        return True
+
+    def matches(self, record):
+        for predicate in self.predicates:
+            if not predicate.matches(record):
+                return False
+        return True
+
+
+class QueryStatistics(Statistics):
+    """
+    Result of `query` (see Query): {group value: {aggregate: value}}, just
+    {aggregate: value} without grouping
+    """
+    def __init__(self, symbols=None, query=None):
+        super().__init__(symbols)
+        self.query = Query() if query is None else query
+        self.groups = {}
+
+    @property
+    def name(self):
+        return str(self.query)
+
+    def _group(self, key):
+        if key not in self.groups:
+            self.groups[key] = [aggregate.new()
+                                for aggregate in self.query.aggregates]
+        return self.groups[key]
+
+    def handle_record(self, record):
+        query = self.query
+        if not query.matches(record):
+            return
+        group = self._group(None if query.group_by is None else
+                            query_value(record, query.group_by))
+        for aggregate, aggregator in zip(query.aggregates, group):
+            aggregator.add(None if aggregate.field is None else
+                           query_value(record, aggregate.field))
+
+    def handle_batch(self, batch):
+        query = self.query
+        fields = {predicate.field for predicate in query.predicates}
+        fields.update(aggregate.field for aggregate in query.aggregates
+                      if aggregate.field is not None)
+        if query.group_by is not None:
+            fields.add(query.group_by)
+        columns = {field: query_column(batch, field) for field in fields}
+
+        rows = range(batch.size)
+        for predicate in query.predicates:
+            op = QUERY_OPERATORS[predicate.op]
+            values = columns[predicate.field]
+            rows = [i for i in rows if op(values[i], predicate.value)]
+
+        keys = None if query.group_by is None else columns[query.group_by]
+        aggregates = [None if aggregate.field is None else
+                      columns[aggregate.field]
+                      for aggregate in query.aggregates]
+        for i in rows:
+            group = self._group(None if keys is None else keys[i])
+            for values, aggregator in zip(aggregates, group):
+                aggregator.add(None if values is None else values[i])
+
+    def merge(self, other):
+        for key, group in other.groups.items():
+            for aggregator, other_aggregator in zip(self._group(key), group):
+                aggregator.merge(other_aggregator)
+
+    def _result(self, group):
+        return OrderedDict(
+            (str(aggregate), aggregator.result())
+            for aggregate, aggregator in zip(self.query.aggregates, group))
+
+    def result(self):
+        if self.query.group_by is None:
+            group = self.groups.get(None)
+            return self._result(group or [aggregate.new() for aggregate in
+                                          self.query.aggregates])
+        return {key: self._result(group)
+                for key, group in self.groups.items()}
+
+
+def build_stats(feed, statistics=ALL_STATS, profile=None):
+    symbols = SymbolTable()
+    stats_builders = [x(symbols) for x in statistics]
+    if profile is not None:
+        return _profiled_build_stats(feed, stats_builders, 'handle_record',
+                                     profile)
+
     for record in feed:
         for sb in stats_builders:
             sb.handle_record(record)
 
+    return stats_builders
+
+
+def build_batch_stats(batches, statistics=ALL_STATS, profile=None):
+    symbols = SymbolTable()
+    stats_builders = [x(symbols) for x in statistics]
+    if profile is not None:
+        return _profiled_build_stats(batches, stats_builders, 'handle_batch',
+                                     profile)
+
+    for batch in batches:
+        for sb in stats_builders:
+            sb.handle_batch(batch)
+
+    return stats_builders
+
+
+def _profiled_build_stats(feed, stats_builders, method, profile):
+    clock = time.perf_counter
+    handle_times = profile.handle_times
+    handlers = [(sb.name, getattr(sb, method)) for sb in stats_builders]
+    for item in feed:
+        for name, handle in handlers:
+            start = clock()
+            handle(item)
+            handle_times[name] += clock() - start
+
+    return stats_builders
+
+
+def split_file(filename, chunks):
+    """
+    Splits file into at most `chunks` byte ranges of about the same size,
+    every range starting at the beginning of a line
+    """
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, chunks):
+            f.seek(max(size * i // chunks - 1, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+
+    return [(begin, end) for begin, end in zip(bounds, bounds[1:])
+            if begin < end]
+
+
+def read_lines(filename, begin, end):
+    with open(filename, 'rb') as f:
+        f.seek(begin)
+        while begin < end:
+            line = f.readline()
+            if not line:
+                break
+            begin += len(line)
+            yield line.decode('utf-8', 'replace')
+
+
+# Magic bytes of compressed files, functions opening them and their
+# decompressor object factories
+COMPRESSIONS = (
+    (b'\x1f\x8b', gzip.open, partial(zlib.decompressobj, 31)),
+    (b'BZh', bz2.open, bz2.BZ2Decompressor),
+    (b'\xfd7zXZ\x00', lzma.open, lzma.LZMADecompressor),
+)
+READ_CHUNK = 2**20
+# Compressed data is read in smaller chunks: it expands a lot
+COMPRESSED_READ_CHUNK = 64 * 2**10
+READ_QUEUE_SIZE = 8
+
+
+def _sniff_log(filename):
+    with open(filename, 'rb') as f:
+        head = f.read(6)
+    for magic, opener, decompressor in COMPRESSIONS:
+        if head.startswith(magic):
+            return opener, decompressor
+    return open, None
+
+
+def log_opener(filename):
+    """
+    Returns function opening `filename` for reading bytes: gzip.open,
+    bz2.open or lzma.open for compressed files, open for plain ones
+    """
+    return _sniff_log(filename)[0]
+
+
+def _decompress(f, make_decompressor, chunk_size):
+    """
+    Yields decompressed data of file `f` of one or more concatenated
+    compressed streams. Unlike gzip/bz2/lzma file objects, which
+    decompress 8 KiB at a time, every decompress() call gets a whole chunk
+    and runs without the GIL for most of it
+    """
+    decompressor = make_decompressor()
+    started = False
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            if started and not decompressor.eof:
+                raise EOFError('compressed file ended before the '
+                               'end-of-stream marker was reached')
+            return
+        while data:
+            started = True
+            yield decompressor.decompress(data)
+            if not decompressor.eof:
+                break
+            data = decompressor.unused_data
+            decompressor = make_decompressor()
+            started = False
+
+
+def _read_chunks(filename, make_decompressor, chunk_size, chunks, stop):
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    try:
+        with open(filename, 'rb') as f:
+            if make_decompressor is None:
+                blocks = iter(partial(f.read, chunk_size), b'')
+            else:
+                blocks = _decompress(f, make_decompressor,
+                                     COMPRESSED_READ_CHUNK)
+            for data in blocks:
+                if stop.is_set():
+                    return
+                if data:
+                    put(data)
+        put(b'')
+    except Exception as e:
+        put(e)
+
+
+def read_log(filename, chunk_size=READ_CHUNK, queue_size=READ_QUEUE_SIZE):
+    """
+    Yields lines (without line ends) of log `filename`, plain or compressed
+    with gzip, bzip2 or xz. Reading and decompression run ahead of the
+    parsing, at most `queue_size` chunks of data (of `chunk_size` bytes
+    for plain files, decompressed from COMPRESSED_READ_CHUNK bytes for
+    compressed ones) ahead.
+
+    Plain files are read in a background thread. Compressed ones are
+    decompressed in a background process: decompressors release the GIL,
+    but take it back for every output block and then wait for the parsing
+    thread, so in a thread decompression barely overlaps with parsing
+    """
+    _, make_decompressor = _sniff_log(filename)
+    if make_decompressor is None:
+        chunks, stop = queue.Queue(queue_size), threading.Event()
+        reader = threading.Thread(
+            target=_read_chunks, daemon=True,
+            args=(filename, None, chunk_size, chunks, stop))
+    else:
+        chunks = multiprocessing.Queue(queue_size)
+        stop = multiprocessing.Event()
+        reader = multiprocessing.Process(
+            target=_read_chunks, daemon=True,
+            args=(filename, make_decompressor, chunk_size, chunks, stop))
+    reader.start()
+
+    try:
+        tail = b''
+        while True:
+            data = chunks.get()
+            if isinstance(data, Exception):
+                raise data
+            if not data:
+                if tail:
+                    yield tail.decode('utf-8', 'replace')
+                return
+
+            data = tail + data
+            end = data.rfind(b'\n')
+            if end < 0:
+                tail = data
+                continue
+            tail = data[end + 1:]
+            yield from data[:end].decode('utf-8', 'replace').split('\n')
+    finally:
+        stop.set()
+        # Unread chunks may keep the reader blocked on a full queue
+        while reader.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader.join()
+
+
+CACHE_SUFFIX = '.hw4cache'
+CACHE_MAGIC = b'HW4CACHE'
+CACHE_VERSION = 2
+CACHE_HEADER = struct.Struct('<8sIIqq')
+CACHE_BLOCK = struct.Struct('<qi4x')
+CACHE_DICTIONARY = struct.Struct('<qq')
+CACHE_FIELDS = LogBatch.STRING_FIELDS + LogBatch.NUMERIC_FIELDS
+
+
+def cache_path(filename):
+    return filename + CACHE_SUFFIX
+
+
+def _cache_header(st):
+    # Native byte order: columns are mapped into memory as they are
+    return CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION,
+                             sys.byteorder == 'little', st.st_size,
+                             st.st_mtime_ns)
+
+
+def _write_cache_block(f, batch):
+    offset = batch.tzinfo.utcoffset(None)
+    f.write(CACHE_BLOCK.pack(batch.size, int(offset.total_seconds())))
+    for field in LogBatch.STRING_FIELDS:
+        values = batch.values[field]
+        if field == 'DATE':
+            values = [value.isoformat() for value in values]
+        data = '\n'.join(values).encode('utf-8')
+        f.write(CACHE_DICTIONARY.pack(len(values), len(data)))
+        f.write(data)
+        f.write(bytes(-len(data) % 8))
+    for field in CACHE_FIELDS:
+        f.write(array('q', batch.columns[field]).tobytes()
+                if np is None else
+                np.asarray(batch.columns[field], dtype=np.int64).tobytes())
+
+
+def _read_cache_blocks(buffer):
+    position = CACHE_HEADER.size
+    while position < len(buffer):
+        size, offset = CACHE_BLOCK.unpack_from(buffer, position)
+        position += CACHE_BLOCK.size
+        values = {}
+        for field in LogBatch.STRING_FIELDS:
+            count, length = CACHE_DICTIONARY.unpack_from(buffer, position)
+            position += CACHE_DICTIONARY.size
+            strings = (bytes(buffer[position:position + length]).decode(
+                'utf-8').split('\n') if count else [])
+            if field == 'DATE':
+                strings = [date.fromisoformat(value) for value in strings]
+            values[field] = strings
+            position += length + -length % 8
+
+        columns = {}
+        for field in CACHE_FIELDS:
+            if np is not None:
+                columns[field] = np.frombuffer(buffer, dtype=np.int64,
+                                               count=size, offset=position)
+            else:
+                columns[field] = buffer[position:position + 8 * size].cast(
+                    'q')
+            position += 8 * size
+        yield LogBatch(columns, values,
+                       timezone(timedelta(seconds=offset)))
+
+
+def read_cache(filename):
+    """
+    Returns iterator of LogBatch objects from the cache of log `filename`
+    (see cached_batches), None if there is no cache or it is stale. Numeric
+    columns are not copied but mapped from the file
+    """
+    try:
+        st = os.stat(filename)
+        with open(cache_path(filename), 'rb') as f:
+            if f.read(CACHE_HEADER.size) != _cache_header(st):
+                return None
+            buffer = memoryview(mmap.mmap(f.fileno(), 0,
+                                          access=mmap.ACCESS_READ))
+    except (OSError, ValueError):
+        return None
+    return _read_cache_blocks(buffer)
+
+
+def _write_cache(filename, batches):
+    st = os.stat(filename)
+    tmp = '{}.{}.tmp'.format(cache_path(filename), os.getpid())
+    try:
+        f = open(tmp, 'wb')
+    except OSError:
+        # Not writable: just parse
+        yield from batches
+        return
+
+    try:
+        with f:
+            f.write(_cache_header(st))
+            for batch in batches:
+                if batch.size:
+                    _write_cache_block(f, batch)
+                yield batch
+        os.replace(tmp, cache_path(filename))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def cached_batches(filename, batch_size=BATCH_SIZE, profile=None):
+    """
+    Yields LogBatch objects of log `filename` from a binary columnar cache
+    next to it (`filename` + CACHE_SUFFIX), skipping parsing entirely. If
+    the cache is missing or made for another size or modification time of
+    the log, the log is parsed and the cache is written on the way.
+
+    Every batch is stored as a block: its string dictionaries (values of
+    the string fields in order of their ids, joined with newlines, which
+    can't occur in them) followed by its columns of 8-byte ints
+    """
+    batches = read_cache(filename)
+    if batches is not None and profile is None:
+        yield from batches
+        return
+    if batches is not None:
+        clock = time.perf_counter
+        while True:
+            start = clock()
+            batch = next(batches, None)
+            profile.stage_times['read cache'] += clock() - start
+            if batch is None:
+                return
+            profile.lines += batch.size
+            profile.records += batch.size
+            yield batch
+    yield from _write_cache(filename, iter_batches(
+        read_log(filename), batch_size, profile))
+
+
+def build_range_stats(filename, begin, end, statistics=ALL_STATS,
+                      parsers=PARSERS, batches=False, line_filter=None,
+                      profile=None):
+    """
+    Builds statistics over lines of `filename` from byte `begin` to `end`.
+    Returns tuple (builders, updated `profile`) if `profile` is given
+    """
+    lines = read_lines(filename, begin, end)
+    if line_filter is not None:
+        lines = filter_lines(lines, line_filter, profile)
+    if batches:
+        builders = build_batch_stats(iter_batches(lines, profile=profile),
+                                     statistics, profile)
+    else:
+        builders = build_stats(parse_file(lines, parsers, profile),
+                               statistics, profile)
+    return builders if profile is None else (builders, profile)
+
+
+def harvest_stats(feed, statistics=ALL_STATS, batches=False, profile=None):
+    """
+    Computes `statistics` over parsed records from `feed`, or over LogBatch
+    objects from `feed` if `batches` is true.
+
+    Timings of building statistics are added to Profile `profile` if it is
+    given (pass it to parse_file or iter_batches making `feed` for timings
+    of reading and parsing)
+    """
+    if batches:
+        stats_builders = build_batch_stats(feed, statistics, profile)
+    else:
+        stats_builders = build_stats(feed, statistics, profile)
+
     return {
         sb.name: sb.result()
         for sb in stats_builders
     }
 
 
+def harvest_file_stats(filename, statistics=ALL_STATS, workers=None,
+                       parsers=PARSERS, batches=False, line_filter=None,
+                       profile=None):
+    """
+    Computes `statistics` over uncompressed log file `filename`. With
+    `workers` > 1 the file is split into line-aligned byte ranges, which
+    are parsed with `parsers` (or into batches) in a process pool, and
+    partial statistics are merged in file order. Only lines for which
+    `line_filter` returns true are parsed, if it is given.
+
+    Timings of reading, parsing and building statistics are added to
+    Profile `profile` if it is given
+    """
+    stats_builders = build_stats((), statistics)
+    build = partial(build_range_stats, filename, statistics=statistics,
+                    parsers=parsers, batches=batches, line_filter=line_filter,
+                    profile=None if profile is None else Profile())
+
+    def merge(results):
+        for builders in results:
+            if profile is not None:
+                builders, range_profile = builders
+                profile.merge(range_profile)
+            for sb, other in zip(stats_builders, builders):
+                sb.merge(other)
+
+    if workers is None or workers <= 1:
+        merge([build(0, os.path.getsize(filename))])
+    else:
+        begins_ends = list(zip(*split_file(filename, workers)))
+        with ProcessPoolExecutor(workers) as pool:
+            merge(pool.map(build, *begins_ends or ((), ())))
+
+    return {
+        sb.name: sb.result()
+        for sb in stats_builders
+    }
+
+
+STATE_VERSION = 3
+CHECKPOINT_CHUNK = 16 * 2**20
+
+
+def _state_names(stats_builders):
+    # Class names tell exact and approximate variants apart, statistics
+    # names tell windows of different sizes apart
+    return [(type(sb).__name__, sb.name) for sb in stats_builders]
+
+
+def save_stats(filename, stats_builders, source=None, offset=None):
+    """
+    Atomically saves statistics builders to `filename`, together with
+    identity of the log `source` (os.stat result) and the byte `offset` up
+    to which it is processed
+    """
+    state = {
+        'version': STATE_VERSION,
+        'statistics': _state_names(stats_builders),
+        'source': None if source is None else (source.st_dev, source.st_ino),
+        'offset': offset,
+        'builders': stats_builders,
+    }
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, filename)
+
+
+def load_stats(filename, statistics=ALL_STATS):
+    """
+    Loads state saved by save_stats. Returns tuple (builders, source,
+    offset), raises ValueError if the state was saved by another version
+    or for other statistics
+    """
+    with open(filename, 'rb') as f:
+        state = pickle.load(f)
+    if state.get('version') != STATE_VERSION:
+        raise ValueError('{}: unsupported state version'.format(filename))
+    if state['statistics'] != _state_names(build_stats((), statistics)):
+        raise ValueError('{}: state has statistics {}'.format(
+            filename, ', '.join(name for _, name in state['statistics'])))
+    return state['builders'], state['source'], state['offset']
+
+
+def merge_stats(filenames, statistics=ALL_STATS):
+    """
+    Merges states saved by save_stats (e.g. daily ones into a weekly one)
+    in the given order. Returns statistics builders
+    """
+    stats_builders = build_stats((), statistics)
+    for filename in filenames:
+        builders, _, _ = load_stats(filename, statistics)
+        for sb, other in zip(stats_builders, builders):
+            sb.merge(other)
+
+    return stats_builders
+
+
+def checkpointed_stats(filename, checkpoint, statistics=ALL_STATS,
+                       parsers=PARSERS, batches=False, interval=60):
+    """
+    Builds `statistics` over log `filename`, saving state to `checkpoint`
+    at most every `interval` seconds and at the end. If `checkpoint`
+    exists, continues from the offset stored in it. A last line without a
+    newline is not processed: the saved offset is its start. Returns
+    statistics builders
+    """
+    st = os.stat(filename)
+    opener = log_opener(filename)
+    if os.path.exists(checkpoint):
+        stats_builders, source, offset = load_stats(checkpoint, statistics)
+        # Offsets in compressed logs are offsets of decompressed data
+        if source != (st.st_dev, st.st_ino) or (
+                opener is open and offset > st.st_size):
+            raise ValueError('{}: checkpoint is made for another file'.format(
+                checkpoint))
+    else:
+        stats_builders, offset = build_stats((), statistics), 0
+
+    next_save = time.monotonic() + interval
+    with opener(filename, 'rb') as f:
+        f.seek(offset)
+        while True:
+            raw_lines = f.readlines(CHECKPOINT_CHUNK)
+            # A last line without a newline may be still being written:
+            # leave it for the next run, which continues from its start
+            if raw_lines and not raw_lines[-1].endswith(b'\n'):
+                raw_lines.pop()
+            if not raw_lines:
+                break
+            offset += sum(map(len, raw_lines))
+            f.seek(offset)
+            lines = [line.decode('utf-8', 'replace') for line in raw_lines]
+
+            if batches:
+                batch = parse_batch(lines)
+                for sb in stats_builders:
+                    sb.handle_batch(batch)
+            else:
+                for record in parse_file(lines, parsers):
+                    for sb in stats_builders:
+                        sb.handle_record(record)
+
+            if time.monotonic() >= next_save:
+                save_stats(checkpoint, stats_builders, st, offset)
+                next_save = time.monotonic() + interval
+        save_stats(checkpoint, stats_builders, st, offset)
+
+    return stats_builders
+
+
+FOLLOW_READ_SIZE = 2**20
+
+
+def _split_lines(data):
+    return [line.decode('utf-8', 'replace')
+            for line in data.splitlines(keepends=True)]
+
+
+def follow(filename, interval=1.0):
+    """
+    Yields lists of lines of `filename` from its beginning and then of lines
+    appended to it, like `tail -F`. When the file is rotated (replaced by a
+    new file with the same name) the rest of the old file is read and the
+    new one is followed from its beginning, a truncated file is reread from
+    the beginning. When there is no new data, yields an empty list and
+    sleeps for `interval` seconds
+    """
+    f = open(filename, 'rb')
+    try:
+        tail = b''
+        while True:
+            data = f.read(FOLLOW_READ_SIZE)
+            if data:
+                data = tail + data
+                end = data.rfind(b'\n') + 1
+                tail = data[end:]
+                if end:
+                    yield _split_lines(data[:end])
+                continue
+
+            try:
+                st = os.stat(filename)
+            except FileNotFoundError:
+                # Rotated, but the new file is not created yet
+                st = None
+            if st is not None:
+                own = os.fstat(f.fileno())
+                if (st.st_ino, st.st_dev) != (own.st_ino, own.st_dev):
+                    data = tail + f.read()
+                    if data:
+                        yield _split_lines(data)
+                    f.close()
+                    f = open(filename, 'rb')
+                    tail = b''
+                    continue
+                if st.st_size < f.tell():
+                    f.seek(0)
+                    tail = b''
+                    continue
+
+            yield []
+            time.sleep(interval)
+    finally:
+        f.close()
+
+
+def follow_stats(filename, statistics=ALL_STATS, parsers=PARSERS,
+                 batches=False, interval=1.0, report_interval=60,
+                 output=None):
+    """
+    Updates `statistics` with lines of `filename` as it grows (see follow)
+    and writes a prepare_output report to `output` (stdout by default) at
+    most every `report_interval` seconds if there are new records, and once
+    more when interrupted. Reports are separated by '---' lines
+    """
+    output = sys.stdout if output is None else output
+    stats_builders = build_stats((), statistics)
+    fresh = False
+    next_report = time.monotonic() + report_interval
+
+    def report():
+        output.write('---\n')
+        output.write(prepare_output({sb.name: sb.result()
+                                     for sb in stats_builders}))
+        output.flush()
+
+    try:
+        for lines in follow(filename, interval):
+            if batches:
+                batch = parse_batch(lines)
+                if batch.size:
+                    for sb in stats_builders:
+                        sb.handle_batch(batch)
+                    fresh = True
+            else:
+                for record in parse_file(lines, parsers):
+                    for sb in stats_builders:
+                        sb.handle_record(record)
+                    fresh = True
+
+            if fresh and time.monotonic() >= next_report:
+                report()
+                fresh = False
+                next_report = time.monotonic() + report_interval
+    except KeyboardInterrupt:
+        pass
+
+    if fresh:
+        report()
+
+
 def main():
-    with sys.stdin as f:
-        stats = harvest_stats(parse_file(f))
-        print(prepare_output(stats))
+    parser = argparse.ArgumentParser(description='Access log statistics')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        metavar='N',
+                        help='process FILE in N processes')
+    parser.add_argument('--fast', action='store_true',
+                        help='use single-regex parser with compact records')
+    parser.add_argument('--batch', action='store_true',
+                        help='parse lines into column batches and update '
+                             'statistics batch by batch')
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='keep reading FILE as it grows (handling '
+                             'rotation and truncation) and report '
+                             'periodically')
+    parser.add_argument('--report-interval', type=float, default=60,
+                        metavar='SECONDS',
+                        help='report interval for --follow (default 60)')
+    parser.add_argument('--checkpoint', metavar='STATE',
+                        help='resume processing of FILE from STATE if it '
+                             'exists, save progress to it periodically and '
+                             'at the end')
+    parser.add_argument('--checkpoint-interval', type=float, default=60,
+                        metavar='SECONDS',
+                        help='save interval for --checkpoint (default 60)')
+    parser.add_argument('--merge', nargs='+', metavar='STATE',
+                        help='report on merged saved states instead of '
+                             'reading a log')
+    parser.add_argument('--save', metavar='STATE',
+                        help='save merged states to STATE (with --merge)')
+    parser.add_argument('--approx', action='append', metavar='NAME',
+                        default=[], choices=sorted(APPROX_STATS),
+                        help='use fixed-memory approximate variant of '
+                             'statistics NAME or add approximate-only one '
+                             '(may be repeated): %(choices)s. '
+                             'SlowestPercentilePages is not fixed-memory: it '
+                             'keeps a sketch per URL')
+    parser.add_argument('--window', action='append', default=[],
+                        metavar='NAME:SIZE[:STEP]',
+                        help='also compute statistics NAME per tumbling '
+                             'window of SIZE (e.g. 5m, 1h, 1d) or per window '
+                             'sliding by STEP (may be repeated)')
+    parser.add_argument('--lateness', type=parse_duration, default=60,
+                        metavar='DURATION',
+                        help='how late out of order records may come for '
+                             '--window (default 60s)')
+    parser.add_argument('--where', action='append', default=[],
+                        metavar='CONDITION',
+                        help='run a query instead of the statistics: only '
+                             'records with FIELD{=,!=,<,<=,>,>=}VALUE or '
+                             'FIELD~SUBSTRING (may be repeated). FIELD is '
+                             'one of ' + ', '.join(QUERY_FIELDS))
+    parser.add_argument('--group-by', metavar='FIELD',
+                        choices=list(QUERY_FIELDS),
+                        help='query results by values of FIELD')
+    parser.add_argument('--agg', action='append', default=[],
+                        metavar='AGGREGATE',
+                        help='query aggregate (may be repeated): count, '
+                             'sum, min, max, avg or pNN of a numeric FIELD '
+                             '(e.g. p99(process_time)) or distinct(FIELD); '
+                             'count by default')
+    parser.add_argument('--profile', action='store_true',
+                        help='write time spent in every parser stage and '
+                             'statistics, throughput and numbers of dropped '
+                             'lines to stderr')
+    parser.add_argument('--cache', action='store_true',
+                        help='read parsed FILE from binary columnar cache '
+                             'FILE' + CACHE_SUFFIX + ', (re)building it if it '
+                             'is missing or FILE has changed; implies '
+                             '--batch')
+    parser.add_argument('fn', metavar='FILE', nargs='?',
+                        help='log file, plain or compressed with gzip, '
+                             'bzip2 or xz (stdin by default)')
+    args = parser.parse_args()
+    parsers = FAST_PARSERS if args.fast else PARSERS
+    statistics = select_stats(args.approx)
+    try:
+        statistics += tuple(parse_window(window, statistics, args.lateness)
+                            for window in args.window)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.cache:
+        if args.fn is None:
+            parser.error('--cache needs a FILE')
+        if args.follow or args.checkpoint or args.merge:
+            parser.error('--cache does not support --follow, --checkpoint '
+                         'and --merge')
+        args.batch = True
+
+    query = None
+    if args.where or args.group_by or args.agg:
+        if args.window or args.approx:
+            parser.error('a query does not support --window and --approx')
+        try:
+            query = Query.parse(args.where, args.group_by,
+                                args.agg or ['count'])
+        except ValueError as e:
+            parser.error(str(e))
+        statistics = (partial(QueryStatistics, query=query),)
+    line_filter = (query.prefilter if query is not None and
+                   query.has_prefilter else None)
+
+    profile = Profile() if args.profile else None
+    if profile is not None and (args.merge or args.checkpoint or
+                                args.follow):
+        parser.error('--profile does not support --merge, --checkpoint and '
+                     '--follow')
+
+    def feed(f):
+        if line_filter is not None:
+            f = filter_lines(f, line_filter, profile)
+        if args.batch:
+            return iter_batches(f, profile=profile)
+        return parse_file(f, parsers, profile)
+
+    if args.merge:
+        try:
+            stats_builders = merge_stats(args.merge, statistics)
+            if args.save:
+                save_stats(args.save, stats_builders)
+        except (OSError, ValueError, pickle.UnpicklingError) as e:
+            sys.exit('Error: {}'.format(e))
+        print(prepare_output({sb.name: sb.result()
+                              for sb in stats_builders}))
+        return
+
+    if args.checkpoint:
+        if args.fn is None:
+            sys.exit('Error: --checkpoint needs a FILE')
+        try:
+            stats_builders = checkpointed_stats(
+                args.fn, args.checkpoint, statistics, parsers=parsers,
+                batches=args.batch, interval=args.checkpoint_interval)
+        except (OSError, ValueError, pickle.UnpicklingError) as e:
+            sys.exit('Error: {}'.format(e))
+        print(prepare_output({sb.name: sb.result()
+                              for sb in stats_builders}))
+        return
+
+    started = time.perf_counter()
+    compressed = args.fn is not None and log_opener(args.fn) is not open
+    if args.follow:
+        if args.fn is None:
+            sys.exit('Error: --follow needs a FILE')
+        if compressed:
+            sys.exit('Error: --follow needs an uncompressed FILE')
+        if args.workers is not None and args.workers > 1:
+            sys.exit('Error: --follow does not support --workers')
+        follow_stats(args.fn, statistics, parsers=parsers, batches=args.batch,
+                     report_interval=args.report_interval)
+        return
+
+    if args.cache:
+        # Parsing is what workers would share, and the cache skips it
+        stats = harvest_stats(cached_batches(args.fn, profile=profile),
+                              statistics, batches=True, profile=profile)
+    elif args.fn is None:
+        if args.workers is not None and args.workers > 1:
+            sys.exit('Error: --workers needs a FILE')
+        with sys.stdin as f:
+            stats = harvest_stats(feed(f), statistics, batches=args.batch,
+                                  profile=profile)
+    elif args.workers is not None and args.workers > 1 and not compressed:
+        stats = harvest_file_stats(args.fn, statistics, workers=args.workers,
+                                   parsers=parsers, batches=args.batch,
+                                   line_filter=line_filter, profile=profile)
+    else:
+        # Compressed logs can't be split into byte ranges: read_log
+        # decompresses them in a background process instead
+        stats = harvest_stats(feed(read_log(args.fn)), statistics,
+                              batches=args.batch, profile=profile)
+
+    if query is not None:
+        stats = stats[str(query)]
+    print(prepare_output(stats))
+    if profile is not None:
+        profile.elapsed = time.perf_counter() - started
+        sys.stderr.write(prepare_output({'Profile': profile.report()}))
 
 
 if __name__ == '__main__':
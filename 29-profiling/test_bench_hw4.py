@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import io
+import unittest
+
+import bench_hw4 as t
+import hw4
+
+
+def report(**seconds):
+    return {'results': [{'benchmark': name, 'seconds': value}
+                        for name, value in seconds.items()]}
+
+
+class TestFindRegressions(unittest.TestCase):
+    def test_regressions(self):
+        baseline = report(parse_file=1.0, harvest_stats=2.0)
+        self.assertEqual(
+            t.find_regressions(report(parse_file=1.5, harvest_stats=2.1),
+                               baseline, 0.2),
+            [('parse_file', 1.0, 1.5)])
+
+    def test_new_benchmark(self):
+        self.assertEqual(
+            t.find_regressions(report(parse_file=1.0, harvest_stats=9.0),
+                               report(parse_file=1.0), 0.2),
+            [])
+
+
+class TestGenerateLog(unittest.TestCase):
+    def generate(self, **kwargs):
+        f = io.StringIO()
+        t.generate_log(f, **kwargs)
+        return f.getvalue()
+
+    def test_deterministic(self):
+        log = self.generate(lines=1000, seed=1)
+        self.assertEqual(log, self.generate(lines=1000, seed=1))
+        self.assertNotEqual(log, self.generate(lines=1000, seed=2))
+
+    def test_lines(self):
+        # More lines than one chunk of generate_log
+        lines = t.GENERATE_CHUNK + 10
+        log = self.generate(lines=lines, days=2).splitlines(keepends=True)
+        self.assertEqual(len(log), lines)
+        self.assertEqual(sum(1 for _ in hw4.parse_file(log)), lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
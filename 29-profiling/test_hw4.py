@@ -0,0 +1,662 @@
+#!/usr/bin/env python3
+
+import bz2
+import datetime
+import gzip
+import io
+import lzma
+import os
+import tempfile
+import unittest
+from collections import defaultdict
+from functools import partial
+from unittest import mock
+
+import hw4 as t
+
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', '07-iterators', 'hw', 'hw4', 'examples')
+
+
+def read_example():
+    with bz2.open(os.path.join(EXAMPLES, 'example_1.log.bz2'), 'rt') as f:
+        return f.read()
+
+
+class TestParseTimestamp(unittest.TestCase):
+    def test_same_as_strptime(self):
+        for timestamp in ('08/Jul/2012:06:27:38 +0600',
+                          '31/Dec/1999:23:59:59 -0330',
+                          '01/Jan/2000:00:00:00 +0000',
+                          '8/Jul/2012:06:27:38 +0600'):
+            expected = datetime.datetime.strptime(timestamp,
+                                                  t.TIMESTAMP_FORMAT)
+            parsed = t.parse_timestamp(timestamp)
+            self.assertEqual(parsed, expected)
+            self.assertEqual(parsed.utcoffset(), expected.utcoffset())
+
+    def test_invalid(self):
+        for timestamp in ('08/Foo/2012:06:27:38 +0600',
+                          '30/Feb/2012:06:27:38 +0600', '',
+                          '08-Jul-2012 06:27:38 x0600',
+                          '08/Jul/2012:06:27:38 x0600',
+                          '08/Jul/2012:+6:27:38 +0600'):
+            with self.assertRaises(ValueError):
+                t.parse_timestamp(timestamp)
+
+
+class TestHarvestStats(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.data = read_example()
+        cls.lines = cls.data.splitlines(keepends=True)
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self._tmp.name, 'access.log')
+        with open(self.log, 'w') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_example(self):
+        self.assertDictEqual(t.harvest_stats(t.parse_file(self.lines)),
+                             EXAMPLE_1)
+
+    def test_fast_parsers(self):
+        fast = list(t.parse_file(self.lines, t.FAST_PARSERS))
+        slow = list(t.parse_file(self.lines))
+        self.assertEqual(len(fast), len(slow))
+        for fast_record, slow_record in zip(fast, slow):
+            for key, value in slow_record.items():
+                self.assertEqual(fast_record[key], value)
+
+        self.assertDictEqual(t.harvest_stats(iter(fast)), EXAMPLE_1)
+
+        record = fast[0]
+        self.assertEqual(record[0], record['IP'])
+        self.assertEqual(record[:2], (record['IP'], record['TIMESTAMP']))
+        for key in ('count', '__class__', 'ip'):
+            with self.assertRaises(KeyError):
+                record[key]
+
+    def test_merge(self):
+        for sizes in ((1, 9999), (5000, 5000), (3333, 3333, 3334)):
+            parts = []
+            begin = 0
+            for size in sizes:
+                parts.append(t.build_stats(
+                    t.parse_file(self.lines[begin:begin + size])))
+                begin += size
+
+            merged = t.build_stats(())
+            for builders in parts:
+                for sb, other in zip(merged, builders):
+                    sb.merge(other)
+            self.assertDictEqual({sb.name: sb.result() for sb in merged},
+                                 EXAMPLE_1)
+
+    def test_symbols(self):
+        builders = t.build_stats(t.parse_file(self.lines))
+        symbols = builders[0].symbols
+        for sb in builders:
+            self.assertIs(sb.symbols, symbols)
+        urls = symbols['REQUEST_URL']
+        self.assertEqual(len(urls), len(set(urls.strings)))
+        for i, url in enumerate(urls.strings):
+            self.assertEqual(urls[url], i)
+
+        pages = builders[t.ALL_STATS.index(t.MostPopularPage)].pages
+        self.assertEqual(sum(pages), len(self.lines))
+        self.assertEqual(len(pages), len(urls))
+
+    def test_split_file(self):
+        ranges = t.split_file(self.log, 7)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.log))
+        lines = []
+        for begin, end in ranges:
+            lines.extend(t.read_lines(self.log, begin, end))
+        self.assertListEqual(lines, self.lines)
+
+    def test_workers(self):
+        for workers in (None, 3):
+            self.assertDictEqual(
+                t.harvest_file_stats(self.log, workers=workers), EXAMPLE_1)
+
+    def test_batches(self):
+        for batch_size in (t.BATCH_SIZE, 1000, 3):
+            self.assertDictEqual(
+                t.harvest_stats(t.iter_batches(self.lines, batch_size),
+                                batches=True),
+                EXAMPLE_1)
+
+    def test_batches_without_numpy(self):
+        with mock.patch.object(t, 'np', None):
+            batch = t.parse_batch(self.lines)
+            self.assertIsInstance(batch.columns['PROCESS_TIME'], list)
+            self.assertDictEqual(
+                t.harvest_stats(t.iter_batches(self.lines, 1000),
+                                batches=True),
+                EXAMPLE_1)
+
+    def test_parse_batch(self):
+        records = list(t.parse_file(self.lines, t.FAST_PARSERS))
+        batch = t.parse_batch(self.lines + ['garbage\n'])
+        self.assertEqual(len(batch), len(records))
+        for i in (0, 1, len(records) // 2, len(records) - 1):
+            for field in ('IP', 'REQUEST_URL', 'USER_AGENT'):
+                self.assertEqual(batch.value(field, i), records[i][field])
+            for field in ('STATUS', 'SIZE', 'PROCESS_TIME'):
+                self.assertEqual(batch.columns[field][i], records[i][field])
+            self.assertEqual(batch.value('DATE', i),
+                             records[i]['DATETIME'].date())
+
+    def test_checkpoint(self):
+        checkpoint = os.path.join(self._tmp.name, 'state')
+        for batches in (False, True):
+            with open(self.log, 'w') as f:
+                f.writelines(self.lines[:4000])
+            t.checkpointed_stats(self.log, checkpoint, batches=batches)
+            with open(self.log, 'a') as f:
+                f.writelines(self.lines[4000:])
+            builders = t.checkpointed_stats(self.log, checkpoint,
+                                            batches=batches, interval=0)
+            self.assertDictEqual({sb.name: sb.result() for sb in builders},
+                                 EXAMPLE_1)
+            _, _, offset = t.load_stats(checkpoint)
+            self.assertEqual(offset, os.path.getsize(self.log))
+            os.remove(checkpoint)
+
+    def test_checkpoint_partial_line(self):
+        checkpoint = os.path.join(self._tmp.name, 'state')
+        head = ''.join(self.lines[:4000])
+        cut = len(head) + len(self.lines[4000]) // 2
+        statistics = t.ALL_STATS + (
+            partial(t.QueryStatistics, query=t.Query()),)
+        for batches in (False, True):
+            # The log is cut in the middle of a line being written
+            with open(self.log, 'w') as f:
+                f.write(self.data[:cut])
+            t.checkpointed_stats(self.log, checkpoint, statistics,
+                                 batches=batches)
+            _, _, offset = t.load_stats(checkpoint, statistics)
+            self.assertEqual(offset, len(head.encode()))
+
+            with open(self.log, 'a') as f:
+                f.write(self.data[cut:])
+            builders = t.checkpointed_stats(self.log, checkpoint, statistics,
+                                            batches=batches)
+            results = {sb.name: sb.result() for sb in builders}
+            self.assertEqual(results.pop('count'),
+                             {'count': len(self.lines)})
+            self.assertDictEqual(results, EXAMPLE_1)
+            os.remove(checkpoint)
+
+    def test_checkpoint_other_file(self):
+        checkpoint = os.path.join(self._tmp.name, 'state')
+        other = os.path.join(self._tmp.name, 'other.log')
+        with open(other, 'w') as f:
+            f.writelines(self.lines[:10])
+        t.checkpointed_stats(other, checkpoint)
+        with self.assertRaises(ValueError):
+            t.checkpointed_stats(self.log, checkpoint)
+        with self.assertRaises(ValueError):
+            t.load_stats(checkpoint, t.ALL_STATS[1:])
+
+    def test_merge_states(self):
+        states = []
+        for i, begin in enumerate(range(0, len(self.lines), 3000)):
+            states.append(os.path.join(self._tmp.name, 'day{}'.format(i)))
+            t.save_stats(states[-1], t.build_stats(
+                t.parse_file(self.lines[begin:begin + 3000])))
+        builders = t.merge_stats(states)
+        self.assertDictEqual({sb.name: sb.result() for sb in builders},
+                             EXAMPLE_1)
+
+    def test_approx(self):
+        statistics = t.select_stats(
+            ['MostPopularPage', 'MostActiveClient', 'MostPopularBrowser',
+             'MostActiveClientByDay', 'SlowestAveragePage',
+             'DistinctClients'])
+        self.assertIn(t.ApproxMostPopularPage, statistics)
+        self.assertNotIn(t.MostPopularPage, statistics)
+        self.assertIn(t.ApproxSlowestAveragePage, statistics)
+        self.assertEqual(statistics[-1], t.DistinctClients)
+
+        # Nothing grows with the number of distinct values
+        builders = t.build_stats(t.parse_file(self.lines), statistics)
+        self.assertDictEqual(builders[0].symbols, {})
+
+        expected = dict(EXAMPLE_1, DistinctClients=24)
+        self.assertDictEqual(
+            t.harvest_stats(t.parse_file(self.lines), statistics), expected)
+        self.assertDictEqual(
+            t.harvest_stats(t.iter_batches(self.lines, 1000), statistics,
+                            batches=True),
+            expected)
+        self.assertDictEqual(
+            t.harvest_file_stats(self.log, statistics, workers=3), expected)
+
+        with self.assertRaises(ValueError):
+            t.select_stats(['SlowestPage'])
+
+    @mock.patch.object(t.ApproxMostActiveClientByDay, 'CAPACITY', 2)
+    def test_approx_client_by_day(self):
+        # Singletons between them take 3 off the counter of 'a', so the
+        # summary alone would rank 'b' first
+        day = datetime.datetime(2013, 2, 17, tzinfo=datetime.timezone.utc)
+        ips = ['a'] * 5 + ['s{}'.format(i) for i in range(6)] + ['b'] * 4
+        stat = t.ApproxMostActiveClientByDay()
+        for ip in ips:
+            stat.handle_record({'DATETIME': day, 'IP': ip})
+        summary = stat.stat_by_day[day.date()]
+        self.assertLess(summary.estimate('a'), summary.estimate('b'))
+        self.assertEqual(stat.result(), {day.date(): 'a'})
+
+    def test_percentiles(self):
+        statistics = t.select_stats(['SlowestPercentilePages'])
+        builders = t.build_stats(t.parse_file(self.lines), statistics)
+        stat = builders[-1]
+        times = defaultdict(list)
+        for record in t.parse_file(self.lines):
+            times[record['REQUEST_URL']].append(record['PROCESS_TIME'])
+        for url, values in times.items():
+            values.sort()
+            for name, q in stat.QUANTILES:
+                expected = values[int(q * (len(values) - 1))]
+                self.assertLessEqual(
+                    abs(stat.percentiles(url)[name] - expected),
+                    stat.ALPHA * expected + 1e-9)
+
+        result = stat.result()
+        self.assertEqual(result['p99'], EXAMPLE_1['SlowestAveragePage'])
+        for stats in (
+                t.harvest_stats(t.iter_batches(self.lines, 1000), statistics,
+                                batches=True),
+                t.harvest_file_stats(self.log, statistics, workers=3)):
+            self.assertDictEqual(stats['SlowestPercentilePages'], result)
+
+        # Times so large that (URL id, time) pairs don't fit in int64
+        lines = [line.rsplit(' ', 1)[0] + ' {}\n'.format(2**61 + i)
+                 for i, line in enumerate(self.lines[:200])]
+        statistics = [t.SlowestPercentilePages]
+        self.assertDictEqual(
+            t.harvest_stats(t.iter_batches(lines), statistics, batches=True),
+            t.harvest_stats(t.parse_file(lines), statistics))
+
+    def test_read_log(self):
+        data = self.data.encode()
+        expected = self.data.rstrip('\n').split('\n')
+        half = len(data) // 2
+        for name, compress in (('log', bytes), ('log.gz', gzip.compress),
+                               ('log.bz2', bz2.compress),
+                               ('log.xz', lzma.compress)):
+            path = os.path.join(self._tmp.name, name)
+            with open(path, 'wb') as f:
+                # Concatenated compressed streams as in multi-member gzip
+                f.write(compress(data[:half]) + compress(data[half:]))
+            self.assertListEqual(list(t.read_log(path, chunk_size=4096)),
+                                 expected)
+
+            # Stopping early must not hang the reader
+            lines = t.read_log(path, chunk_size=4096, queue_size=1)
+            next(lines)
+            lines.close()
+
+        self.assertDictEqual(
+            t.harvest_stats(t.parse_file(t.read_log(path))), EXAMPLE_1)
+
+    def test_read_log_truncated(self):
+        path = os.path.join(self._tmp.name, 'log.gz')
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(self.data.encode())[:-100])
+        with self.assertRaises(EOFError):
+            list(t.read_log(path))
+
+    def test_batch_workers(self):
+        self.assertDictEqual(t.harvest_file_stats(self.log, workers=3,
+                                                  batches=True),
+                             EXAMPLE_1)
+
+    def test_query(self):
+        records = list(t.parse_file(self.lines))
+        for where in (['status=302'], ['status>=300', 'size<1000'],
+                      ['url~ajax', 'method=GET'], ['ip=192.168.12.210'],
+                      ['referrer~http', 'method=POST'],
+                      ['process_time>100000', 'status!=200'],
+                      ['date=2013-02-17', 'user_agent~Firefox']):
+            query = t.Query.parse(where, 'url', ['count', 'sum(size)',
+                                                 'max(process_time)'])
+            self.assertTrue(query.has_prefilter)
+            expected = defaultdict(lambda: {'count': 0, 'sum(size)': 0,
+                                            'max(process_time)': 0})
+            for line, record in zip(self.lines, records):
+                if query.matches(record):
+                    self.assertTrue(query.prefilter(line))
+                    group = expected[record['REQUEST_URL']]
+                    group['count'] += 1
+                    group['sum(size)'] += record['SIZE']
+                    group['max(process_time)'] = max(
+                        group['max(process_time)'], record['PROCESS_TIME'])
+            self.assertTrue(expected)
+
+            statistics = [partial(t.QueryStatistics, query=query)]
+            for stats in (
+                    t.harvest_stats(t.parse_file(self.lines), statistics),
+                    t.harvest_stats(
+                        t.parse_file(filter(query.prefilter, self.lines),
+                                     t.FAST_PARSERS), statistics),
+                    t.harvest_file_stats(self.log, statistics, workers=3,
+                                         line_filter=query.prefilter),
+                    t.harvest_stats(t.iter_batches(self.lines, 1000),
+                                    statistics, batches=True)):
+                self.assertDictEqual(stats[str(query)], expected)
+
+    def test_query_profile(self):
+        query = t.Query.parse(['status=302'])
+        statistics = [partial(t.QueryStatistics, query=query)]
+        rejected = sum(not query.prefilter(line) for line in self.lines)
+        self.assertTrue(rejected)
+
+        profile = t.Profile()
+        t.harvest_stats(t.parse_file(t.filter_lines(
+            self.lines, query.prefilter, profile), t.FAST_PARSERS, profile),
+            statistics, profile=profile)
+        for batches in (False, True):
+            worker_profile = t.Profile()
+            t.harvest_file_stats(self.log, statistics, workers=3,
+                                 batches=batches, line_filter=query.prefilter,
+                                 profile=worker_profile)
+            for p in (profile, worker_profile):
+                self.assertEqual(p.lines, len(self.lines))
+                self.assertEqual(p.dropped['prefilter', 'no match'], rejected)
+
+    def test_query_aggregates(self):
+        query = t.Query.parse(['status=200'], None, [
+            'count', 'min(size)', 'avg(process_time)', 'p50(process_time)',
+            'p99(process_time)', 'distinct(ip)'])
+        self.assertEqual(
+            str(query), 'count, min(size), avg(process_time), '
+            'p50(process_time), p99(process_time), distinct(ip) '
+            'where status=200')
+        records = [record for record in t.parse_file(self.lines)
+                   if record['STATUS'] == 200]
+        times = sorted(record['PROCESS_TIME'] for record in records)
+        result = t.build_stats(t.parse_file(self.lines), [
+            partial(t.QueryStatistics, query=query)])[0].result()
+        self.assertEqual(result['count'], len(times))
+        self.assertAlmostEqual(result['avg(process_time)'],
+                               sum(times) / len(times))
+        for name, q in (('p50(process_time)', 0.5),
+                        ('p99(process_time)', 0.99)):
+            expected = times[int(q * (len(times) - 1))]
+            self.assertLessEqual(abs(result[name] - expected),
+                                 0.01 * expected + 1)
+        self.assertAlmostEqual(result['distinct(ip)'],
+                               len({record['IP'] for record in records}),
+                               delta=1)
+
+        for where, agg in ((['status~5'], []), (['size>big'], []),
+                           (['foo=1'], []), ([], ['p99(url)']),
+                           ([], ['sum']), ([], ['median(size)'])):
+            with self.assertRaises(ValueError):
+                t.Query.parse(where, None, agg)
+
+        for query in (query, t.Query.parse([], 'date', [
+                'count', 'distinct(referrer)', 'p95(process_time)'])):
+            statistics = [partial(t.QueryStatistics, query=query)]
+            self.assertEqual(
+                t.build_batch_stats(t.iter_batches(self.lines, 1000),
+                                    statistics)[0].result(),
+                t.build_stats(t.parse_file(self.lines),
+                              statistics)[0].result())
+
+    def test_raw_status_and_size(self):
+        for line, record in zip(self.lines, t.parse_file(self.lines)):
+            self.assertEqual(t.raw_status_and_size(line),
+                             (record['STATUS'], record['SIZE']))
+        self.assertIsNone(t.raw_status_and_size('garbage'))
+
+    def test_profile(self):
+        lines = self.lines + ['garbage\n', '1.2.3.4 - - [bad date] "GET / '
+                              'HTTP/1.1" 200 1 "-" "-" 1\n']
+        profile = t.Profile()
+        stats = t.harvest_stats(t.parse_file(lines, profile=profile),
+                                profile=profile)
+        self.assertDictEqual(stats, EXAMPLE_1)
+        self.assertEqual(profile.lines, len(lines))
+        self.assertEqual(profile.records, len(self.lines))
+        self.assertDictEqual(dict(profile.dropped), {
+            ('parse_to_dict', 'AttributeError'): 1,
+            ('parse_datetime', 'ValueError'): 1})
+        self.assertSetEqual(set(profile.stage_times), {
+            'read', 'parse_to_dict', 'parse_ints', 'parse_datetime',
+            'parse_request'})
+        self.assertSetEqual(set(profile.handle_times), set(EXAMPLE_1))
+
+        with open(self.log, 'a') as f:
+            f.writelines(lines[len(self.lines):])
+        for batches in (False, True):
+            profile = t.Profile()
+            stats = t.harvest_file_stats(self.log, workers=3,
+                                         batches=batches, profile=profile)
+            self.assertDictEqual(stats, EXAMPLE_1)
+            self.assertEqual(profile.lines, len(lines))
+            self.assertEqual(profile.records, len(self.lines))
+            self.assertEqual(sum(profile.dropped.values()), 2)
+        self.assertIn('parse_batch', profile.stage_times)
+
+        report = profile.report()
+        self.assertEqual(report['dropped'],
+                         {'parse_batch': {'invalid line': 2}})
+        self.assertIsNone(report['lines per second'])
+        profile.elapsed = 2
+        self.assertEqual(t.Profile().report()['dropped'], 0)
+        self.assertEqual(profile.report()['lines per second'],
+                         len(lines) // 2)
+
+    def test_cache(self):
+        cache = t.cache_path(self.log)
+        for without_numpy in (False, True):
+            with mock.patch.object(t, 'np', None if without_numpy else t.np):
+                self.assertIsNone(t.read_cache(self.log))
+                self.assertDictEqual(
+                    t.harvest_stats(t.cached_batches(self.log, 1000),
+                                    batches=True),
+                    EXAMPLE_1)
+                self.assertTrue(os.path.exists(cache))
+
+                batches = list(t.read_cache(self.log))
+                self.assertEqual(len(batches), 10)
+                expected = t.parse_batch(self.lines[1000:2000])
+                for field in t.CACHE_FIELDS:
+                    self.assertListEqual(list(batches[1].columns[field]),
+                                         list(expected.columns[field]))
+                self.assertDictEqual(batches[1].values, expected.values)
+                self.assertEqual(batches[1].tzinfo, expected.tzinfo)
+
+                with mock.patch.object(t, 'iter_batches') as iter_batches:
+                    self.assertDictEqual(
+                        t.harvest_stats(t.cached_batches(self.log),
+                                        batches=True),
+                        EXAMPLE_1)
+                iter_batches.assert_not_called()
+
+                # A changed log invalidates the cache
+                with open(self.log, 'w') as f:
+                    f.writelines(self.lines[:5000])
+                self.assertIsNone(t.read_cache(self.log))
+                stats = t.harvest_stats(t.cached_batches(self.log),
+                                        batches=True)
+                self.assertEqual(
+                    stats, t.harvest_stats(t.parse_file(self.lines[:5000])))
+                self.assertIsNotNone(t.read_cache(self.log))
+
+                with open(self.log, 'w') as f:
+                    f.write(self.data)
+                os.remove(cache)
+
+    def test_cache_compressed(self):
+        path = os.path.join(self._tmp.name, 'access.log.gz')
+        with gzip.open(path, 'wt') as f:
+            f.write(self.data)
+        window = t.windowed(t.MostActiveClient, 300)
+        expected = t.harvest_stats(t.parse_file(self.lines),
+                                   t.ALL_STATS + (window,))
+        for _ in range(2):
+            self.assertDictEqual(
+                t.harvest_stats(t.cached_batches(path), t.ALL_STATS +
+                                (window,), batches=True),
+                expected)
+
+        # Stopping early leaves neither a cache nor a temporary file
+        os.remove(t.cache_path(path))
+        batches = t.cached_batches(path, 1000)
+        next(batches)
+        batches.close()
+        self.assertListEqual(sorted(os.listdir(self._tmp.name)),
+                             ['access.log', 'access.log.gz'])
+
+    def brute_force_windows(self, statistics, size, step):
+        records = list(t.parse_file(self.lines))
+        tzinfo = records[0]['DATETIME'].tzinfo
+        offset = int(records[0]['DATETIME'].utcoffset().total_seconds())
+        windows = defaultdict(list)
+        for record in records:
+            pane = (int(record['DATETIME'].timestamp()) + offset) // step
+            for end in range(pane, pane + size // step):
+                windows[end].append(record)
+        return {
+            datetime.datetime.fromtimestamp(
+                (end + 1) * step - size - offset, tzinfo):
+            t.build_stats(window, [statistics])[0].result()
+            for end, window in windows.items()
+        }
+
+    def test_windows(self):
+        for size, step, name in ((300, None, 'MostActiveClientPer5m'),
+                                 (600, 120, 'MostActiveClientPer10mEvery2m')):
+            expected = self.brute_force_windows(t.MostActiveClient, size,
+                                                step or size)
+            window = t.windowed(t.MostActiveClient, size, step)
+            builder = t.build_stats(t.parse_file(self.lines), [window])[0]
+            self.assertEqual(builder.name, name)
+            self.assertEqual(builder.late, 0)
+            self.assertLessEqual(len(builder.panes),
+                                 2 * builder.width + 2 * builder.lateness)
+            self.assertDictEqual(builder.result(), expected)
+
+            for stats in (
+                    t.harvest_stats(t.iter_batches(self.lines, 1000),
+                                    [window], batches=True),
+                    t.harvest_file_stats(self.log, [window], workers=3),
+                    t.harvest_file_stats(self.log, [window], workers=7,
+                                         batches=True)):
+                self.assertDictEqual(stats[name], expected)
+            with mock.patch.object(t, 'np', None):
+                self.assertDictEqual(
+                    t.harvest_stats(t.iter_batches(self.lines, 1000),
+                                    [window], batches=True)[name],
+                    expected)
+
+    def test_window_late_records(self):
+        records = list(t.parse_file(self.lines))
+        start = records[0]['DATETIME']
+
+        def at(minutes):
+            return next(record for record in records if record['DATETIME'] >=
+                        start + datetime.timedelta(minutes=minutes))
+
+        builder = t.windowed(t.MostActiveClient, 300, lateness=60)()
+        for record in (records[0], at(40), at(20), at(38)):
+            builder.handle_record(record)
+        self.assertEqual(builder.late, 1)
+        self.assertListEqual(list(builder.result().values()),
+                             [records[0]['IP'], at(38)['IP']])
+
+    def test_parse_window(self):
+        window = t.parse_window('MostActiveClient:1h:5m')(None)
+        self.assertEqual(window.name, 'MostActiveClientPer1hEvery5m')
+        window = t.parse_window('MostActiveClient:1d',
+                                t.select_stats(['MostActiveClient']))(None)
+        self.assertIsInstance(window.statistics(), t.ApproxMostActiveClient)
+        for text in ('MostActiveClient', 'Foo:5m', 'MostActiveClient:5x',
+                     'MostActiveClient:5m:2m', 'MostActiveClient:0s'):
+            with self.assertRaises(ValueError):
+                t.parse_window(text)
+
+        state = os.path.join(self._tmp.name, 'state')
+        t.save_stats(state, t.build_stats((), [t.parse_window(
+            'MostActiveClient:5m')]))
+        with self.assertRaises(ValueError):
+            t.load_stats(state, [t.parse_window('MostActiveClient:1h')])
+
+
+class TestFollow(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self._tmp.name, 'access.log')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def write(self, data, mode='a', path=None):
+        with open(path or self.log, mode) as f:
+            f.write(data)
+
+    def test_follow(self):
+        self.write('a\nb', 'w')
+        lines = t.follow(self.log, interval=0)
+        self.assertListEqual(next(lines), ['a\n'])
+        self.assertListEqual(next(lines), [])
+
+        self.write('\nc\n')
+        self.assertListEqual(next(lines), ['b\n', 'c\n'])
+        self.assertListEqual(next(lines), [])
+
+        # Truncation
+        self.write('d\n', 'w')
+        self.assertListEqual(next(lines), ['d\n'])
+
+        # Rotation: the rest of the old file comes first
+        self.write('e\nf')
+        os.rename(self.log, self.log + '.1')
+        self.assertListEqual(next(lines), ['e\n'])
+        self.assertListEqual(next(lines), [])
+        self.write('g\n', 'w')
+        self.assertListEqual(next(lines), ['f'])
+        self.assertListEqual(next(lines), ['g\n'])
+        lines.close()
+
+    def test_follow_stats(self):
+        lines = read_example().splitlines(keepends=True)
+        chunks = [lines[:5000], [], lines[5000:], []]
+        for batches in (False, True):
+            output = io.StringIO()
+            with mock.patch.object(t, 'follow',
+                                   return_value=iter(chunks)):
+                t.follow_stats(self.log, batches=batches, report_interval=0,
+                               output=output)
+            reports = output.getvalue().split('---\n')
+            self.assertEqual(len(reports), 3)
+            self.assertEqual(reports[-1], t.prepare_output(EXAMPLE_1))
+
+
+EXAMPLE_1 = {
+    'FastestPage': '/css/main.css',
+    'MostActiveClient': '192.168.74.151',
+    'MostActiveClientByDay': {datetime.date(2013, 2, 17): '192.168.74.151'},
+    'MostPopularBrowser': 'Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 6.1; '
+                          'WOW64; Trident/5.0; SLCC2; .NET CLR 2.0.50727; '
+                          '.NET CLR 3.5.30729; .NET CLR 3.0.30729; Media '
+                          'Center PC 6.0; InfoPath.3; .NET4.0C; .NET4.0E)',
+    'MostPopularPage': '/pause/ajaxPause?pauseConfigId=&admin=0',
+    'SlowestAveragePage': '/lib/callider/graph.registr_tel.php?auto=0',
+    'SlowestPage': '/pause/ajaxPause?pauseConfigId=&admin=0'}
+
+
+if __name__ == '__main__':
+    unittest.main()
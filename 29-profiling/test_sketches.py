@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import random
+import unittest
+from collections import Counter
+
+import sketches as t
+
+
+def zipf_stream(n, seed=0):
+    rnd = random.Random(seed)
+    return ['key{}'.format(int(rnd.paretovariate(1.0))) for _ in range(n)]
+
+
+class TestMisraGries(unittest.TestCase):
+    def check_bounds(self, summary, counts):
+        error = summary.error()
+        self.assertLessEqual(error, sum(counts.values()) //
+                             (summary.capacity + 1))
+        self.assertLessEqual(len(summary), summary.capacity)
+        for key, count in counts.items():
+            self.assertLessEqual(summary.estimate(key), count)
+            self.assertGreaterEqual(summary.estimate(key), count - error)
+
+    def test_bounds(self):
+        stream = zipf_stream(20000)
+        summary = t.MisraGries(50)
+        for key in stream:
+            summary.add(key)
+        self.check_bounds(summary, Counter(stream))
+
+    def test_weighted(self):
+        counts = Counter(zipf_stream(20000))
+        summary = t.MisraGries(20)
+        for key, count in counts.items():
+            summary.add(key, count)
+        self.check_bounds(summary, counts)
+
+    def test_merge(self):
+        stream = zipf_stream(30000)
+        merged = t.MisraGries(50)
+        for begin in range(0, len(stream), 7000):
+            part = t.MisraGries(50)
+            for key in stream[begin:begin + 7000]:
+                part.add(key)
+            merged.merge(part)
+        self.assertEqual(merged.total, len(stream))
+        self.check_bounds(merged, Counter(stream))
+
+
+class TestCountMinSketch(unittest.TestCase):
+    def test_bounds(self):
+        stream = zipf_stream(20000)
+        sketch = t.CountMinSketch(width=2**10, depth=4)
+        for key in stream:
+            sketch.add(key)
+        for key, count in Counter(stream).items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+        self.assertEqual(sketch.estimate('key1'), Counter(stream)['key1'])
+
+    def test_merge(self):
+        stream = zipf_stream(10000)
+        whole = t.CountMinSketch(width=2**8, depth=3)
+        first = t.CountMinSketch(width=2**8, depth=3)
+        second = t.CountMinSketch(width=2**8, depth=3)
+        for i, key in enumerate(stream):
+            whole.add(key)
+            (first if i % 2 else second).add(key)
+        first.merge(second)
+        self.assertEqual(first.table, whole.table)
+        with self.assertRaises(ValueError):
+            first.merge(t.CountMinSketch(width=2**8, depth=4))
+
+
+class TestHyperLogLog(unittest.TestCase):
+    def test_count(self):
+        for n in (0, 1, 100, 5000, 100000):
+            hll = t.HyperLogLog()
+            for i in range(n):
+                hll.add(str(i))
+                hll.add(str(i))
+            self.assertAlmostEqual(hll.count(), n, delta=n * 0.03)
+
+    def test_merge(self):
+        first, second = t.HyperLogLog(10), t.HyperLogLog(10)
+        for i in range(20000):
+            first.add(str(i))
+        for i in range(10000, 40000):
+            second.add(str(i))
+        first.merge(second)
+        # 1.04 / sqrt(1024) = 3.25% standard error
+        self.assertAlmostEqual(first.count(), 40000, delta=40000 * 0.1)
+
+
+class TestDDSketch(unittest.TestCase):
+    QUANTILES = (0, 0.25, 0.5, 0.9, 0.95, 0.99, 1)
+
+    def check(self, sketch, values):
+        values = sorted(values)
+        for q in self.QUANTILES:
+            expected = values[int(q * (len(values) - 1))]
+            self.assertLessEqual(abs(sketch.quantile(q) - expected),
+                                 sketch.alpha * expected + 1e-9)
+
+    def test_quantiles(self):
+        rnd = random.Random(0)
+        values = [int(rnd.lognormvariate(8, 2)) for _ in range(20000)]
+        sketch = t.DDSketch()
+        for value in values:
+            sketch.add(value)
+        self.check(sketch, values)
+        self.assertIsNone(t.DDSketch().quantile(0.5))
+
+    def test_merge(self):
+        rnd = random.Random(1)
+        values = [rnd.expovariate(0.001) for _ in range(10000)] + [0] * 50
+        whole, first, second = t.DDSketch(), t.DDSketch(), t.DDSketch()
+        for i, value in enumerate(values):
+            whole.add(value)
+            (first if i % 3 else second).add(value)
+        first.merge(second)
+        self.assertEqual(first.buckets, whole.buckets)
+        self.check(first, values)
+        with self.assertRaises(ValueError):
+            first.merge(t.DDSketch(0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+Helpers shared by benchmark scripts of the course (09-tar/bench_untar.py,
+29-profiling/bench_hw4.py)
+"""
+import resource
+from operator import itemgetter
+
+
+def peak_rss_kb():
+    """
+    Peak memory of the current process in KiB. ru_maxrss on Linux also
+    counts memory of the parent before exec, so VmHWM is preferred
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def find_regressions(report, baseline, tolerance,
+                     key=itemgetter('benchmark')):
+    """
+    Returns list of (key, old seconds, new seconds) of results in `report`
+    slower than the result with the same `key` in `baseline` more than
+    1 + `tolerance` times. Results missing from `baseline` are skipped
+    """
+    old = {key(result): result for result in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        base = old.get(key(result))
+        if base is not None and \
+                result['seconds'] > base['seconds'] * (1 + tolerance):
+            regressions.append((key(result), base['seconds'],
+                                result['seconds']))
+    return regressions